@@ -7,7 +7,7 @@ import MyPythonScript from './python/MyPythonScript.py';
 (() => {
   const browser = window.chrome || window.browser;
   const MODELS = [
-    'cv.joblib',
+    'vocabulary.npz',
     'df_articles.csv',
     'wwt_config.json',
     'xbm25.npz',
@@ -1,16 +1,66 @@
 # Copyright 2020-present Kensho Technologies, LLC.
+from collections import OrderedDict
 import io
+import json
 from nltk.stem.snowball import SnowballStemmer
+from sklearn.feature_extraction.text import CountVectorizer
 import scipy.sparse
-import joblib
 import pandas as pd
 import numpy as np
 
 
+class CachedStemmer:
+    """LRU memoized stemmer (same interface as wikiwhatsthis.stem_cache.CachedStemmer)."""
+
+    def __init__(self, stemmer, maxsize=100_000):
+        self.stemmer = stemmer
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stem(self, token):
+        stem = self._cache.get(token)
+        if stem is not None:
+            self.hits += 1
+            self._cache.move_to_end(token)
+            return stem
+        self.misses += 1
+        stem = self.stemmer.stem(token)
+        self._insert(token, stem)
+        return stem
+
+    def warm(self, tokens):
+        for token in tokens:
+            if token not in self._cache:
+                self._insert(token, self.stemmer.stem(token))
+
+    def _insert(self, token, stem):
+        self._cache[token] = stem
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._cache),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
 global_objects = {
-    "stemmer": SnowballStemmer("english"),
+    "stemmer": CachedStemmer(SnowballStemmer("english")),
 }
 
+# stem the model vocabulary into the cache when vocabulary.npz is loaded
+WARM_STEM_CACHE = False
+
 
 # Make loading safe vs. malicious input
 PICKLE_KWARGS = dict(allow_pickle=False)
@@ -93,19 +143,127 @@ def set_model_file_data(name, value):
         global_objects["df_articles"] = pd.read_csv(io.BytesIO(value))
         # print(global_objects["df_articles"].head())
 
-    if name == "cv.joblib":
+    if name == "wwt_config.json":
         print("reading {}".format(name))
-        # print("type(value): ", type(value))
-        global_objects["cv"] = joblib.load(io.BytesIO(value))
+        # the analyzer only needs the CountVectorizer arguments, not the fitted vocabulary
+        cv_args = json.loads(bytes(value))["cv_args"]
+        cv_args["ngram_range"] = tuple(cv_args["ngram_range"])
+        global_objects["cv"] = CountVectorizer(**cv_args)
         global_objects["tokenizer"] = global_objects["cv"].build_tokenizer()
         global_objects["analyzer"] = global_objects["cv"].build_analyzer()
-        # print(global_objects["cv"])
+
+    if name == "vocabulary.npz":
+        print("reading {}".format(name))
+        # sorted utf-8 token buffer with offsets (see wikiwhatsthis.vocabulary.Vocabulary)
+        with np.load(io.BytesIO(value), **PICKLE_KWARGS) as loaded:
+            global_objects["vocabulary"] = {key: loaded[key] for key in loaded.files}
+        if WARM_STEM_CACHE:
+            vocab = global_objects["vocabulary"]
+            global_objects["stemmer"].warm(
+                vocab["buffer"][start:stop].tobytes().decode("utf-8")
+                for start, stop in zip(vocab["offsets"][:-1], vocab["offsets"][1:])
+            )
 
     if name == "xbm25.npz":
         print("reading {}".format(name))
         # print("type(value): ", type(value))
-        global_objects["xbm25"] = load_npz(io.BytesIO(value))
-        # print(global_objects["xbm25"][0])
+        # term-major posting lists (row t holds the (topic id, impact) pairs of term t)
+        global_objects["postings"] = scipy.sparse.csr_matrix(load_npz(io.BytesIO(value)).T)
+
+
+def lookup_tokens(tokens):
+    """Return the column id of each token (-1 if unknown) with a vectorized binary search.
+
+    Same algorithm as wikiwhatsthis.vocabulary.Vocabulary.lookup.
+    """
+    vocab = global_objects["vocabulary"]
+    buffer, offsets = vocab["buffer"], vocab["offsets"]
+    num_queries, num_tokens = len(tokens), len(offsets) - 1
+    column_ids = np.full(num_queries, -1, dtype=np.int64)
+    if num_queries == 0 or num_tokens == 0:
+        return column_ids
+
+    encoded = [token.encode("utf-8") for token in tokens]
+    lengths = np.array([len(token) for token in encoded], dtype=np.int64)
+    width = max(1, int(lengths.max()))
+    query_bytes = np.zeros((num_queries, width), dtype=np.uint8)
+    for row, token in enumerate(encoded):
+        query_bytes[row, : len(token)] = np.frombuffer(token, dtype=np.uint8)
+
+    def compare(queries, positions):
+        starts = offsets[positions]
+        token_lengths = offsets[positions + 1] - starts
+        cols = np.arange(width)
+        gather = np.minimum(starts[:, None] + cols, len(buffer) - 1)
+        token_bytes = np.where(cols < token_lengths[:, None], buffer[gather], 0).astype(np.uint8)
+        differs = queries != token_bytes
+        first = differs.argmax(axis=1)
+        rows = np.arange(len(positions))
+        result = np.sign(
+            queries[rows, first].astype(np.int16) - token_bytes[rows, first].astype(np.int16)
+        )
+        result[~differs.any(axis=1) & (token_lengths > width)] = -1
+        return result
+
+    lo = np.zeros(num_queries, dtype=np.int64)
+    hi = np.full(num_queries, num_tokens, dtype=np.int64)
+    while (lo < hi).any():
+        active = lo < hi
+        mid = (lo + hi) // 2
+        greater = compare(query_bytes, np.minimum(mid, num_tokens - 1)) > 0
+        lo = np.where(active & greater, mid + 1, lo)
+        hi = np.where(active & ~greater, mid, hi)
+
+    found = lo < num_tokens
+    found[found] = compare(query_bytes[found], lo[found]) == 0
+    positions = lo[found]
+    column_ids[found] = vocab["indices"][positions] if "indices" in vocab else positions
+    return column_ids
+
+
+def score_postings(token_indices):
+    """Accumulate impacts over the posting lists of the query tokens.
+
+    Returns the sorted ids of the topics with a posting in the query and their
+    scores (sum of impacts divided by the number of known query tokens).
+    """
+    postings = global_objects["postings"]
+    norm = max(1, len(token_indices))
+    term_ids, counts = np.unique(np.array(token_indices, dtype=np.int64), return_counts=True)
+    topic_ids = []
+    contributions = []
+    for term_id, count in zip(term_ids, counts):
+        start, stop = postings.indptr[term_id], postings.indptr[term_id + 1]
+        topic_ids.append(postings.indices[start:stop])
+        contributions.append(postings.data[start:stop] * (count / norm))
+    if not topic_ids:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    topic_ids, slots = np.unique(np.concatenate(topic_ids), return_inverse=True)
+    scores = np.bincount(slots, weights=np.concatenate(contributions), minlength=len(topic_ids))
+    return topic_ids, scores
+
+
+def topn_sparse(ids, scores, topn, thresh):
+    """Return (ids, scores) of the `topn` largest scores above `thresh`.
+
+    Uses a partial selection over the surviving scores and breaks ties by
+    ascending id (same as wikiwhatsthis.topk.topn_sparse).
+    """
+    keep = scores > thresh
+    ids, scores = ids[keep], scores[keep]
+    if len(scores) > topn:
+        kth = np.partition(scores, len(scores) - topn)[len(scores) - topn]
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)
+        ties = ties[np.argsort(ids[ties], kind="stable")][: topn - len(above)]
+        survivors = np.concatenate([above, ties])
+        ids, scores = ids[survivors], scores[survivors]
+    order = np.lexsort((ids, -scores))
+    return ids[order], scores[order]
+
+
+def stem_cache_stats():
+    return global_objects["stemmer"].stats()
 
 
 def search(text):
@@ -127,22 +285,15 @@ def search(text):
     tokens = global_objects["analyzer"](stemmed_text)
     # print("tokens: ", tokens)
 
-    token_indices = [
-        global_objects["cv"].vocabulary_[token]
-        for token in tokens
-        if token in global_objects["cv"].vocabulary_
-    ]
+    token_indices = lookup_tokens(tokens)
+    token_indices = token_indices[token_indices >= 0]
     # print("token_indices: ", token_indices)
 
-    norm = max(1, len(token_indices))
-    topic_vector = np.array(global_objects["xbm25"][:, token_indices].sum(axis=1)).squeeze() / norm
-    # print("topic_vector: ", topic_vector)
+    topic_ids, topic_scores = score_postings(token_indices)
 
-    topic_indxs = np.argsort(-topic_vector)[:topn]
-    top_topics_df = global_objects["df_articles"].iloc[topic_indxs].copy()
-    topic_scores = topic_vector[topic_indxs]
+    topic_ids, topic_scores = topn_sparse(topic_ids, topic_scores, topn, thresh)
+    top_topics_df = global_objects["df_articles"].iloc[topic_ids].copy()
     top_topics_df["score"] = topic_scores
-    top_topics_df = top_topics_df[top_topics_df["score"] > thresh]
     # print("top_topics_df ... ")
     # for indx, row in top_topics_df.iterrows():
     #     print(row)
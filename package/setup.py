@@ -45,7 +45,7 @@ setup(
     author_email="kwnlp@kensho.com",
     license="Apache 2.0",
     packages=find_packages(exclude=["tests*"]),
-    package_data={"": []},
+    package_data={"": ["sample_masks.json"]},
     install_requires=[
         "nltk",
         "pandas",
@@ -54,7 +54,13 @@ setup(
     extras_require={
         "dev": [
             "pre-commit",
-        ]
+        ],
+        "fast": [
+            "orjson",
+        ],
+        "zstd": [
+            "zstandard",
+        ],
     },
     classifiers=[
         "Development Status :: 4 - Beta",
@@ -62,10 +68,9 @@ setup(
         "License :: OSI Approved :: Apache Software License",
         "Programming Language :: Python :: 3 :: Only",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
     ],
     keywords="wikipedia wikidata wikimedia open data",
-    python_requires=">=3.6",
+    python_requires=">=3.7",
 )
@@ -3,7 +3,7 @@ import argparse
 import logging
 import multiprocessing
 import sys
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 
 DEFAULT_KWNLP_DATA_PATH: str = ""
@@ -17,6 +17,20 @@ DEFAULT_KWNLP_MAX_ENTITIES: int = sys.maxsize
 DEFAULT_KWNLP_WORKERS = multiprocessing.cpu_count() - 1
 
 
+def list_from_comma_delimited_string(comma_delimited_string: str) -> List[str]:
+    return [el.strip() for el in comma_delimited_string.strip().split(",")]
+
+
+def prunings_from_comma_delimited_string(comma_delimited_string: str) -> List[Tuple[str, float]]:
+    prunings = []
+    for el in list_from_comma_delimited_string(comma_delimited_string):
+        policy, sep, value = el.partition("=")
+        if not sep:
+            raise argparse.ArgumentTypeError(f"expected policy=value, got {el}")
+        prunings.append((policy.strip(), float(value)))
+    return prunings
+
+
 ap_wp_yyyymmdd = argparse.ArgumentParser(add_help=False)
 ap_wp_yyyymmdd.add_argument("wp_yyyymmdd", help="date string for Wikipedia dump (e.g. 20200920)")
 
@@ -75,6 +89,72 @@ ap_loglevel.add_argument(
     type=int,
 )
 
+ap_force = argparse.ArgumentParser(add_help=False)
+ap_force.add_argument(
+    "--force",
+    action="store_true",
+    help="recompute all outputs, even those with a fresh stage manifest entry",
+)
+
+ap_fingerprints = argparse.ArgumentParser(add_help=False)
+ap_fingerprints.add_argument(
+    "--fingerprints",
+    default="content",
+    choices=["content", "mtime"],
+    help=(
+        "compare stage manifest files by size and sha256 (content) or by size and"
+        " modification time (mtime)"
+    ),
+)
+
+ap_compression = argparse.ArgumentParser(add_help=False)
+ap_compression.add_argument(
+    "--compression",
+    default="",
+    choices=["", "gz", "zst"],
+    help="compression of the files written by the pipeline (empty for none)",
+)
+
+ap_no_line_offsets = argparse.ArgumentParser(add_help=False)
+ap_no_line_offsets.add_argument(
+    "--no_line_offsets",
+    action="store_true",
+    help="write no line offsets next to the collected jsonl files (saves a read of copied chunks)",
+)
+
+ap_per_corpus_counts = argparse.ArgumentParser(add_help=False)
+ap_per_corpus_counts.add_argument(
+    "--per_corpus_counts",
+    action="store_true",
+    help="tokenize every corpus on its own instead of taking its rows from the base counts",
+)
+
+ap_token_store = argparse.ArgumentParser(add_help=False)
+ap_token_store.add_argument(
+    "--token_store",
+    action="store_true",
+    help="write (task_01) or count from (task_15) the pre-tokenized stems of the chunk files",
+)
+
+ap_quantizations = argparse.ArgumentParser(add_help=False)
+ap_quantizations.add_argument(
+    "--quantizations",
+    default=[],
+    type=list_from_comma_delimited_string,
+    help="comma separated quantizations of extra task_15 bundles (e.g. float32,uint8_log)",
+)
+
+ap_prunings = argparse.ArgumentParser(add_help=False)
+ap_prunings.add_argument(
+    "--prunings",
+    default=[],
+    type=prunings_from_comma_delimited_string,
+    help=(
+        "comma separated policy=value prunings of extra task_15 bundles, a budget is a number"
+        " of postings (e.g. top_n=1000,percentile=50,budget=5000000)"
+    ),
+)
+
 
 ARGS: Dict[str, argparse.ArgumentParser] = {
     "wp_yyyymmdd": ap_wp_yyyymmdd,
@@ -86,13 +166,17 @@ ARGS: Dict[str, argparse.ArgumentParser] = {
     "max_entities": ap_max_entities,
     "workers": ap_workers,
     "loglevel": ap_loglevel,
+    "force": ap_force,
+    "fingerprints": ap_fingerprints,
+    "compression": ap_compression,
+    "no_line_offsets": ap_no_line_offsets,
+    "per_corpus_counts": ap_per_corpus_counts,
+    "token_store": ap_token_store,
+    "quantizations": ap_quantizations,
+    "prunings": ap_prunings,
 }
 
 
-def list_from_comma_delimited_string(comma_delimited_string: str) -> List[str]:
-    return [el.strip() for el in comma_delimited_string.strip().split(",")]
-
-
 def get_argparser(description: str, arg_names: List[str]) -> argparse.ArgumentParser:
     parents = [ARGS[arg_name] for arg_name in arg_names]
     parser = argparse.ArgumentParser(description=description, parents=parents)
@@ -0,0 +1,314 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""Count vectorizers of page samples derived from the raw counts of all base pages.
+
+Every sample is a subset of the base pages, and a page is tokenized the same
+way whatever sample it is in. So the base pages are counted once, without any
+vocabulary limits, and each sample selects its rows from the base counts.
+`fit_subset` then applies `min_df`, `max_df` and `max_features` to the
+columns of those rows the way `CountVectorizer.fit_transform` does, so the
+vocabulary, stop words and counts match a vectorizer fit on the sample's own
+text.
+
+The text of a scope (intro, page, ...) is a selection of the paragraphs of a
+page, and the word unigram counts of joined paragraphs are the sums of their
+counts. So `fit_paragraph_counts` counts every paragraph once, keeping its
+page and section, and `scope_counts` sums the paragraphs of any scope into
+page counts with a sparse matrix product.
+"""
+from collections import Counter
+import numbers
+import re
+from typing import Dict, Iterable, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+import scipy.sparse
+from sklearn.feature_extraction.text import CountVectorizer
+
+
+# arguments that limit the vocabulary and are applied per sample
+LIMIT_ARGS = ("min_df", "max_df", "max_features")
+# the first `num_sections` sections of a page (section 0 is the intro)
+SECTIONS_SCOPE_PATTERN = re.compile(r"^sections(?P<num_sections>[1-9]\d*)$")
+SCOPES = ("paragraph", "intro", "page", "sections<N>")
+
+
+class ParagraphCounts(NamedTuple):
+    """Raw counts of every paragraph with the page and section it belongs to.
+
+    The paragraphs of page i are rows page_offsets[i] to page_offsets[i + 1].
+    """
+
+    feature_names: np.ndarray
+    xparagraph: scipy.sparse.csr_matrix
+    page_offsets: np.ndarray
+    section_idx: np.ndarray
+
+
+def fit_base_counts(
+    cv_args: Dict, texts: Iterable[str]
+) -> Tuple[np.ndarray, scipy.sparse.csr_matrix]:
+    """Return the sorted feature names and raw counts of `texts` with no vocabulary limits.
+
+    The counts are those of `CountVectorizer.fit_transform`, except that an
+    empty vocabulary is no error (a shard may hold only empty pages).
+    """
+    cv = CountVectorizer(
+        **{name: value for name, value in cv_args.items() if name not in LIMIT_ARGS}
+    )
+    analyze = cv.build_analyzer()
+    vocabulary: Dict[str, int] = {}
+    indices: List[int] = []
+    values: List[int] = []
+    indptr = [0]
+    for text in texts:
+        term_counts = Counter(
+            vocabulary.setdefault(term, len(vocabulary)) for term in analyze(text)
+        )
+        indices.extend(term_counts.keys())
+        values.extend(term_counts.values())
+        indptr.append(len(indices))
+
+    # columns sorted by term, like CountVectorizer
+    feature_names = np.array(list(vocabulary), dtype=object)
+    order = np.argsort(feature_names)
+    columns = np.empty(len(order), dtype=np.int32)
+    columns[order] = np.arange(len(order), dtype=np.int32)
+    xbase = scipy.sparse.csr_matrix(
+        (
+            np.array(values, dtype=cv.dtype),
+            columns[np.array(indices, dtype=np.int64)],
+            np.array(indptr, dtype=np.int64),
+        ),
+        shape=(len(indptr) - 1, len(vocabulary)),
+    )
+    xbase.sort_indices()
+    if cv.binary:
+        xbase.data.fill(1)
+    return feature_names[order], xbase
+
+
+def merge_counts(
+    shards: Sequence[Tuple[np.ndarray, scipy.sparse.csr_matrix]],
+) -> Tuple[np.ndarray, scipy.sparse.csr_matrix]:
+    """Stack the rows of `fit_base_counts` shards on the union of their vocabularies."""
+    if not shards:
+        raise ValueError("shards must not be empty")
+    feature_names = np.unique(np.concatenate([names for names, _ in shards]))
+    remapped = []
+    for names, xshard in shards:
+        # both vocabularies are sorted, so the columns of a row stay sorted
+        columns = np.searchsorted(feature_names, names).astype(xshard.indices.dtype)
+        remapped.append(
+            scipy.sparse.csr_matrix(
+                (xshard.data, columns[xshard.indices], xshard.indptr),
+                shape=(xshard.shape[0], len(feature_names)),
+            )
+        )
+    xbase = scipy.sparse.vstack(remapped, format="csr")
+    xbase.sort_indices()
+    return feature_names, xbase
+
+
+def merge_paragraph_counts(shards: Sequence[ParagraphCounts]) -> ParagraphCounts:
+    """Concatenate the pages of `shards` (see `merge_counts`)."""
+    feature_names, xparagraph = merge_counts(
+        [(shard.feature_names, shard.xparagraph) for shard in shards]
+    )
+    page_offsets = [np.zeros(1, dtype=np.int64)]
+    for shard in shards:
+        page_offsets.append(shard.page_offsets[1:] + page_offsets[-1][-1])
+    return ParagraphCounts(
+        feature_names,
+        xparagraph,
+        np.concatenate(page_offsets),
+        np.concatenate([shard.section_idx for shard in shards]),
+    )
+
+
+def gather_ranges(offsets: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the items of ranges `rows` of `offsets` and the offsets of the gathered ranges.
+
+    Range i holds items offsets[i] to offsets[i + 1].
+    """
+    lengths = np.diff(offsets)[rows]
+    new_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    # item j of gathered range k is offsets[rows[k]] + j
+    items = np.arange(new_offsets[-1], dtype=np.int64) + np.repeat(
+        offsets[:-1][rows] - new_offsets[:-1], lengths
+    )
+    return items, new_offsets
+
+
+def select_pages(paragraph_counts: ParagraphCounts, rows: np.ndarray) -> ParagraphCounts:
+    """Return the paragraph counts of pages `rows`, in that order."""
+    paragraphs, page_offsets = gather_ranges(paragraph_counts.page_offsets, rows)
+    return ParagraphCounts(
+        paragraph_counts.feature_names,
+        paragraph_counts.xparagraph[paragraphs],
+        page_offsets,
+        paragraph_counts.section_idx[paragraphs],
+    )
+
+
+def scope_text(page: Dict, scope: str) -> str:
+    """Return the text of `page` in `scope` (see `scope_paragraph_mask`)."""
+    paragraphs = page["paragraphs"]
+    sections_match = SECTIONS_SCOPE_PATTERN.match(scope)
+    if scope == "paragraph":
+        paragraphs = paragraphs[:1]
+    elif scope == "intro":
+        paragraphs = [para for para in paragraphs if para["section_idx"] == 0]
+    elif sections_match is not None:
+        num_sections = int(sections_match.group("num_sections"))
+        paragraphs = [para for para in paragraphs if para["section_idx"] < num_sections]
+    elif scope != "page":
+        raise ValueError(f"scope must be one of {list(SCOPES)}")
+    return " ".join([para["plaintext_snowball"] for para in paragraphs])
+
+
+def sums_paragraph_counts(cv_args: Dict) -> bool:
+    """Return True if page counts with `cv_args` are the sums of their paragraph counts.
+
+    Word ngrams longer than one can span two paragraphs, so only word unigrams
+    qualify, and binary counts do not add up.
+    """
+    analyzer = cv_args.get("analyzer", "word")
+    return (
+        analyzer == "word"
+        and tuple(cv_args.get("ngram_range", (1, 1))) == (1, 1)
+        and not cv_args.get("binary", False)
+    )
+
+
+def fit_paragraph_counts(cv_args: Dict, pages: Iterable[Dict]) -> ParagraphCounts:
+    """Count the `plaintext_snowball` of every paragraph of `pages` with no vocabulary limits."""
+    if not sums_paragraph_counts(cv_args):
+        raise ValueError("paragraph counts add up to page counts only for word unigrams")
+    page_offsets = [0]
+    section_idx = []
+
+    def iter_paragraphs() -> Iterable[str]:
+        for page in pages:
+            for para in page["paragraphs"]:
+                section_idx.append(para["section_idx"])
+                yield para["plaintext_snowball"]
+            page_offsets.append(len(section_idx))
+
+    feature_names, xparagraph = fit_base_counts(cv_args, iter_paragraphs())
+    return ParagraphCounts(
+        feature_names,
+        xparagraph,
+        np.array(page_offsets, dtype=np.int64),
+        np.array(section_idx, dtype=np.int64),
+    )
+
+
+def scope_paragraph_mask(
+    scope: str, page_offsets: np.ndarray, section_idx: np.ndarray
+) -> np.ndarray:
+    """Return a mask of the paragraphs that make up the text of each page in `scope`.
+
+    "paragraph" is the first paragraph of a page, "intro" its section 0, "page"
+    all of it and "sections<N>" its first N sections.
+    """
+    if scope == "paragraph":
+        mask = np.zeros(len(section_idx), dtype=bool)
+        mask[page_offsets[:-1][np.diff(page_offsets) > 0]] = True
+        return mask
+    if scope == "intro":
+        return section_idx == 0
+    if scope == "page":
+        return np.ones(len(section_idx), dtype=bool)
+    match = SECTIONS_SCOPE_PATTERN.match(scope)
+    if match is not None:
+        return section_idx < int(match.group("num_sections"))
+    raise ValueError(f"scope must be one of {list(SCOPES)}")
+
+
+def scope_counts(
+    paragraph_counts: ParagraphCounts, scope: str
+) -> Tuple[np.ndarray, scipy.sparse.csr_matrix]:
+    """Return the feature names and raw counts of every page in `scope`.
+
+    The counts are the same as `fit_base_counts` of the scope's text, except
+    that terms absent from the scope keep their (empty) column.
+    """
+    _, xparagraph, page_offsets, section_idx = paragraph_counts
+    mask = scope_paragraph_mask(scope, page_offsets, section_idx)
+    num_pages = len(page_offsets) - 1
+    page_of_paragraph = np.repeat(np.arange(num_pages), np.diff(page_offsets))
+    (paragraphs,) = np.nonzero(mask)
+    aggregate = scipy.sparse.csr_matrix(
+        (np.ones(len(paragraphs), dtype=xparagraph.dtype), (page_of_paragraph[mask], paragraphs)),
+        shape=(num_pages, xparagraph.shape[0]),
+    )
+    xscope = scipy.sparse.csr_matrix(aggregate @ xparagraph)
+    xscope.sort_indices()
+    return paragraph_counts.feature_names, xscope
+
+
+def subset_rows(base_page_ids: np.ndarray, page_ids: np.ndarray) -> np.ndarray:
+    """Return the row of each of `page_ids` in `base_page_ids`."""
+    base_page_ids = np.asarray(base_page_ids)
+    if not len(base_page_ids):
+        if len(page_ids):
+            raise ValueError("page_ids must all be base pages")
+        return np.zeros(0, dtype=np.int64)
+    order = np.argsort(base_page_ids, kind="stable")
+    positions = np.searchsorted(base_page_ids, page_ids, sorter=order)
+    rows = order[np.minimum(positions, len(order) - 1)]
+    if np.any(base_page_ids[rows] != page_ids):
+        raise ValueError("page_ids must all be base pages")
+    return rows
+
+
+def fit_subset(
+    cv_args: Dict,
+    feature_names: np.ndarray,
+    xbase: scipy.sparse.csr_matrix,
+    rows: np.ndarray,
+) -> Tuple[CountVectorizer, scipy.sparse.csr_matrix]:
+    """Return a count vectorizer and counts for the base pages in `rows`.
+
+    Parameters
+    ----------
+    cv_args : dict
+        Arguments of the `CountVectorizer` fit on the subset's own text.
+    feature_names, xbase : np.ndarray, csr_matrix
+        Output of `fit_base_counts` with the same `cv_args`.
+    rows : np.ndarray
+        Rows of `xbase` in the order of the subset.
+    """
+    cv = CountVectorizer(**cv_args)
+    xcv = xbase[rows]
+    # a vectorizer fit on the subset only knows terms that occur in it
+    dfs = np.bincount(xcv.indices, minlength=xcv.shape[1])
+    present = np.flatnonzero(dfs)
+    xcv = xcv[:, present]
+    dfs = dfs[present]
+    names = feature_names[present]
+
+    n_doc = xcv.shape[0]
+    max_df, min_df = cv.max_df, cv.min_df
+    max_doc_count = max_df if isinstance(max_df, numbers.Integral) else max_df * n_doc
+    min_doc_count = min_df if isinstance(min_df, numbers.Integral) else min_df * n_doc
+    if max_doc_count < min_doc_count:
+        raise ValueError("max_df corresponds to < documents than min_df")
+
+    mask = (dfs <= max_doc_count) & (dfs >= min_doc_count)
+    if cv.max_features is not None and mask.sum() > cv.max_features:
+        tfs = np.asarray(xcv.sum(axis=0)).ravel()
+        # same (unstable) argsort as CountVectorizer so ties are broken the same way
+        mask_inds = (-tfs[mask]).argsort()[: cv.max_features]
+        new_mask = np.zeros(len(dfs), dtype=bool)
+        new_mask[np.where(mask)[0][mask_inds]] = True
+        mask = new_mask
+    kept = np.flatnonzero(mask)
+    if len(kept) == 0:
+        raise ValueError("After pruning, no terms remain. Try a lower min_df or a higher max_df.")
+
+    cv.vocabulary_ = {term: index for index, term in enumerate(names[kept])}
+    cv.stop_words_ = set(names[~mask])
+    cv.fixed_vocabulary_ = False
+    return cv, xcv[:, kept]
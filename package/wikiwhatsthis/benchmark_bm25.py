@@ -0,0 +1,98 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""Micro-benchmark of `BM25Transformer.transform` on a synthetic count matrix.
+
+The default shape is about that of the base corpus intro counts, use
+smaller values for a quick run, e.g.
+
+    python benchmark_bm25.py --num_rows 200000 --num_cols 100000
+
+Every variant reports its time and the peak of memory allocated through
+numpy (tracemalloc) on top of the input matrix.
+"""
+import argparse
+import time
+import tracemalloc
+from typing import Callable, Tuple
+
+import numpy as np
+import scipy.sparse
+
+from bm25_transformer import BM25Transformer
+
+
+def synthetic_counts(
+    num_rows: int, num_cols: int, nnz_per_row: float, seed: int = 0
+) -> scipy.sparse.csr_matrix:
+    """Return a float64 count matrix with Poisson row lengths and geometric counts."""
+    rng = np.random.default_rng(seed)
+    indptr = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(rng.poisson(nnz_per_row, num_rows), out=indptr[1:])
+    nnz = int(indptr[-1])
+    indices = rng.integers(0, num_cols, nnz, dtype=np.int32)
+    data = rng.geometric(0.5, nnz).astype(np.float64)
+    return scipy.sparse.csr_matrix((data, indices, indptr), shape=(num_rows, num_cols))
+
+
+def reference_transform(
+    bm25: BM25Transformer, X: scipy.sparse.csr_matrix
+) -> scipy.sparse.csr_matrix:
+    """Return bm25 values the way `transform` computed them before it worked in place."""
+    X = scipy.sparse.csr_matrix(X, dtype=np.float64, copy=True)
+    n_samples, n_features = X.shape
+    dl = X.sum(axis=1)
+    sz = X.indptr[1:] - X.indptr[:-1]
+    rep = np.repeat(np.asarray(dl), sz)
+    avgdl = np.mean(dl)
+    data = X.data * (bm25.k1 + 1) / (X.data + bm25.k1 * (1 - bm25.b + bm25.b * rep / avgdl))
+    X = scipy.sparse.csr_matrix((data, X.indices, X.indptr), shape=X.shape, dtype=np.float64)
+    idf_diag = scipy.sparse.diags(
+        bm25.idf_, offsets=0, shape=(n_features, n_features), format="csr", dtype=np.float64
+    )
+    return X * idf_diag
+
+
+def measure(
+    transform: Callable[[], scipy.sparse.csr_matrix],
+) -> Tuple[float, int, scipy.sparse.csr_matrix]:
+    """Return the seconds and peak bytes allocated by `transform` and its result."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = transform()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak, result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="benchmark BM25Transformer.transform")
+    parser.add_argument("--num_rows", type=int, default=6_000_000, help="number of documents")
+    parser.add_argument("--num_cols", type=int, default=500_000, help="number of terms")
+    parser.add_argument("--nnz_per_row", type=float, default=50.0, help="mean terms per document")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    xcounts = synthetic_counts(args.num_rows, args.num_cols, args.nnz_per_row, args.seed)
+    xcounts32 = xcounts.astype(np.float32)
+    print(
+        f"counts shape={xcounts.shape} nnz={xcounts.nnz} data={xcounts.data.nbytes / 2 ** 20:.0f}MiB"
+    )
+    bm25 = BM25Transformer().fit(xcounts)
+    bm25_32 = BM25Transformer(dtype=np.float32).fit(xcounts)
+
+    seconds, peak, expected = measure(lambda: reference_transform(bm25, xcounts))
+    print(f"{'reference':>18} {seconds:8.3f}s peak={peak / 2 ** 20:8.0f}MiB")
+    variants = [
+        ("float64 copy", bm25, xcounts, True),
+        ("float64 in place", bm25, xcounts, False),
+        ("float32 copy", bm25_32, xcounts32, True),
+        ("float32 in place", bm25_32, xcounts32, False),
+    ]
+    for name, transformer, xinput, copy in variants:
+        # the input of an in-place transform is copied before measuring
+        xinput = xinput if copy else xinput.copy()
+        seconds, peak, result = measure(lambda: transformer.transform(xinput, copy=copy))
+        error = abs(result - expected).max()
+        print(f"{name:>18} {seconds:8.3f}s peak={peak / 2 ** 20:8.0f}MiB max_error={error:.3g}")
+        del xinput, result
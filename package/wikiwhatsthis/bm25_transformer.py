@@ -9,25 +9,85 @@ Background
  * https://www.elastic.co/blog/practical-bm25-part-2-the-bm25-algorithm-and-its-variables
  * https://en.wikipedia.org/wiki/Okapi_BM25
 """
-from typing import Any
+from typing import Any, Iterator, Optional
 
 import numpy as np
 import scipy.sparse
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.utils.validation import check_is_fitted, check_array, FLOAT_DTYPES
-from sklearn.utils.fixes import _astype_copy_false
 from sklearn.feature_extraction.text import _document_frequency
 
 
+# rows per block of `BM25Transformer.transform` and `transform_to_file`
+BLOCK_ROWS = 2 ** 16
+
+
+def iter_row_blocks(
+    X: scipy.sparse.csr_matrix, block_rows: int = BLOCK_ROWS
+) -> Iterator[scipy.sparse.csr_matrix]:
+    """Yield consecutive blocks of `block_rows` rows of `X` as views on its arrays."""
+    if block_rows < 1:
+        raise ValueError(f"block_rows={block_rows} must be positive")
+    n_samples, n_features = X.shape
+    for start in range(0, n_samples, block_rows):
+        stop = min(start + block_rows, n_samples)
+        lo, hi = X.indptr[start], X.indptr[stop]
+        yield scipy.sparse.csr_matrix(
+            (X.data[lo:hi], X.indices[lo:hi], X.indptr[start : stop + 1] - lo),
+            shape=(stop - start, n_features),
+            copy=False,
+        )
+
+
+def row_sums(data: np.ndarray, indptr: np.ndarray, block_rows: int = BLOCK_ROWS) -> np.ndarray:
+    """Return the float64 sum of every row of the csr arrays `data` and `indptr`.
+
+    `data` must hold exactly the values of the rows, from indptr[0] to
+    indptr[-1]. Rows are summed a block at a time, so a float32 `data` is
+    never cast to float64 as a whole.
+    """
+    sums = np.zeros(len(indptr) - 1, dtype=np.float64)
+    for start in range(0, len(sums), block_rows):
+        stop = min(start + block_rows, len(sums))
+        starts, ends = indptr[start:stop], indptr[start + 1 : stop + 1]
+        # an empty row would get the next value, so they are left out
+        (nonempty,) = np.nonzero(starts < ends)
+        if len(nonempty):
+            block = data[indptr[start] - indptr[0] : indptr[stop] - indptr[0]]
+            sums[start + nonempty] = np.add.reduceat(
+                block, starts[nonempty] - indptr[start], dtype=np.float64
+            )
+    return sums
+
+
 class BM25Transformer(BaseEstimator, TransformerMixin):
-    def __init__(self, use_idf: bool = True, k1: float = 1.2, b: float = 0.75):
+    def __init__(
+        self, use_idf: bool = True, k1: float = 1.2, b: float = 0.75, dtype: Any = np.float64
+    ):
         self.use_idf = use_idf
         self.k1 = k1
         self.b = b
+        self.dtype = dtype
 
     def fit(self, X: scipy.sparse.csr_matrix, y: Any = None) -> "BM25Transformer":
         """Learn the idf vector (global term weights).
 
+        Parameters
+        ----------
+        X : sparse matrix of shape n_samples, n_features)
+            A matrix of term/token counts.
+        """
+        for name in ("n_samples_seen_", "df_", "total_dl_", "avgdl_", "idf_"):
+            if hasattr(self, name):
+                delattr(self, name)
+        return self.partial_fit(X)
+
+    def partial_fit(self, X: scipy.sparse.csr_matrix, y: Any = None) -> "BM25Transformer":
+        """Update the idf vector and mean document length with more documents.
+
+        Fitting the row blocks of a matrix one after the other (see
+        `iter_row_blocks`) gives the same model as fitting the whole matrix.
+
         Parameters
         ----------
         X : sparse matrix of shape n_samples, n_features)
@@ -38,69 +98,154 @@ class BM25Transformer(BaseEstimator, TransformerMixin):
             X = scipy.sparse.csr_matrix(X)
         dtype = X.dtype if X.dtype in FLOAT_DTYPES else np.float64
 
+        n_samples, n_features = X.shape
+        if not hasattr(self, "n_samples_seen_"):
+            self.n_samples_seen_ = 0
+            self.df_ = np.zeros(n_features, dtype=np.int64)
+            self.total_dl_ = 0.0
+        else:
+            self._check_n_features(n_features)
+        self.n_samples_seen_ += n_samples
+        self.df_ += _document_frequency(X)
+        self.total_dl_ += float(X.sum())
+        self.avgdl_ = self.total_dl_ / self.n_samples_seen_ if self.n_samples_seen_ else 0.0
+
         if self.use_idf:
-            n_samples, n_features = X.shape
-            df = _document_frequency(X)
-            df = df.astype(dtype, **_astype_copy_false(df))
+            n_samples = self.n_samples_seen_
+            df = self.df_.astype(dtype)
+            self.idf_ = np.log(1 + (n_samples - df + 0.5) / (df + 0.5))
+        return self
 
-            idf = np.log(1 + (n_samples - df + 0.5) / (df + 0.5))
-            self._idf_diag = scipy.sparse.diags(
-                idf, offsets=0, shape=(n_features, n_features), format="csr", dtype=dtype
+    def _check_n_features(self, n_features: int) -> None:
+        expected_n_features = len(self.df_)
+        if n_features != expected_n_features:
+            raise ValueError(
+                "Input has n_features=%d while the model"
+                " has been trained with n_features=%d" % (n_features, expected_n_features)
             )
-        return self
 
-    def transform(self, X: scipy.sparse.csr_matrix, copy: bool = True) -> scipy.sparse.csr_matrix:
+    def _idf(self, n_features: int) -> Optional[np.ndarray]:
+        """Return the idf vector in `dtype`, or None without idf."""
+        if not self.use_idf:
+            return None
+        check_is_fitted(self, attributes=["idf_"], msg="idf vector is not fitted")
+        self._check_n_features(n_features)
+        return self.idf_.astype(self.dtype, copy=False)
+
+    def _transform_rows(
+        self,
+        data: np.ndarray,
+        indices: np.ndarray,
+        indptr: np.ndarray,
+        avgdl: float,
+        idf: Optional[np.ndarray],
+        block_rows: int,
+    ) -> None:
+        """Turn the counts `data` of csr rows into bm25 in place, a block of rows at a time.
+
+        `indices` and `data` hold exactly the values of the rows, and the
+        rows start at data[0] (indptr[0] is subtracted).
+        """
+        n_samples = len(indptr) - 1
+        for start in range(0, n_samples, block_rows):
+            stop = min(start + block_rows, n_samples)
+            lo, hi = indptr[start] - indptr[0], indptr[stop] - indptr[0]
+            tf = data[lo:hi]
+            # Document length (number of terms) in each row
+            dl = row_sums(tf, indptr[start : stop + 1])
+            # the length normalization of every row, repeated for its nonzeros
+            row_norm = self.k1 * (1 - self.b + self.b * dl / avgdl)
+            norm = np.repeat(row_norm.astype(tf.dtype), np.diff(indptr[start : stop + 1]))
+            # Compute BM25 score only for non-zero elements
+            norm += tf
+            tf *= self.k1 + 1
+            tf /= norm
+            if idf is not None:
+                tf *= idf[indices[lo:hi]]
+
+    def transform(
+        self, X: scipy.sparse.csr_matrix, copy: bool = True, block_rows: int = BLOCK_ROWS
+    ) -> scipy.sparse.csr_matrix:
         """Transform a count matrix to a tf or bm25 representation.
 
+        The mean document length is that of `X`. The values are computed in
+        `dtype`, a block of rows at a time.
+
         Parameters
         ----------
         X : sparse matrix of (n_samples, n_features)
             a matrix of term/token counts
         copy : bool, default=True
             Whether to copy X and operate on the copy or perform in-place
-            operations.
+            operations. X is only transformed in place if it is a csr
+            matrix of `dtype`.
+        block_rows : int
+            number of rows transformed at a time
 
         Returns
         -------
         vectors : sparse matrix of shape (n_samples, n_features)
         """
-        X = check_array(X, accept_sparse="csr", dtype=FLOAT_DTYPES, copy=copy)
+        X = check_array(X, accept_sparse="csr", dtype=self.dtype, copy=copy)
         if not scipy.sparse.issparse(X):
-            X = scipy.sparse.csr_matrix(X, dtype=np.float64)
+            X = scipy.sparse.csr_matrix(X, dtype=self.dtype)
 
         n_samples, n_features = X.shape
-
-        # Document length (number of terms) in each row
-        # Shape is (n_samples, 1)
-        dl = X.sum(axis=1)
-        # Number of non-zero elements in each row
-        # Shape is (n_samples, )
-        sz = X.indptr[1:] - X.indptr[:-1]
-        # In each row, repeat `dl` for `sz` times
-        # Shape is (sum(sz), )
-        # Example
-        # -------
-        # dl = [4, 5, 6]
-        # sz = [1, 2, 3]
-        # rep = [4, 5, 5, 6, 6, 6]
-        rep = np.repeat(np.asarray(dl), sz)
+        idf = self._idf(n_features)
         # Mean document length
-        # Scalar value
-        avgdl = np.mean(dl)
-        # Compute BM25 score only for non-zero elements
-        data = X.data * (self.k1 + 1) / (X.data + self.k1 * (1 - self.b + self.b * rep / avgdl))
-        X = scipy.sparse.csr_matrix((data, X.indices, X.indptr), shape=X.shape, dtype=np.float64)
+        avgdl = float(np.mean(row_sums(X.data[: X.indptr[-1]], X.indptr)))
+        self._transform_rows(X.data, X.indices, X.indptr, avgdl, idf, block_rows)
+        return X
 
-        if self.use_idf:
-            check_is_fitted(self, attributes=["_idf_diag"], msg="idf vector is not fitted")
+    def transform_to_file(
+        self, X: scipy.sparse.csr_matrix, file_path: str, block_rows: int = BLOCK_ROWS
+    ) -> scipy.sparse.csr_matrix:
+        """Transform a count matrix to bm25 block by block into a file.
 
-            expected_n_features = self._idf_diag.shape[0]
-            if n_features != expected_n_features:
-                raise ValueError(
-                    "Input has n_features=%d while the model"
-                    " has been trained with n_features=%d" % (n_features, expected_n_features)
-                )
-            # *= doesn't work
-            X = X * self._idf_diag
+        Unlike `transform`, the mean document length is the fitted one, and
+        no temporary larger than a block of rows is made. The bm25 values
+        are written to `file_path` as a .npy array of X.nnz `dtype` values,
+        one for every nonzero of `X`.
 
-        return X
+        Parameters
+        ----------
+        X : sparse matrix of (n_samples, n_features)
+            a matrix of term/token counts
+        file_path : str
+            path of the .npy file of bm25 values
+        block_rows : int
+            number of rows transformed at a time
+
+        Returns
+        -------
+        vectors : sparse matrix of shape (n_samples, n_features)
+            a matrix on the memory-mapped values of `file_path` which shares
+            its indices with `X`
+        """
+        check_is_fitted(self, attributes=["avgdl_"], msg="BM25Transformer is not fitted")
+        X = check_array(X, accept_sparse="csr")
+        if not scipy.sparse.issparse(X):
+            X = scipy.sparse.csr_matrix(X)
+        # sorting the indices of the result later would scramble the indices of X
+        if not X.has_sorted_indices:
+            X = X.sorted_indices()
+
+        n_samples, n_features = X.shape
+        self._check_n_features(n_features)
+        idf = self._idf(n_features)
+
+        data = np.lib.format.open_memmap(file_path, mode="w+", dtype=self.dtype, shape=(X.nnz,))
+        for start in range(0, n_samples, block_rows):
+            stop = min(start + block_rows, n_samples)
+            lo, hi = X.indptr[start], X.indptr[stop]
+            data[lo:hi] = X.data[lo:hi]
+            self._transform_rows(
+                data[lo:hi],
+                X.indices[lo:hi],
+                X.indptr[start : stop + 1],
+                self.avgdl_,
+                idf,
+                block_rows,
+            )
+        data.flush()
+        return scipy.sparse.csr_matrix((data, X.indices, X.indptr), shape=X.shape, copy=False)
@@ -0,0 +1,152 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""Transparent gzip and zstd compression of the line-oriented pipeline files.
+
+The compression of a file is given by its last extension (`.gz` or `.zst`,
+anything else is read and written as is). Compressed files can be
+concatenated byte for byte, since both formats allow several members (frames)
+per file.
+
+`iter_lines` decompresses in a background thread, so decompression overlaps
+with parsing in the calling thread (zlib and zstandard release the GIL while
+they work). zstd needs the optional `zstandard` package.
+"""
+import gzip
+import io
+import os
+import queue
+import threading
+from typing import IO, Iterator, Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSIONS = ("gz", "zst")
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+READ_BLOCK_SIZE = 4 * 2 ** 20
+# decompressed blocks buffered between the reader thread and the parser
+QUEUE_BLOCKS = 4
+
+
+def compression_of(file_path: str) -> str:
+    """Return "gz", "zst" or "" for uncompressed files."""
+    extension = os.path.splitext(file_path)[1].lstrip(".")
+    return extension if extension in COMPRESSIONS else ""
+
+
+def strip_compression(file_path: str) -> str:
+    compression = compression_of(file_path)
+    return file_path[: -len(compression) - 1] if compression else file_path
+
+
+def with_compression(file_path: str, compression: str) -> str:
+    """Return `file_path` without its compression extension plus `compression`."""
+    if compression and compression not in COMPRESSIONS:
+        raise ValueError(f"compression must be one of {COMPRESSIONS} or empty")
+    file_path = strip_compression(file_path)
+    return f"{file_path}.{compression}" if compression else file_path
+
+
+def remove_other_compressions(file_path: str) -> None:
+    """Remove copies of `file_path` with another compression left by earlier runs."""
+    for compression in ("",) + COMPRESSIONS:
+        other_path = with_compression(file_path, compression)
+        if other_path != file_path and os.path.exists(other_path):
+            os.remove(other_path)
+
+
+def open_binary(file_path: str, mode: str = "rb") -> IO[bytes]:
+    """Open `file_path` for binary reading ("rb") or writing ("wb"), compressing by extension."""
+    if mode not in ("rb", "wb"):
+        raise ValueError("mode must be 'rb' or 'wb'")
+    compression = compression_of(file_path)
+    if compression == "gz":
+        return gzip.open(file_path, mode, compresslevel=GZIP_LEVEL)  # type: ignore
+    if compression == "zst":
+        if zstandard is None:
+            raise ValueError(f"the zstandard package is needed for {file_path}")
+        if mode == "rb":
+            return zstandard.open(file_path, mode)
+        return zstandard.open(file_path, mode, cctx=zstandard.ZstdCompressor(level=ZSTD_LEVEL))
+    return open(file_path, mode)
+
+
+def compressed_writer(fp: IO[bytes], compression: str) -> IO[bytes]:
+    """Return a writer that appends one compressed member (frame) to binary file `fp`.
+
+    Closing the writer ends the member but leaves `fp` open.
+    """
+    if compression == "gz":
+        return gzip.GzipFile(fileobj=fp, mode="wb", compresslevel=GZIP_LEVEL)  # type: ignore
+    if compression == "zst":
+        if zstandard is None:
+            raise ValueError("the zstandard package is needed for zst compression")
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(fp, closefd=False)
+    raise ValueError(f"compression must be one of {COMPRESSIONS}")
+
+
+def open_text(file_path: str, mode: str = "r") -> IO[str]:
+    """Open `file_path` for utf-8 text reading ("r") or writing ("w"), compressing by extension."""
+    if mode not in ("r", "w"):
+        raise ValueError("mode must be 'r' or 'w'")
+    if not compression_of(file_path):
+        return open(file_path, mode, encoding="utf-8")
+    return io.TextIOWrapper(open_binary(file_path, mode + "b"), encoding="utf-8")
+
+
+def iter_lines(file_path: str) -> Iterator[bytes]:
+    """Yield the lines of `file_path` (with their newline) as bytes.
+
+    Compressed files are decompressed by a reader thread.
+    """
+    if not compression_of(file_path):
+        with open(file_path, "rb") as fp:
+            yield from fp
+        return
+
+    blocks: "queue.Queue[Union[bytes, BaseException, None]]" = queue.Queue(QUEUE_BLOCKS)
+    stop = threading.Event()
+
+    def put(item: Union[bytes, BaseException, None]) -> bool:
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_blocks() -> None:
+        try:
+            with open_binary(file_path) as fp:
+                for block in iter(lambda: fp.read(READ_BLOCK_SIZE), b""):
+                    if not put(block):
+                        return
+        except BaseException as exc:
+            put(exc)
+            return
+        put(None)
+
+    reader = threading.Thread(target=read_blocks, name=f"decompress {file_path}", daemon=True)
+    reader.start()
+    tail = b""
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if isinstance(block, BaseException):
+                raise block
+            buffer = tail + block
+            end = buffer.rfind(b"\n") + 1
+            tail = buffer[end:]
+            # BytesIO splits on b"\n" only
+            yield from io.BytesIO(buffer[:end])
+        if tail:
+            yield tail
+    finally:
+        stop.set()
+        reader.join()
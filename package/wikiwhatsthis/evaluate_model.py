@@ -8,21 +8,20 @@ import scipy.sparse
 from sklearn.preprocessing import normalize
 
 from explicit_topic_model import ExplicitTopicModel
+from topk import topn_sparse
 from nltk.stem.snowball import SnowballStemmer
 
 
 def explain_row(xdocterm, row_indx, row_labels, col_labels):
-    row = xdocterm.getrow(row_indx).toarray().flatten()
-    num_finite_entries = (row > 0).sum()
-    col_indxs = np.argsort(-row)[:num_finite_entries]
-    return zip(col_indxs, col_labels[col_indxs], row[col_indxs])
+    row = xdocterm.getrow(row_indx)
+    col_indxs, values = topn_sparse(row.indices, row.data, row.nnz)
+    return zip(col_indxs, col_labels[col_indxs], values)
 
 
 def explain_col(xdocterm, col_indx, row_labels, col_labels):
-    col = xdocterm.getcol(col_indx).toarray().flatten()
-    num_finite_entries = (col > 0).sum()
-    row_indxs = np.argsort(-col)[:num_finite_entries]
-    return zip(row_indxs, row_labels[row_indxs], col[row_indxs])
+    col = scipy.sparse.csc_matrix(xdocterm.getcol(col_indx))
+    row_indxs, values = topn_sparse(col.indices, col.data, col.nnz)
+    return zip(row_indxs, row_labels[row_indxs], values)
 
 
 if __name__ == "__main__":
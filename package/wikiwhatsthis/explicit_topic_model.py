@@ -1,36 +1,96 @@
 # Copyright 2020-present Kensho Technologies, LLC.
+from itertools import chain
 import numpy as np
 import pandas as pd
 import scipy.sparse
-from typing import Iterable, List
+from typing import Iterable, List, NamedTuple, Optional, Tuple, Union
 import warnings
 
 from nltk.stem.snowball import SnowballStemmer
 from sklearn.feature_extraction.text import CountVectorizer
 
+from wikiwhatsthis.inverted_index import InvertedIndex
+from wikiwhatsthis.quantize import quantize_topic_term
+from wikiwhatsthis.stem_cache import CachedStemmer, cached_stemmer
+from wikiwhatsthis.topic_table import TopicTable
+from wikiwhatsthis.topk import topn_dense, topn_sparse
+from wikiwhatsthis.tunable_bm25 import BM25Params, TermFrequencyIndex, TunedIndex
+from wikiwhatsthis.vocabulary import Vocabulary
+
+
 warnings.filterwarnings(
     "ignore",
     category=UserWarning,
     message="Your stop_words may be inconsistent with your preprocessing.",
 )
 
+# "maxscore" skips postings that cannot reach the top-n and returns the same topics and scores
+RETRIEVAL_MODES = ("exhaustive", "maxscore")
+
+
+class TopnBatch(NamedTuple):
+    """Top topics for a batch of texts.
+
+    Row `i` of `topic_ids` and `scores` holds the results for text `i` in
+    descending score order. Only the first `counts[i]` entries of a row are
+    valid, the rest are padded with -1 (topic ids) and 0.0 (scores).
+    """
+
+    topic_ids: np.ndarray
+    scores: np.ndarray
+    counts: np.ndarray
+
 
 class ExplicitTopicModel:
     def __init__(
         self,
         cv: CountVectorizer,
         xdocterm: scipy.sparse.csr_matrix,
-        topic_df: pd.DataFrame,
-        stemmer: SnowballStemmer,
+        topic_df: Union[pd.DataFrame, TopicTable],
+        stemmer: Union[SnowballStemmer, CachedStemmer],
+        index: Optional[InvertedIndex] = None,
+        retrieval: str = "exhaustive",
+        warm_stem_cache: bool = False,
+        vocabulary: Optional[Vocabulary] = None,
+        quantization: str = "float64",
+        term_frequencies: Optional[TermFrequencyIndex] = None,
     ) -> None:
+        """Explicit topic model over a (n_topics, n_terms) matrix.
+
+        `cv` provides the analyzer. The vocabulary is built from the fitted
+        `cv` unless `vocabulary` is given, in which case `cv` can be unfitted.
+
+        Without an `index`, the index is built from `xdocterm` and both are
+        stored with `quantization` (see `quantize.QUANTIZATION_MODES`). With
+        an `index`, `xdocterm` must already be encoded with `index.codec`.
+
+        With `term_frequencies`, queries can pass `bm25_params` to score with
+        impacts computed for those parameters instead of `xdocterm` (see
+        `tunable_bm25`).
+        """
+        if retrieval not in RETRIEVAL_MODES:
+            raise ValueError(f"retrieval must be one of {RETRIEVAL_MODES}")
         self.cv = cv
-        self.xdocterm = xdocterm
         self.topic_df = topic_df
-        self.stemmer = stemmer
+        # several models can share one cache by passing the same CachedStemmer
+        self.stemmer = cached_stemmer(stemmer)
+        # term-major copy of xdocterm used for query scoring
+        if index is None:
+            index = InvertedIndex.from_topic_term(xdocterm, quantization=quantization)
+            if quantization != "float64":
+                xdocterm = quantize_topic_term(xdocterm, index.codec)
+        self.index = index
+        self.xdocterm = xdocterm
+        self.retrieval = retrieval
+        self.term_frequencies = term_frequencies
 
         self.analyzer = cv.build_analyzer()
-        self.indx2tok = np.array(cv.get_feature_names())
-        self.tok2indx = cv.vocabulary_
+        self.vocabulary = (
+            vocabulary if vocabulary is not None else Vocabulary.from_dict(cv.vocabulary_)
+        )
+        if warm_stem_cache:
+            # queries often contain tokens that are already in stemmed form
+            self.stemmer.warm(self.vocabulary.tokens())
 
         print(
             "creating explicit topic model (topics={}, tokens={})".format(
@@ -44,30 +104,140 @@ class ExplicitTopicModel:
     def _tokenize(self, text: str) -> List[str]:
         return self.analyzer(text)
 
-    def topn_topics_from_text(self, text: str, topn: int = 10, thresh: float = 0.0) -> pd.DataFrame:
+    def _scoring_index(self, bm25_params: Optional[BM25Params]) -> Union[InvertedIndex, TunedIndex]:
+        """Return the index that scores queries with `bm25_params` (the trained impacts if None)."""
+        if bm25_params is None:
+            return self.index
+        if self.term_frequencies is None:
+            raise ValueError("bm25_params need a model with term_frequencies")
+        return self.term_frequencies.index(bm25_params)
+
+    def topn_topics_from_text(
+        self,
+        text: str,
+        topn: int = 10,
+        thresh: float = 0.0,
+        bm25_params: Optional[BM25Params] = None,
+    ) -> pd.DataFrame:
         tokens = self._stem_and_tokenize(text)
-        topic_vector = self.topic_vec_from_tokens(tokens)
+        topic_vector = self.topic_vec_from_tokens(tokens, bm25_params=bm25_params)
         return self.topn_topics_from_topic_vec(topic_vector, topn=topn, thresh=thresh)
 
+    def topn_topics_from_texts(
+        self,
+        texts: Iterable[str],
+        topn: int = 10,
+        thresh: float = 0.0,
+        bm25_params: Optional[BM25Params] = None,
+    ) -> TopnBatch:
+        """Score many texts with one sparse product against the posting lists.
+
+        Only topics with a positive score are returned, so `thresh` must be
+        non-negative.
+        """
+        if thresh < 0:
+            raise ValueError("thresh must be non-negative for batched queries")
+        index = self._scoring_index(bm25_params)
+
+        token_lists = [self._tokenize(text) for text in texts]
+        # stem each distinct surface token once for the whole batch
+        stems = {token: self.stemmer.stem(token) for token in set(chain.from_iterable(token_lists))}
+        distinct_stems = list(set(stems.values()))
+        stem_indices = dict(zip(distinct_stems, self.vocabulary.lookup(distinct_stems)))
+
+        rows, cols, weights = [], [], []
+        for row, tokens in enumerate(token_lists):
+            token_indices = np.array(
+                [stem_indices[stems[token]] for token in tokens], dtype=np.int64
+            )
+            term_ids, term_weights = self._query_from_indices(token_indices[token_indices >= 0])
+            rows.append(np.full(len(term_ids), row))
+            cols.append(term_ids)
+            weights.append(term_weights)
+
+        n_texts = len(token_lists)
+        topic_ids = np.full((n_texts, topn), -1, dtype=np.int64)
+        scores = np.zeros((n_texts, topn))
+        counts = np.zeros(n_texts, dtype=np.int64)
+        if n_texts == 0:
+            return TopnBatch(topic_ids, scores, counts)
+
+        # restrict the product to the posting lists of terms that occur in the batch
+        query_terms, query_cols = np.unique(np.concatenate(cols), return_inverse=True)
+        xquery = scipy.sparse.csr_matrix(
+            (np.concatenate(weights), (np.concatenate(rows), query_cols)),
+            shape=(n_texts, len(query_terms)),
+        )
+        xscores = scipy.sparse.csr_matrix(xquery @ index.term_matrix(query_terms))
+
+        for row in range(n_texts):
+            start, stop = xscores.indptr[row], xscores.indptr[row + 1]
+            row_ids, row_scores = topn_sparse(
+                xscores.indices[start:stop], xscores.data[start:stop], topn, thresh=thresh
+            )
+            counts[row] = len(row_ids)
+            topic_ids[row, : len(row_ids)] = row_ids
+            scores[row, : len(row_ids)] = row_scores
+        return TopnBatch(topic_ids, scores, counts)
+
     def topn_topics_from_tokens(
-        self, tokens: Iterable[str], topn: int = 10, thresh: float = 0.0
+        self,
+        tokens: Iterable[str],
+        topn: int = 10,
+        thresh: float = 0.0,
+        bm25_params: Optional[BM25Params] = None,
     ) -> pd.DataFrame:
-        topic_vector = self.topic_vec_from_tokens(tokens)
-        return self.topn_topics_from_topic_vec(topic_vector, topn=topn, thresh=thresh)
+        if thresh < 0:
+            # topics without postings score 0.0 and can pass a negative threshold
+            topic_vector = self.topic_vec_from_tokens(tokens, bm25_params=bm25_params)
+            return self.topn_topics_from_topic_vec(topic_vector, topn=topn, thresh=thresh)
+        term_ids, weights = self.query_from_tokens(tokens)
+        topic_ids, topic_scores = self._scoring_index(bm25_params).topn(
+            term_ids, weights, topn=topn, thresh=thresh, pruning=self.retrieval == "maxscore"
+        )
+        top_topics_df = self.topic_df.iloc[topic_ids].copy()
+        top_topics_df["score"] = topic_scores
+        return top_topics_df
 
     def topn_topics_from_topic_vec(
         self, topic_vector: np.ndarray, topn: int = 10, thresh: float = 0.0
     ) -> pd.DataFrame:
-        topic_indxs = np.argsort(-topic_vector)[:topn]
+        topic_indxs = topn_dense(topic_vector, topn, thresh=thresh)
         top_topics_df = self.topic_df.iloc[topic_indxs].copy()
-        topic_scores = topic_vector[topic_indxs]
+        top_topics_df["score"] = topic_vector[topic_indxs]
+        return top_topics_df
+
+    def topn_topics_from_topic_scores(
+        self, topic_ids: np.ndarray, topic_scores: np.ndarray, topn: int = 10, thresh: float = 0.0
+    ) -> pd.DataFrame:
+        topic_ids, topic_scores = topn_sparse(topic_ids, topic_scores, topn, thresh=thresh)
+        top_topics_df = self.topic_df.iloc[topic_ids].copy()
         top_topics_df["score"] = topic_scores
-        return top_topics_df[top_topics_df["score"] > thresh].copy()
+        return top_topics_df
+
+    def query_from_tokens(self, tokens: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Return unique term ids and their weights (term count / number of known tokens)."""
+        token_indices = self.vocabulary.lookup(list(tokens))
+        return self._query_from_indices(token_indices[token_indices >= 0])
 
-    def topic_vec_from_tokens(self, tokens: Iterable[str]) -> np.ndarray:
-        token_indices = [self.tok2indx[token] for token in tokens if token in self.tok2indx]
+    def _query_from_indices(self, token_indices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
         norm = max(1, len(token_indices))
-        topic_vector = np.array(self.xdocterm[:, token_indices].sum(axis=1)).squeeze() / norm
+        term_ids, counts = np.unique(token_indices, return_counts=True)
+        return term_ids, counts / norm
+
+    def topic_scores_from_tokens(
+        self, tokens: Iterable[str], bm25_params: Optional[BM25Params] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (topic ids, scores) for the topics with a non-zero score."""
+        term_ids, weights = self.query_from_tokens(tokens)
+        return self._scoring_index(bm25_params).score(term_ids, weights)
+
+    def topic_vec_from_tokens(
+        self, tokens: Iterable[str], bm25_params: Optional[BM25Params] = None
+    ) -> np.ndarray:
+        topic_ids, topic_scores = self.topic_scores_from_tokens(tokens, bm25_params=bm25_params)
+        topic_vector = np.zeros(self.index.n_topics)
+        topic_vector[topic_ids] = topic_scores
         return topic_vector
 
     def explain_topic_for_text(self, text: str, topic_title: str) -> pd.DataFrame:
@@ -78,10 +248,23 @@ class ExplicitTopicModel:
         return explanation.sort_values("score", ascending=False)
 
     def topn_tokens_from_topic(self, topic_title: str, topn: int = 10) -> pd.DataFrame:
-        indx = self.topic_df.index[self.topic_df["page_title"] == topic_title][0]
-        token_vector = self.xdocterm.getrow(indx).toarray().squeeze()
-        token_indxs = np.argsort(-token_vector)[:topn]
+        """Return the `topn` best tokens of a topic, padded with zero-score tokens."""
+        if isinstance(self.topic_df, TopicTable):
+            indx = self.topic_df.positions("page_title", topic_title)[0]
+        else:
+            indx = self.topic_df.index[self.topic_df["page_title"] == topic_title][0]
+        # read the row arrays directly, xdocterm data may be quantized
+        start, stop = self.xdocterm.indptr[indx], self.xdocterm.indptr[indx + 1]
+        token_ids = self.xdocterm.indices[start:stop]
+        impacts = self.index.codec.decode(self.xdocterm.data[start:stop], token_ids)
+        token_indxs, token_scores = topn_sparse(token_ids, impacts, topn)
+        num_missing = min(topn, self.xdocterm.shape[1]) - len(token_indxs)
+        if num_missing > 0:
+            # like a dense sort of the row, fill up with zero-score tokens in id order
+            zero_indxs = np.setdiff1d(np.arange(len(token_indxs) + num_missing), token_indxs)
+            token_indxs = np.concatenate([token_indxs, zero_indxs])
+            token_scores = np.concatenate([token_scores, np.zeros(num_missing)])
         tokens = pd.DataFrame(
-            zip(self.indx2tok[token_indxs], token_vector[token_indxs]), columns=["token", "score"]
+            zip(self.vocabulary.tokens(token_indxs), token_scores), columns=["token", "score"]
         )
         return tokens
@@ -0,0 +1,341 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""Term-major inverted index for scoring explicit topic models.
+
+The topic-term matrices produced by `task_15_train_models` are stored row-major
+(one row per topic).  Scoring a query against them means slicing a few columns
+out of a matrix with millions of rows.  This module stores the same matrix
+term-major, so that each term owns a contiguous posting list of
+(topic id, impact) pairs and a query only touches the postings of its terms.
+
+For exact top-n retrieval the index also keeps the maximum impact of every
+term and of every block of `block_size` consecutive postings. `topn` uses
+them (MaxScore with block-max bounds) to skip postings and drop accumulators
+of topics that can no longer enter the top-n.
+
+Impacts can be stored quantized (see `quantize.ImpactCodec`). They are decoded
+per slice while scoring, so the float64 posting lists are never materialized.
+"""
+from typing import Optional, Tuple
+
+import numpy as np
+import scipy.sparse
+
+from wikiwhatsthis.quantize import ImpactCodec, quantize_postings
+from wikiwhatsthis.topk import topn_sparse
+
+DEFAULT_BLOCK_SIZE = 128
+
+# relative slack on upper bounds so that rounding never prunes a top-n topic
+BOUND_RTOL = 1e-9
+
+
+class InvertedIndex:
+    def __init__(
+        self,
+        postings: scipy.sparse.csr_matrix,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        codec: Optional[ImpactCodec] = None,
+    ) -> None:
+        """Wrap a term-major posting matrix.
+
+        Parameters
+        ----------
+        postings : sparse matrix of shape (n_terms, n_topics)
+            Row `t` holds the posting list of term `t`. Topic ids within a
+            posting list are sorted if they are not already.
+        block_size : int
+            Number of postings summarized by one block-max impact.
+        codec : ImpactCodec, optional
+            Decodes the data of quantized `postings`. Defaults to float64.
+        """
+        if not scipy.sparse.isspmatrix_csr(postings):
+            postings = scipy.sparse.csr_matrix(postings)
+        if not postings.has_sorted_indices:
+            postings.sort_indices()
+        self.postings = postings
+        self.codec = codec if codec is not None else ImpactCodec()
+        self.n_terms, self.n_topics = postings.shape
+        self.block_size = block_size
+        self._block_indptr: Optional[np.ndarray] = None
+        self._block_max: Optional[np.ndarray] = None
+        self._term_max: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_topic_term(
+        cls, xdocterm: scipy.sparse.spmatrix, quantization: str = "float64"
+    ) -> "InvertedIndex":
+        """Build an index from a (n_topics, n_terms) matrix."""
+        postings = scipy.sparse.csr_matrix(xdocterm.T)
+        if quantization == "float64":
+            return cls(postings)
+        postings, codec = quantize_postings(postings, quantization)
+        return cls(postings, codec=codec)
+
+    @classmethod
+    def load(cls, file_path: str) -> "InvertedIndex":
+        with np.load(file_path, allow_pickle=False) as loaded:
+            # assign the arrays directly, the constructor casts float16 data to float32
+            postings = scipy.sparse.csr_matrix(tuple(loaded["shape"]))
+            postings.data = loaded["data"]
+            postings.indptr = loaded["indptr"]
+            postings.indices = loaded["indices"]
+            postings.has_sorted_indices = True
+            scales = loaded["scales"] if "scales" in loaded.files else None
+            return cls(postings, codec=ImpactCodec(str(loaded["quantization"]), scales))
+
+    def save(self, file_path: str) -> None:
+        arrays = {
+            "indptr": self.postings.indptr,
+            "indices": self.postings.indices,
+            "data": self.postings.data,
+            "shape": np.array(self.postings.shape),
+            "quantization": np.array(self.codec.mode),
+        }
+        if self.codec.scales is not None:
+            arrays["scales"] = self.codec.scales
+        np.savez(file_path, **arrays)
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the posting arrays (and per-term scales) in bytes."""
+        nbytes = self.postings.data.nbytes + self.postings.indices.nbytes
+        nbytes += self.postings.indptr.nbytes
+        if self.codec.scales is not None:
+            nbytes += self.codec.scales.nbytes
+        return nbytes
+
+    def postings_for_term(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (topic ids, impacts) for a single term."""
+        start, stop = self.postings.indptr[term_id], self.postings.indptr[term_id + 1]
+        impacts = self.codec.decode(self.postings.data[start:stop], term_id)
+        return self.postings.indices[start:stop], impacts
+
+    def term_matrix(self, term_ids: np.ndarray) -> scipy.sparse.csr_matrix:
+        """Return the posting lists of `term_ids` as a (len(term_ids), n_topics) matrix."""
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        starts = self.postings.indptr[term_ids]
+        lengths = self.postings.indptr[term_ids + 1] - starts
+        positions = _concatenated_ranges(starts, lengths)
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        impacts = self.codec.decode(self.postings.data[positions], np.repeat(term_ids, lengths))
+        return scipy.sparse.csr_matrix(
+            (impacts, self.postings.indices[positions], indptr),
+            shape=(len(term_ids), self.n_topics),
+        )
+
+    @property
+    def term_max(self) -> np.ndarray:
+        """Maximum impact in the posting list of each term."""
+        self._build_bounds()
+        assert self._term_max is not None
+        return self._term_max
+
+    def _build_bounds(self) -> None:
+        if self._term_max is not None:
+            return
+        indptr = self.postings.indptr.astype(np.int64)
+        data = self.postings.data
+        if len(data) > 0 and data.min() < 0:
+            raise ValueError("dynamic pruning requires non-negative impacts")
+
+        lengths = np.diff(indptr)
+        n_blocks = (lengths + self.block_size - 1) // self.block_size
+        block_indptr = np.concatenate([[0], np.cumsum(n_blocks)])
+        block_term = np.repeat(np.arange(self.n_terms), n_blocks)
+        block_rank = np.arange(block_indptr[-1]) - block_indptr[block_term]
+        block_starts = indptr[block_term] + block_rank * self.block_size
+
+        # decoding is monotonic within a term, so the maximum code decodes to the maximum impact
+        block_max = np.zeros(len(block_starts), dtype=np.float64)
+        term_max = np.zeros(self.n_terms, dtype=np.float64)
+        if len(block_starts) > 0:
+            block_max[:] = self.codec.decode(np.maximum.reduceat(data, block_starts), block_term)
+            nonempty = n_blocks > 0
+            term_max[nonempty] = np.maximum.reduceat(block_max, block_indptr[:-1][nonempty])
+
+        self._block_indptr = block_indptr
+        self._block_max = block_max
+        self._term_max = term_max
+
+    def score(self, term_ids: np.ndarray, weights: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Accumulate weighted impacts over the posting lists of the query terms.
+
+        Parameters
+        ----------
+        term_ids : array of shape (n_query_terms,)
+            Unique term ids in the query.
+        weights : array of shape (n_query_terms,)
+            Weight of each query term.
+
+        Returns
+        -------
+        topic_ids : array
+            Sorted ids of the topics with at least one posting in the query.
+        scores : array
+            Accumulated score for each topic in `topic_ids`.
+        """
+        if len(term_ids) == 0:
+            return np.zeros(0, dtype=self.postings.indices.dtype), np.zeros(0, dtype=np.float64)
+
+        indptr = self.postings.indptr
+        starts = indptr[term_ids]
+        lengths = indptr[np.asarray(term_ids) + 1] - starts
+        positions = _concatenated_ranges(starts, lengths)
+
+        topic_ids = self.postings.indices[positions]
+        contributions = np.repeat(np.asarray(weights, dtype=np.float64), lengths)
+        if self.codec.scales is None:
+            contributions *= self.postings.data[positions]
+        else:
+            position_terms = np.repeat(np.asarray(term_ids), lengths)
+            contributions *= self.codec.decode(self.postings.data[positions], position_terms)
+
+        # accumulators only for the topics that appear in the query postings
+        unique_topic_ids, slots = np.unique(topic_ids, return_inverse=True)
+        scores = np.bincount(slots, weights=contributions, minlength=len(unique_topic_ids))
+        return unique_topic_ids, scores
+
+    def topn(
+        self,
+        term_ids: np.ndarray,
+        weights: np.ndarray,
+        topn: int = 10,
+        thresh: float = 0.0,
+        pruning: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (topic ids, scores) of the `topn` best topics with a score above `thresh`.
+
+        With `pruning=True` postings and accumulators that cannot reach the
+        top-n are skipped. The result is identical to the exhaustive scorer.
+        """
+        if not pruning:
+            topic_ids, scores = self.score(term_ids, weights)
+            return topn_sparse(topic_ids, scores, topn, thresh=thresh)
+        if thresh < 0:
+            raise ValueError("dynamic pruning requires a non-negative thresh")
+        return self._topn_maxscore(
+            np.asarray(term_ids), np.asarray(weights, dtype=np.float64), topn, thresh
+        )
+
+    def _topn_maxscore(
+        self, term_ids: np.ndarray, weights: np.ndarray, topn: int, thresh: float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        self._build_bounds()
+        assert self._block_indptr is not None and self._block_max is not None
+
+        cand_ids = np.zeros(0, dtype=self.postings.indices.dtype)
+        cand_scores = np.zeros(0, dtype=np.float64)
+        if len(term_ids) == 0 or topn <= 0:
+            return cand_ids, cand_scores
+
+        def prunable(bounds: np.ndarray, kth: float) -> np.ndarray:
+            slack_bounds = bounds * (1 + BOUND_RTOL)
+            return (slack_bounds < kth) | (slack_bounds <= thresh)
+
+        def kth_score(scores: np.ndarray) -> float:
+            if len(scores) < topn:
+                return -np.inf
+            return float(np.partition(scores, len(scores) - topn)[len(scores) - topn])
+
+        term_bounds = weights * self.term_max[term_ids]
+        kth = self._estimate_kth_score(term_ids, weights, topn)
+
+        # non-essential terms: the smallest bounds that together cannot lift a topic
+        # to the n-th best score, so they never need to create accumulators
+        ascending = np.argsort(term_bounds, kind="stable")
+        lazy_bounds = np.cumsum(term_bounds[ascending])
+        n_lazy = int(prunable(lazy_bounds, kth).sum())
+        essential = ascending[n_lazy:]
+
+        # accumulate the essential terms, skipping blocks that cannot reach the n-th best score
+        block_ranges = self._block_indptr[term_ids[essential]]
+        n_blocks = self._block_indptr[term_ids[essential] + 1] - block_ranges
+        blocks = _concatenated_ranges(block_ranges, n_blocks)
+        block_query = np.repeat(essential, n_blocks)
+        other_bounds = term_bounds.sum() - term_bounds[block_query]
+        block_bounds = weights[block_query] * self._block_max[blocks] + other_bounds
+        live = ~prunable(block_bounds, kth)
+        blocks, block_query = blocks[live], block_query[live]
+
+        term_starts = self.postings.indptr[term_ids[block_query]]
+        term_stops = self.postings.indptr[term_ids[block_query] + 1]
+        block_rank = blocks - self._block_indptr[term_ids[block_query]]
+        block_starts = term_starts + block_rank * self.block_size
+        block_lengths = np.minimum(self.block_size, term_stops - block_starts)
+        positions = _concatenated_ranges(block_starts, block_lengths)
+        contributions = np.repeat(weights[block_query], block_lengths) * self.codec.decode(
+            self.postings.data[positions], np.repeat(term_ids[block_query], block_lengths)
+        )
+        cand_ids, slots = np.unique(self.postings.indices[positions], return_inverse=True)
+        cand_scores = np.bincount(slots, weights=contributions, minlength=len(cand_ids)).astype(
+            np.float64
+        )
+
+        # probe the non-essential terms for the surviving accumulators only
+        rest_bounds = np.concatenate([[0.0], lazy_bounds[:n_lazy]])
+        for jj in range(n_lazy, -1, -1):
+            if jj < n_lazy:
+                qq = ascending[jj]
+                cand_scores += weights[qq] * self._lookup(term_ids[qq], cand_ids)
+            kth = max(kth, kth_score(cand_scores))
+            keep = ~prunable(cand_scores + rest_bounds[jj], kth)
+            cand_ids, cand_scores = cand_ids[keep], cand_scores[keep]
+
+        # rescore the survivors in the same order as `score` so results match it exactly
+        cand_scores = np.zeros(len(cand_ids), dtype=np.float64)
+        for term, weight in zip(term_ids, weights):
+            hit = self._lookup(term, cand_ids)
+            present = hit != 0
+            cand_scores[present] += weight * hit[present]
+        return topn_sparse(cand_ids, cand_scores, topn, thresh=thresh)
+
+    def _lookup(self, term_id: int, topic_ids: np.ndarray) -> np.ndarray:
+        """Return the impacts of `term_id` for sorted `topic_ids` (0.0 where there is no posting)."""
+        start, stop = self.postings.indptr[term_id], self.postings.indptr[term_id + 1]
+        term_topic_ids = self.postings.indices[start:stop]
+        impacts = np.zeros(len(topic_ids), dtype=np.float64)
+        if stop == start or len(topic_ids) == 0:
+            return impacts
+        pos = np.searchsorted(term_topic_ids, topic_ids)
+        hit = pos < len(term_topic_ids)
+        hit[hit] = term_topic_ids[pos[hit]] == topic_ids[hit]
+        impacts[hit] = self.codec.decode(self.postings.data[start + pos[hit]], term_id)
+        return impacts
+
+    def _estimate_kth_score(self, term_ids: np.ndarray, weights: np.ndarray, topn: int) -> float:
+        """Return a lower bound on the `topn`-th best score of a query.
+
+        Impacts are non-negative, so the `topn`-th largest impact of any one
+        query term (taken from its highest blocks) is a lower bound.
+        """
+        assert self._block_indptr is not None and self._block_max is not None
+        kth = -np.inf
+        indptr = self.postings.indptr
+        for term, weight in zip(term_ids, weights):
+            start, stop = indptr[term], indptr[term + 1]
+            if stop - start < topn:
+                continue
+            block_max = self._block_max[self._block_indptr[term] : self._block_indptr[term + 1]]
+            top_blocks = np.argsort(-block_max, kind="stable")[:topn]
+            block_starts = start + top_blocks * self.block_size
+            block_lengths = np.minimum(self.block_size, stop - block_starts)
+            codes = self.postings.data[_concatenated_ranges(block_starts, block_lengths)]
+            kth_code = np.partition(codes, len(codes) - topn)[-topn : len(codes) - topn + 1]
+            kth = max(kth, weight * float(self.codec.decode(kth_code, term)[0]))
+        return kth
+
+
+def _concatenated_ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Return the concatenation of `arange(start, start + length)` for each range."""
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    nonempty = lengths > 0
+    starts = np.asarray(starts, dtype=np.int64)[nonempty]
+    lengths = np.asarray(lengths, dtype=np.int64)[nonempty]
+    # step of +1 inside each range and a jump to the next start at range boundaries
+    steps = np.ones(total, dtype=np.int64)
+    boundaries = np.cumsum(lengths)[:-1]
+    steps[0] = starts[0]
+    steps[boundaries] = starts[1:] - (starts[:-1] + lengths[:-1] - 1)
+    return np.cumsum(steps)
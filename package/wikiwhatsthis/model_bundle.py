@@ -0,0 +1,263 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""Memory-mapped model bundles.
+
+A bundle is a directory of raw `.npy` arrays plus a `bundle.json` manifest.
+Every array is opened with `np.load(mmap_mode="r")`, so loading a model does
+not unpickle, parse or decompress anything and processes on the same host
+share one copy of the arrays through the page cache::
+
+    bundle.json                       config, shapes, quantization and column kinds
+    xdocterm_{data,indices,indptr}    topic-major impacts (n_topics, n_terms)
+    postings_{data,indices,indptr}    term-major impacts (n_terms, n_topics)
+    impact_scales                     per-term scales of 8-bit impacts (see `quantize`)
+    tf_postings_{data,indices,indptr} optional term-major raw term frequencies (n_terms, n_topics)
+    doc_lengths, idf                  with them, for query-time bm25 (see `tunable_bm25`)
+    vocab_{buffer,offsets[,indices]}  sorted vocabulary (see `vocabulary.Vocabulary`)
+    topic_{name}.npy                  numeric topic metadata columns
+    topic_{name}_{buffer,offsets}     string topic metadata columns
+"""
+import json
+import logging
+import os
+from typing import Any, Dict, Optional, Sequence, Union
+
+import joblib
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from nltk.stem.snowball import SnowballStemmer
+from sklearn.feature_extraction.text import CountVectorizer
+
+from wikiwhatsthis.explicit_topic_model import ExplicitTopicModel
+from wikiwhatsthis.inverted_index import InvertedIndex
+from wikiwhatsthis.quantize import ImpactCodec, quantize_postings, quantize_topic_term
+from wikiwhatsthis.stem_cache import CachedStemmer
+from wikiwhatsthis.topic_table import Column, TopicTable, encode_strings
+from wikiwhatsthis.tunable_bm25 import TermFrequencyIndex
+from wikiwhatsthis.vocabulary import Vocabulary
+
+
+logger = logging.getLogger(__name__)
+
+
+BUNDLE_FORMAT_VERSION = 3
+BUNDLE_MANIFEST = "bundle.json"
+
+
+def _index_dtype(matrix: scipy.sparse.csr_matrix) -> type:
+    """Use int32 indices whenever they fit so scipy never has to re-check or cast them."""
+    if max(matrix.shape) < np.iinfo(np.int32).max and matrix.nnz < np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+
+def _save_array(bundle_path: str, name: str, array: np.ndarray) -> None:
+    np.save(os.path.join(bundle_path, f"{name}.npy"), np.ascontiguousarray(array))
+
+
+def _load_array(bundle_path: str, name: str, mmap_mode: Optional[str]) -> np.ndarray:
+    return np.load(os.path.join(bundle_path, f"{name}.npy"), mmap_mode=mmap_mode)
+
+
+def _save_csr(bundle_path: str, name: str, matrix: scipy.sparse.csr_matrix) -> None:
+    # `matrix` has sorted indices and possibly quantized data, so it is not converted here
+    index_dtype = _index_dtype(matrix)
+    _save_array(bundle_path, f"{name}_data", matrix.data)
+    _save_array(bundle_path, f"{name}_indices", matrix.indices.astype(index_dtype))
+    _save_array(bundle_path, f"{name}_indptr", matrix.indptr.astype(index_dtype))
+
+
+def _load_csr(
+    bundle_path: str, name: str, shape: Sequence[int], mmap_mode: Optional[str]
+) -> scipy.sparse.csr_matrix:
+    # assign the arrays directly, the constructor may scan or cast them
+    matrix = scipy.sparse.csr_matrix(tuple(shape))
+    matrix.data = _load_array(bundle_path, f"{name}_data", mmap_mode)
+    matrix.indices = _load_array(bundle_path, f"{name}_indices", mmap_mode)
+    matrix.indptr = _load_array(bundle_path, f"{name}_indptr", mmap_mode)
+    matrix.has_sorted_indices = True
+    return matrix
+
+
+def write_bundle(
+    bundle_path: str,
+    wwt_config: Dict,
+    feature_names: Sequence[str],
+    df_articles: pd.DataFrame,
+    xdocterm: scipy.sparse.csr_matrix,
+    quantization: str = "float64",
+    xcounts: Optional[scipy.sparse.spmatrix] = None,
+) -> None:
+    """Write a model bundle for the topic-term matrix `xdocterm` (e.g. xbm25).
+
+    `quantization` selects how impacts are stored (see `quantize.QUANTIZATION_MODES`).
+    With the raw counts `xcounts` (e.g. xcv) the bundle can also score with
+    bm25 parameters chosen at query time.
+
+    The postings are built in memory as a transpose of `xdocterm` (and a
+    float32 transpose of `xcounts`), even if `xdocterm` is memory-mapped.
+    """
+    os.makedirs(bundle_path, exist_ok=True)
+    xdocterm = scipy.sparse.csr_matrix(xdocterm)
+    xdocterm.sort_indices()
+
+    postings, codec = quantize_postings(xdocterm.T, quantization)
+    _save_csr(bundle_path, "xdocterm", quantize_topic_term(xdocterm, codec))
+    _save_csr(bundle_path, "postings", postings)
+    if codec.scales is not None:
+        _save_array(bundle_path, "impact_scales", codec.scales)
+
+    if xcounts is not None:
+        if xcounts.shape != xdocterm.shape:
+            raise ValueError(f"xcounts {xcounts.shape} and xdocterm {xdocterm.shape} differ")
+        term_frequencies = TermFrequencyIndex.from_counts(xcounts)
+        _save_csr(bundle_path, "tf_postings", term_frequencies.postings.postings)
+        _save_array(bundle_path, "doc_lengths", term_frequencies.doc_lengths)
+        _save_array(bundle_path, "idf", term_frequencies.idf)
+
+    vocabulary = Vocabulary.from_tokens(feature_names)
+    _save_array(bundle_path, "vocab_buffer", vocabulary.buffer)
+    _save_array(bundle_path, "vocab_offsets", vocabulary.offsets)
+    if vocabulary.indices is not None:
+        _save_array(bundle_path, "vocab_indices", vocabulary.indices)
+
+    topic_columns = []
+    for name in df_articles.columns:
+        if df_articles[name].dtype.kind in "biuf":
+            _save_array(bundle_path, f"topic_{name}", df_articles[name].values)
+            topic_columns.append({"name": name, "kind": "numeric"})
+        else:
+            buffer, offsets = encode_strings(df_articles[name].values)
+            _save_array(bundle_path, f"topic_{name}_buffer", buffer)
+            _save_array(bundle_path, f"topic_{name}_offsets", offsets)
+            topic_columns.append({"name": name, "kind": "string"})
+
+    manifest = {
+        "format_version": BUNDLE_FORMAT_VERSION,
+        "wwt_config": wwt_config,
+        "shape": list(xdocterm.shape),
+        "quantization": quantization,
+        "num_tokens": len(feature_names),
+        "vocab_indices": vocabulary.indices is not None,
+        "term_frequencies": xcounts is not None,
+        "topic_columns": topic_columns,
+    }
+    with open(os.path.join(bundle_path, BUNDLE_MANIFEST), "w") as fp:
+        json.dump(manifest, fp, indent=4)
+
+
+def read_manifest(bundle_path: str) -> Dict[str, Any]:
+    with open(os.path.join(bundle_path, BUNDLE_MANIFEST), "r") as fp:
+        manifest = json.load(fp)
+    if manifest["format_version"] != BUNDLE_FORMAT_VERSION:
+        raise ValueError(
+            "bundle format version {} is not supported (expected {})".format(
+                manifest["format_version"], BUNDLE_FORMAT_VERSION
+            )
+        )
+    return manifest
+
+
+def build_count_vectorizer(cv_args: Dict) -> CountVectorizer:
+    """Return an unfitted CountVectorizer whose analyzer matches the trained one."""
+    cv_args = dict(cv_args)
+    if "ngram_range" in cv_args:
+        cv_args["ngram_range"] = tuple(cv_args["ngram_range"])
+    return CountVectorizer(**cv_args)
+
+
+def load_bundle(
+    bundle_path: str,
+    stemmer: Union[SnowballStemmer, CachedStemmer, None] = None,
+    mmap_mode: Optional[str] = "r",
+    **model_kwargs: Any,
+) -> ExplicitTopicModel:
+    """Open a bundle written by `write_bundle` as an `ExplicitTopicModel`.
+
+    Parameters
+    ----------
+    bundle_path : str
+        Directory written by `write_bundle`.
+    stemmer : stemmer, optional
+        Defaults to a new english snowball stemmer. Pass one `CachedStemmer`
+        to several models to share its cache.
+    mmap_mode : str or None
+        Passed to `np.load`. Use None to read the arrays into memory.
+    model_kwargs
+        Extra keyword arguments for `ExplicitTopicModel`.
+    """
+    manifest = read_manifest(bundle_path)
+    shape = manifest["shape"]
+
+    xdocterm = _load_csr(bundle_path, "xdocterm", shape, mmap_mode)
+    postings = _load_csr(bundle_path, "postings", shape[::-1], mmap_mode)
+    scales = None
+    if os.path.exists(os.path.join(bundle_path, "impact_scales.npy")):
+        scales = _load_array(bundle_path, "impact_scales", mmap_mode)
+    codec = ImpactCodec(manifest["quantization"], scales)
+    term_frequencies = None
+    # bundles written before query-time bm25 have no term frequencies
+    if manifest.get("term_frequencies", False):
+        term_frequencies = TermFrequencyIndex(
+            _load_csr(bundle_path, "tf_postings", shape[::-1], mmap_mode),
+            _load_array(bundle_path, "doc_lengths", mmap_mode),
+            _load_array(bundle_path, "idf", mmap_mode),
+        )
+
+    vocabulary = Vocabulary(
+        _load_array(bundle_path, "vocab_buffer", mmap_mode),
+        _load_array(bundle_path, "vocab_offsets", mmap_mode),
+        _load_array(bundle_path, "vocab_indices", mmap_mode) if manifest["vocab_indices"] else None,
+    )
+
+    columns: Dict[str, Column] = {}
+    for column in manifest["topic_columns"]:
+        name = column["name"]
+        if column["kind"] == "numeric":
+            columns[name] = _load_array(bundle_path, f"topic_{name}", mmap_mode)
+        else:
+            columns[name] = (
+                _load_array(bundle_path, f"topic_{name}_buffer", mmap_mode),
+                _load_array(bundle_path, f"topic_{name}_offsets", mmap_mode),
+            )
+    topic_table = TopicTable(columns, shape[0])
+
+    cv = build_count_vectorizer(manifest["wwt_config"]["cv_args"])
+    stemmer = stemmer if stemmer is not None else SnowballStemmer("english")
+    return ExplicitTopicModel(
+        cv,
+        xdocterm,
+        topic_table,
+        stemmer,
+        index=InvertedIndex(postings, codec=codec),
+        vocabulary=vocabulary,
+        term_frequencies=term_frequencies,
+        **model_kwargs,
+    )
+
+
+def bundle_nbytes(bundle_path: str) -> int:
+    """Return the total size of the arrays in a bundle."""
+    return sum(
+        os.path.getsize(os.path.join(bundle_path, file_name))
+        for file_name in os.listdir(bundle_path)
+        if file_name.endswith(".npy")
+    )
+
+
+def bundle_from_model_path(model_path: str, matrix_name: str = "xbm25") -> str:
+    """Convert a model directory written by `task_15_train_models.dump` into a bundle."""
+    with open(os.path.join(model_path, "wwt_config.json"), "r") as fp:
+        wwt_config = json.load(fp)
+    cv = joblib.load(os.path.join(model_path, "cv.joblib"))
+    df_articles = pd.read_csv(os.path.join(model_path, "df_articles.csv"), keep_default_na=False)
+    xdocterm = scipy.sparse.load_npz(os.path.join(model_path, f"{matrix_name}.npz"))
+    counts_path = os.path.join(model_path, "xcv.npz")
+    xcounts = scipy.sparse.load_npz(counts_path) if os.path.exists(counts_path) else None
+
+    bundle_path = os.path.join(model_path, "bundle")
+    logger.info(f"writing {bundle_path}")
+    write_bundle(
+        bundle_path, wwt_config, cv.get_feature_names(), df_articles, xdocterm, xcounts=xcounts
+    )
+    return bundle_path
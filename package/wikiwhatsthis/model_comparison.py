@@ -0,0 +1,94 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""Top-n agreement between a reference model and a smaller copy of it.
+
+Quantized or pruned models trade accuracy for memory. `compare_topn` measures
+the cost on a set of query texts: how many of the reference top-n topics the
+candidate still returns, how often the two rankings are identical and how far
+the scores of the shared topics moved.
+"""
+import json
+import logging
+import os
+from typing import Dict, Iterable, Union
+
+import numpy as np
+
+from wikiwhatsthis.explicit_topic_model import ExplicitTopicModel
+from wikiwhatsthis.model_bundle import bundle_nbytes, load_bundle
+from wikiwhatsthis.stem_cache import CachedStemmer
+
+logger = logging.getLogger(__name__)
+
+
+TOPN_REPORT = "topn_report.json"
+
+
+def compare_topn(
+    reference: ExplicitTopicModel,
+    candidate: ExplicitTopicModel,
+    texts: Iterable[str],
+    topn: int = 10,
+) -> Dict[str, Union[int, float]]:
+    """Compare the top-n topics of two models over `texts`.
+
+    Returns
+    -------
+    report : dict
+        num_texts, topn,
+        recall_at_k : mean fraction of the reference top-n found by the candidate
+        exact_match_rate : fraction of texts with identical ranked topic ids
+        max_abs_score_error : largest score change of a topic found by both
+        mean_abs_score_error : mean score change of the topics found by both
+    """
+    texts = list(texts)
+    expected = reference.topn_topics_from_texts(texts, topn=topn)
+    found = candidate.topn_topics_from_texts(texts, topn=topn)
+
+    recalls = []
+    exact_matches = 0
+    score_errors = []
+    for row in range(len(texts)):
+        expected_ids = expected.topic_ids[row, : expected.counts[row]]
+        found_ids = found.topic_ids[row, : found.counts[row]]
+        exact_matches += int(np.array_equal(expected_ids, found_ids))
+        if len(expected_ids) == 0:
+            continue
+        shared, expected_pos, found_pos = np.intersect1d(
+            expected_ids, found_ids, return_indices=True
+        )
+        recalls.append(len(shared) / len(expected_ids))
+        score_errors.append(
+            np.abs(expected.scores[row, expected_pos] - found.scores[row, found_pos])
+        )
+
+    errors = np.concatenate(score_errors) if score_errors else np.zeros(0)
+    return {
+        "num_texts": len(texts),
+        "topn": topn,
+        "recall_at_k": float(np.mean(recalls)) if recalls else 1.0,
+        "exact_match_rate": exact_matches / len(texts) if texts else 1.0,
+        "max_abs_score_error": float(errors.max()) if len(errors) else 0.0,
+        "mean_abs_score_error": float(errors.mean()) if len(errors) else 0.0,
+    }
+
+
+def write_topn_report(
+    reference_path: str, candidate_path: str, texts: Iterable[str], topn: int = 10
+) -> Dict[str, Union[int, float]]:
+    """Compare two bundles and write the report into the candidate bundle."""
+    # both models stem the same texts, so they share one cache
+    stemmer = CachedStemmer()
+    report = compare_topn(
+        load_bundle(reference_path, stemmer=stemmer),
+        load_bundle(candidate_path, stemmer=stemmer),
+        texts,
+        topn=topn,
+    )
+    report["reference_nbytes"] = bundle_nbytes(reference_path)
+    report["nbytes"] = bundle_nbytes(candidate_path)
+
+    file_name = os.path.join(candidate_path, TOPN_REPORT)
+    logger.info(f"writing {file_name}: {report}")
+    with open(file_name, "w") as fp:
+        json.dump(report, fp, indent=4)
+    return report
@@ -75,6 +75,13 @@ ARTICLES_DUMP_PATTERN = re.compile(
     (?P<extension>
         \w+              # extension (e.g. "bz2")
     )
+    (
+    \.                   # literal "."
+    (?P<compression>
+        gz|zst           # optional compression of pipeline files (e.g. "jsonl.gz")
+    )
+    )?
+    $                    # nothing else (e.g. not a ".jsonl.tokens.npz" token store)
     """,
     re.VERBOSE,
 )
@@ -90,6 +97,11 @@ if __name__ == "__main__":
     if match is not None:
         print(match.groupdict())
 
+    file_name = "kwnlp-enwiki-20200920-link-annotated-text13-p10672789p11659682-base.jsonl.zst"
+    match = re.match(ARTICLES_DUMP_PATTERN, file_name)
+    if match is not None:
+        print(match.groupdict())
+
     file_name = "kwnlp-enwiki-20200920-prior-month-pagecounts-views-ge-5-totals.csv"
     match = re.match(CSV_DUMP_PATTERN, file_name)
     if match is not None:
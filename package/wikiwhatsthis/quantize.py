@@ -0,0 +1,134 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""Quantized storage of BM25 impacts.
+
+`BM25Transformer` produces float64 impacts. Top-n retrieval only needs their
+order and rough magnitude, so they can be stored in fewer bytes:
+
+    float64       8 bytes, the reference
+    float32       4 bytes
+    float16       2 bytes
+    uint8_linear  1 byte, `code * scale[term]`
+    uint8_log     1 byte, `expm1(code * scale[term])`
+
+The 8-bit modes keep one scale per term so that every posting list uses all
+256 codes. Decoding is monotonic within a term, so the maximum code of a
+posting list or block decodes to its maximum impact.
+"""
+from typing import Optional, Tuple, Union
+
+import numpy as np
+import scipy.sparse
+
+
+QUANTIZATION_MODES = ("float64", "float32", "float16", "uint8_linear", "uint8_log")
+
+_FLOAT_DTYPES = {"float64": np.float64, "float32": np.float32, "float16": np.float16}
+_MAX_CODE = 255
+
+
+class ImpactCodec:
+    def __init__(self, mode: str = "float64", scales: Optional[np.ndarray] = None) -> None:
+        """Encode and decode impacts with one of `QUANTIZATION_MODES`.
+
+        Parameters
+        ----------
+        mode : str
+            Storage format of the impacts.
+        scales : array of shape (n_terms,), optional
+            Per-term scales, required by the 8-bit modes.
+        """
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"quantization must be one of {QUANTIZATION_MODES}")
+        if mode not in _FLOAT_DTYPES and scales is None:
+            raise ValueError(f"quantization {mode} requires per-term scales")
+        self.mode = mode
+        self.scales = scales if mode not in _FLOAT_DTYPES else None
+
+    @classmethod
+    def from_term_max(cls, mode: str, term_max: np.ndarray) -> "ImpactCodec":
+        """Choose the per-term scales that map the largest impact of each term to code 255."""
+        if mode in _FLOAT_DTYPES:
+            return cls(mode)
+        term_max = np.asarray(term_max, dtype=np.float64)
+        if mode == "uint8_log":
+            term_max = np.log1p(term_max)
+        scales = np.where(term_max > 0, term_max / _MAX_CODE, 1.0)
+        return cls(mode, scales)
+
+    @property
+    def dtype(self) -> type:
+        return _FLOAT_DTYPES.get(self.mode, np.uint8)
+
+    def encode(self, impacts: np.ndarray, term_ids: Union[int, np.ndarray]) -> np.ndarray:
+        """Return the codes of non-negative `impacts` that belong to terms `term_ids`."""
+        impacts = np.asarray(impacts, dtype=np.float64)
+        if self.mode in _FLOAT_DTYPES:
+            if self.mode == "float16" and len(impacts) > 0:
+                if impacts.max() > np.finfo(np.float16).max:
+                    raise ValueError("impacts are too large for float16")
+            return impacts.astype(self.dtype, copy=False)
+
+        if len(impacts) > 0 and impacts.min() < 0:
+            raise ValueError("8-bit quantization requires non-negative impacts")
+        assert self.scales is not None
+        if self.mode == "uint8_log":
+            impacts = np.log1p(impacts)
+        codes = np.rint(impacts / self.scales[term_ids])
+        # a stored posting never decodes to zero
+        codes = np.where(impacts > 0, np.clip(codes, 1, _MAX_CODE), 0)
+        return codes.astype(np.uint8)
+
+    def decode(self, codes: np.ndarray, term_ids: Union[int, np.ndarray]) -> np.ndarray:
+        """Return float64 impacts for `codes` that belong to terms `term_ids`."""
+        if self.mode in _FLOAT_DTYPES:
+            return np.asarray(codes).astype(np.float64, copy=False)
+        assert self.scales is not None
+        impacts = codes * self.scales[term_ids]
+        if self.mode == "uint8_log":
+            impacts = np.expm1(impacts)
+        return impacts
+
+
+def term_max(postings: scipy.sparse.csr_matrix) -> np.ndarray:
+    """Return the maximum impact of every row of a term-major posting matrix."""
+    lengths = np.diff(postings.indptr)
+    result = np.zeros(postings.shape[0], dtype=np.float64)
+    nonempty = lengths > 0
+    if nonempty.any():
+        result[nonempty] = np.maximum.reduceat(postings.data, postings.indptr[:-1][nonempty])
+    return result
+
+
+def quantize_postings(
+    postings: scipy.sparse.csr_matrix, mode: str
+) -> Tuple[scipy.sparse.csr_matrix, ImpactCodec]:
+    """Return (coded postings, codec) for a (n_terms, n_topics) matrix."""
+    postings = scipy.sparse.csr_matrix(postings)
+    postings.sort_indices()
+    codec = ImpactCodec.from_term_max(mode, term_max(postings))
+    row_terms = np.repeat(np.arange(postings.shape[0]), np.diff(postings.indptr))
+    return with_codes(postings, codec.encode(postings.data, row_terms)), codec
+
+
+def quantize_topic_term(
+    xdocterm: scipy.sparse.csr_matrix, codec: ImpactCodec
+) -> scipy.sparse.csr_matrix:
+    """Encode a (n_topics, n_terms) matrix with the per-term scales of `codec`."""
+    xdocterm = scipy.sparse.csr_matrix(xdocterm)
+    xdocterm.sort_indices()
+    return with_codes(xdocterm, codec.encode(xdocterm.data, xdocterm.indices))
+
+
+def with_codes(matrix: scipy.sparse.csr_matrix, codes: np.ndarray) -> scipy.sparse.csr_matrix:
+    """Return a csr matrix with the structure of `matrix` and `codes` as data.
+
+    The arrays are assigned directly because the csr constructor casts float16
+    data to float32. Use the arrays of the result (not scipy operations) to
+    read impacts back.
+    """
+    coded = scipy.sparse.csr_matrix(matrix.shape)
+    coded.indptr = matrix.indptr
+    coded.indices = matrix.indices
+    coded.data = codes
+    coded.has_sorted_indices = matrix.has_sorted_indices
+    return coded
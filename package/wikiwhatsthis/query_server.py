@@ -0,0 +1,357 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""Local HTTP query service for several explicit topic models.
+
+Serves the bundles of one or more `{corpus}-{scope}-ngram11-snowball` model
+directories from one process::
+
+    python query_server.py /data/wiki-whats-this/20200920/inlinks40-intro-ngram11-snowball
+
+    GET  /models              names of the loaded models
+    POST /models/{name}/topn  {"text": "...", "topn": 10, "thresh": 0.0}
+    GET  /stats               latency histograms, batch sizes and stem cache stats
+
+All models share one `CachedStemmer`. Concurrent requests for a model are
+coalesced by `MicroBatcher` into one `topn_topics_from_texts` call, which
+stems every distinct token of the batch once and scores all texts with one
+sparse product. Scoring runs on a single worker thread (the stem cache is not
+thread safe) so the event loop keeps accepting requests.
+"""
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from wikiwhatsthis import argconfig
+from wikiwhatsthis.explicit_topic_model import ExplicitTopicModel
+from wikiwhatsthis.model_bundle import load_bundle
+from wikiwhatsthis.stem_cache import CachedStemmer, StemTable
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+DEFAULT_MAX_BATCH_SIZE = 64
+DEFAULT_MAX_WAIT_MS = 2.0
+# largest topn a client can ask for, a batch allocates (texts x topn) result arrays
+MAX_TOPN = 1000
+# upper bounds of the latency histogram buckets in milliseconds
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float("inf"))
+
+Record = Dict[str, Any]
+
+
+def check_topn_args(topn: int, thresh: float) -> None:
+    """Raise a ValueError unless `topn` and `thresh` are allowed."""
+    if not 1 <= topn <= MAX_TOPN:
+        raise ValueError(f"topn must be between 1 and {MAX_TOPN}")
+    if thresh < 0:
+        raise ValueError("thresh must be non-negative")
+
+
+def parse_topn_query(body: bytes) -> Tuple[str, int, float]:
+    """Return (text, topn, thresh) of a topn request body.
+
+    Raises a KeyError, TypeError or ValueError for a malformed query, before
+    it reaches a model.
+    """
+    query = json.loads(body)
+    text = str(query["text"])
+    topn = int(query.get("topn", 10))
+    thresh = float(query.get("thresh", 0.0))
+    check_topn_args(topn, thresh)
+    return text, topn, thresh
+
+
+class LatencyHistogram:
+    def __init__(self, bounds: Sequence[float] = LATENCY_BUCKETS_MS) -> None:
+        """Count latencies in buckets with upper bounds `bounds` (milliseconds)."""
+        self.bounds = np.asarray(bounds, dtype=np.float64)
+        self.counts = np.zeros(len(self.bounds), dtype=np.int64)
+        self.total_ms = 0.0
+
+    def observe(self, latency_ms: float) -> None:
+        self.counts[np.searchsorted(self.bounds, latency_ms)] += 1
+        self.total_ms += latency_ms
+
+    def quantile(self, q: float) -> float:
+        """Return the upper bound of the bucket that holds the `q` quantile."""
+        count = int(self.counts.sum())
+        if count == 0:
+            return 0.0
+        rank = max(1, int(np.ceil(q * count)))
+        return float(self.bounds[np.searchsorted(np.cumsum(self.counts), rank)])
+
+    def stats(self) -> Dict[str, Any]:
+        count = int(self.counts.sum())
+        return {
+            "count": count,
+            "mean_ms": self.total_ms / count if count else 0.0,
+            "p50_ms": self.quantile(0.5),
+            "p90_ms": self.quantile(0.9),
+            "p99_ms": self.quantile(0.99),
+            "buckets": {str(bound): int(num) for bound, num in zip(self.bounds, self.counts)},
+        }
+
+
+class MicroBatcher:
+    def __init__(
+        self,
+        model: ExplicitTopicModel,
+        executor: Executor,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        max_wait_ms: float = DEFAULT_MAX_WAIT_MS,
+    ) -> None:
+        """Coalesce concurrent top-n requests for `model` into batched scoring calls.
+
+        A batch is scored as soon as it has `max_batch_size` requests or its
+        first request has waited `max_wait_ms`.
+        """
+        self.model = model
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.latency = LatencyHistogram()
+        self.batch_latency = LatencyHistogram()
+        self.batch_sizes: Dict[int, int] = {}
+        self._queue: "Optional[asyncio.Queue[Tuple[str, int, float, asyncio.Future]]]" = None
+        self._worker: Optional[asyncio.Future] = None
+
+    async def topn(self, text: str, topn: int = 10, thresh: float = 0.0) -> List[Record]:
+        """Return the top topics of `text` as records with a "score" field."""
+        check_topn_args(topn, thresh)
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, topn, thresh, future))
+        records = await future
+        self.latency.observe(1000 * (time.perf_counter() - start))
+        return records
+
+    async def close(self) -> None:
+        """Stop the batching task."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+            self._queue = None
+
+    async def _run(self) -> None:
+        assert self._queue is not None
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+
+            # one scoring call per distinct thresh, with the largest topn of the group
+            groups: Dict[float, List[Tuple[str, int, float, asyncio.Future]]] = {}
+            for request in batch:
+                groups.setdefault(request[2], []).append(request)
+            for thresh, requests in groups.items():
+                start = time.perf_counter()
+                try:
+                    results = await loop.run_in_executor(
+                        self.executor,
+                        self._score,
+                        [request[0] for request in requests],
+                        max(request[1] for request in requests),
+                        thresh,
+                    )
+                except Exception as exc:
+                    for request in requests:
+                        if not request[3].done():
+                            request[3].set_exception(exc)
+                    continue
+                self.batch_latency.observe(1000 * (time.perf_counter() - start))
+                for request, records in zip(requests, results):
+                    if not request[3].done():
+                        request[3].set_result(records[: request[1]])
+
+    def _score(self, texts: List[str], topn: int, thresh: float) -> List[List[Record]]:
+        batch = self.model.topn_topics_from_texts(texts, topn=topn, thresh=thresh)
+        results = []
+        for topic_ids, scores, count in zip(batch.topic_ids, batch.scores, batch.counts):
+            top_topics_df = self.model.topic_df.iloc[topic_ids[:count]].copy()
+            top_topics_df["score"] = scores[:count]
+            results.append(top_topics_df.to_dict(orient="records"))
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "latency": self.latency.stats(),
+            "batch_latency": self.batch_latency.stats(),
+            "batch_sizes": {str(size): num for size, num in sorted(self.batch_sizes.items())},
+        }
+
+
+class QueryServer:
+    def __init__(
+        self,
+        models: Dict[str, ExplicitTopicModel],
+        stemmer: CachedStemmer,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        max_wait_ms: float = DEFAULT_MAX_WAIT_MS,
+    ) -> None:
+        """Serve `models` (all stemming with `stemmer`) over HTTP."""
+        self.stemmer = stemmer
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.batchers = {
+            name: MicroBatcher(model, executor, max_batch_size, max_wait_ms)
+            for name, model in models.items()
+        }
+
+    @classmethod
+    def from_model_paths(
+        cls,
+        model_paths: Sequence[str],
+        bundle_name: str = "bundle",
+        stem_table_path: Optional[str] = None,
+        **kwargs: Any,
+    ) -> "QueryServer":
+        """Load the bundle `bundle_name` of each model directory (named by its basename).
+
+        Tokens in the stem table written by task_01 (`stem_table_path`) are
+        looked up there instead of being stemmed.
+        """
+        table = StemTable.load(stem_table_path) if stem_table_path is not None else None
+        stemmer = CachedStemmer(table=table)
+        models = {}
+        for model_path in model_paths:
+            name = os.path.basename(os.path.normpath(model_path))
+            logger.info(f"loading {name}")
+            models[name] = load_bundle(os.path.join(model_path, bundle_name), stemmer=stemmer)
+        return cls(models, stemmer, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "models": {name: batcher.stats() for name, batcher in self.batchers.items()},
+            "stem_cache": self.stemmer.stats(),
+        }
+
+    async def handle_request(self, method: str, path: str, body: bytes) -> Tuple[int, Any]:
+        """Return (HTTP status, JSON response) for one request."""
+        parts = path.strip("/").split("/")
+        if method == "GET" and parts == ["models"]:
+            return 200, sorted(self.batchers)
+        if method == "GET" and parts == ["stats"]:
+            return 200, self.stats()
+        if method == "POST" and len(parts) == 3 and parts[0] == "models" and parts[2] == "topn":
+            if parts[1] not in self.batchers:
+                return 404, {"error": f"unknown model {parts[1]}"}
+            try:
+                text, topn, thresh = parse_topn_query(body)
+            except (KeyError, TypeError, ValueError) as exc:
+                return 400, {"error": str(exc)}
+            try:
+                records = await self.batchers[parts[1]].topn(text, topn=topn, thresh=thresh)
+            except Exception as exc:
+                # the query was valid, so this is a failure of the model (e.g. a
+                # MemoryError while scoring), every request of the batch gets it
+                logger.exception(f"scoring failed for model {parts[1]}")
+                return 500, {"error": f"scoring failed: {type(exc).__name__}"}
+            return 200, records
+        return 404, {"error": f"no route for {method} {path}"}
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Answer HTTP/1.1 requests on one connection until the client closes it."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, response = await self.handle_request(method, path, body)
+                payload = json.dumps(response, default=_json_default).encode("utf-8")
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                        "Content-Type: application/json\r\n"
+                        f"Content-Length: {len(payload)}\r\n\r\n"
+                    ).encode("latin-1")
+                    + payload
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> None:
+        """Accept connections until cancelled."""
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logger.info(f"serving {sorted(self.batchers)} on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for batcher in self.batchers.values():
+                await batcher.close()
+
+    def serve_forever(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> None:
+        asyncio.run(self.serve(host, port))
+
+
+def _json_default(value: Any) -> Any:
+    """Convert numpy scalars in topic records."""
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value)} is not JSON serializable")
+
+
+if __name__ == "__main__":
+
+    description = "serve explicit topic models over HTTP"
+    parser = argconfig.get_argparser(description, ["loglevel"])
+    parser.add_argument("model_paths", nargs="+", help="model directories written by task_15")
+    parser.add_argument("--bundle_name", default="bundle", help="bundle inside each model path")
+    parser.add_argument("--stem_table", default=None, help="stem-table.tsv written by task_01")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", default=DEFAULT_PORT, type=int)
+    parser.add_argument("--max_batch_size", default=DEFAULT_MAX_BATCH_SIZE, type=int)
+    parser.add_argument("--max_wait_ms", default=DEFAULT_MAX_WAIT_MS, type=float)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
+    logger.info(f"args={args}")
+
+    server = QueryServer.from_model_paths(
+        args.model_paths,
+        bundle_name=args.bundle_name,
+        stem_table_path=args.stem_table,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+    )
+    server.serve_forever(args.host, args.port)
@@ -0,0 +1,108 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""Corpus counts sharded over a process pool.
+
+A jsonl corpus is split into byte ranges of whole pages (see `work_units`).
+Each worker decodes and tokenizes the pages of a range into counts with a
+vocabulary of their own. The shards are then stacked in file order on the
+union of their vocabularies (see `base_counts.merge_counts`). Vocabulary
+limits are applied only after the merge (see `base_counts.fit_subset`), so
+`fit_count_vectorizer` returns exactly what `CountVectorizer.fit_transform`
+returns for the whole corpus.
+
+A compressed corpus can not be split and is counted by a single worker.
+"""
+from contextlib import ExitStack
+import json
+from multiprocessing import Pool
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import scipy.sparse
+from sklearn.feature_extraction.text import CountVectorizer
+
+from wikiwhatsthis.base_counts import (
+    ParagraphCounts,
+    fit_base_counts,
+    fit_paragraph_counts,
+    fit_subset,
+    merge_counts,
+    merge_paragraph_counts,
+    scope_text,
+)
+from wikiwhatsthis.work_units import (
+    DEFAULT_UNIT_BYTES,
+    UnitResult,
+    WorkProgress,
+    WorkUnit,
+    iter_unit_lines,
+    plan_work_units,
+)
+
+
+def _count_unit(args: Tuple[Dict, Optional[str], WorkUnit]) -> Tuple[UnitResult, Any]:
+    """Count the pages of one unit in `scope`, or their paragraphs if `scope` is None."""
+    cv_args, scope, unit = args
+    start = time.perf_counter()
+    pages = map(json.loads, iter_unit_lines(unit))
+    counts: Any
+    if scope is None:
+        counts = fit_paragraph_counts(cv_args, pages)
+        num_pages = len(counts.page_offsets) - 1
+    else:
+        counts = fit_base_counts(cv_args, (scope_text(page, scope) for page in pages))
+        num_pages = counts[1].shape[0]
+    return UnitResult(unit, os.getpid(), time.perf_counter() - start, num_pages), counts
+
+
+def _map_units(
+    cv_args: Dict, corpus_path: str, scope: Optional[str], workers: int, unit_bytes: int
+) -> List[Any]:
+    """Return the counts of every unit of `corpus_path`, in file order."""
+    units = plan_work_units([corpus_path], unit_bytes)
+    progress = WorkProgress(units)
+    tasks = [(cv_args, scope, unit) for unit in units]
+    shards = {}
+    with ExitStack() as stack:
+        if workers > 1:
+            pool = stack.enter_context(Pool(workers))
+            results = pool.imap_unordered(_count_unit, tasks)
+        else:
+            results = map(_count_unit, tasks)
+        for result, counts in results:
+            progress.observe(result)
+            shards[result.unit.unit_index] = counts
+    return [shards[unit_index] for unit_index in sorted(shards)]
+
+
+def count_corpus_paragraphs(
+    cv_args: Dict, corpus_path: str, workers: int = 1, unit_bytes: int = DEFAULT_UNIT_BYTES
+) -> ParagraphCounts:
+    """Return `fit_paragraph_counts` of the pages in `corpus_path`."""
+    shards = _map_units(cv_args, corpus_path, None, workers, unit_bytes)
+    return merge_paragraph_counts(shards)
+
+
+def count_corpus_scope(
+    cv_args: Dict,
+    corpus_path: str,
+    scope: str,
+    workers: int = 1,
+    unit_bytes: int = DEFAULT_UNIT_BYTES,
+) -> Tuple[np.ndarray, scipy.sparse.csr_matrix]:
+    """Return `fit_base_counts` of the `scope` text of the pages in `corpus_path`."""
+    shards = _map_units(cv_args, corpus_path, scope, workers, unit_bytes)
+    return merge_counts(shards)
+
+
+def fit_count_vectorizer(
+    cv_args: Dict,
+    corpus_path: str,
+    scope: str,
+    workers: int = 1,
+    unit_bytes: int = DEFAULT_UNIT_BYTES,
+) -> Tuple[CountVectorizer, scipy.sparse.csr_matrix]:
+    """Return a `CountVectorizer` fit on the `scope` text of `corpus_path` and its counts."""
+    feature_names, xbase = count_corpus_scope(cv_args, corpus_path, scope, workers, unit_bytes)
+    return fit_subset(cv_args, feature_names, xbase, np.arange(xbase.shape[0]))
@@ -0,0 +1,209 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""Manifests that let pipeline stages skip outputs whose inputs did not change.
+
+Each stage keeps a `stage-manifest.json` in its output directory with one
+entry per output (a chunk file, a sample or a model). An entry records the
+fingerprints of the inputs, the parameters, a hash of the code that produced
+the output and the fingerprints of the outputs themselves. On a rerun an
+output is recomputed only if any of these changed or an output file is
+missing or was modified. Entries are saved as soon as an output is done, so a
+stage that dies halfway resumes where it stopped.
+
+Fingerprints are file size and modification time by default. With
+`hash_contents=True` they also hold a sha256 of the file contents and files
+are compared by size and sha256 only, so a file that was rewritten with the
+same bytes (e.g. by a rerun of the previous stage) is unchanged. A recorded
+sha256 is reused while the size and modification time of its file are the
+same, so only files that were written since are read.
+"""
+import ast
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, Optional, Sequence, Set
+
+from wikiwhatsthis import __version__
+
+
+MANIFEST_FILE_NAME = "stage-manifest.json"
+
+Fingerprint = Dict[str, Any]
+
+
+def file_fingerprint(
+    file_path: str, hash_contents: bool = False, previous: Optional[Fingerprint] = None
+) -> Fingerprint:
+    """Return the fingerprint of `file_path`, reusing the sha256 of an unchanged `previous`."""
+    stat = os.stat(file_path)
+    fingerprint: Fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if not hash_contents:
+        return fingerprint
+    if previous is not None and "sha256" in previous:
+        if (previous["size"], previous["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+            fingerprint["sha256"] = previous["sha256"]
+            return fingerprint
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as fp:
+        for block in iter(lambda: fp.read(2 ** 20), b""):
+            sha256.update(block)
+    fingerprint["sha256"] = sha256.hexdigest()
+    return fingerprint
+
+
+def same_file(current: Fingerprint, recorded: Fingerprint) -> bool:
+    """Compare by size and sha256 if both have one, otherwise by size and mtime."""
+    if "sha256" in current and "sha256" in recorded:
+        return (current["size"], current["sha256"]) == (recorded["size"], recorded["sha256"])
+    return (current["size"], current["mtime_ns"]) == (recorded["size"], recorded["mtime_ns"])
+
+
+def directory_files(dir_path: str) -> List[str]:
+    """Return the paths of all files below `dir_path`, sorted."""
+    return sorted(
+        os.path.join(root, file_name)
+        for root, _, file_names in os.walk(dir_path)
+        for file_name in file_names
+    )
+
+
+def _imported_names(source_path: str) -> Set[str]:
+    """Return the absolute module names imported by `source_path`, with `from` targets."""
+    with open(source_path, "rb") as fp:
+        tree = ast.parse(fp.read(), filename=source_path)
+    names: Set[str] = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module is not None and node.level == 0:
+            names.add(node.module)
+            # `from wikiwhatsthis import argconfig` imports a module
+            names.update(f"{node.module}.{alias.name}" for alias in node.names)
+    return names
+
+
+def stage_sources(script_path: str) -> List[str]:
+    """Return `script_path` and the package modules it imports, directly or not, sorted.
+
+    Modules are found by parsing the import statements of every module that
+    is reached, the rest of the environment is not hashed. Modules of the
+    package directory can be imported as `wikiwhatsthis.<name>` or as
+    top-level `<name>` (e.g. `bm25_transformer` by the task scripts).
+    """
+    package_path = os.path.dirname(os.path.abspath(__file__))
+    package_name = os.path.basename(package_path)
+
+    def package_module_path(name: str) -> Optional[str]:
+        parts = name.split(".")
+        if parts[0] == package_name:
+            parts = parts[1:]
+        if len(parts) != 1:
+            return None
+        module_path = os.path.join(package_path, f"{parts[0]}.py")
+        return module_path if os.path.exists(module_path) else None
+
+    sources: Set[str] = set()
+    pending = [os.path.abspath(script_path)]
+    while pending:
+        source_path = pending.pop()
+        if source_path in sources:
+            continue
+        sources.add(source_path)
+        for name in _imported_names(source_path):
+            if name == package_name:
+                pending.append(os.path.join(package_path, "__init__.py"))
+            module_path = package_module_path(name)
+            if module_path is not None:
+                pending.append(module_path)
+    return sorted(sources)
+
+
+def code_version(source_paths: Sequence[str]) -> str:
+    """Return the package version plus a hash of the source files that define a stage.
+
+    Stages pass `stage_sources(__file__)`.
+    """
+    sha256 = hashlib.sha256()
+    for source_path in source_paths:
+        with open(source_path, "rb") as fp:
+            sha256.update(fp.read())
+    return f"{__version__}+{sha256.hexdigest()[:16]}"
+
+
+class StageManifest:
+    def __init__(
+        self, manifest_path: str, hash_contents: bool = False, force: bool = False
+    ) -> None:
+        """Entries of the manifest at `manifest_path` (empty if it does not exist yet).
+
+        With `force`, every output is reported stale.
+        """
+        self.manifest_path = manifest_path
+        self.hash_contents = hash_contents
+        self.force = force
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as fp:
+                self.entries = json.load(fp)
+
+    def _fingerprints(
+        self, file_paths: Sequence[str], previous: Dict[str, Fingerprint]
+    ) -> Dict[str, Fingerprint]:
+        return {
+            path: file_fingerprint(path, self.hash_contents, previous.get(path))
+            for path in file_paths
+        }
+
+    def _unchanged(self, file_paths: Sequence[str], recorded: Dict[str, Fingerprint]) -> bool:
+        if set(file_paths) != set(recorded):
+            return False
+        for path in file_paths:
+            if not os.path.exists(path):
+                return False
+            # files recorded with a sha256 are compared by contents
+            hash_contents = self.hash_contents or "sha256" in recorded[path]
+            current = file_fingerprint(path, hash_contents, recorded[path])
+            if not same_file(current, recorded[path]):
+                return False
+            # a file rewritten with the same bytes is not read again after the next save
+            recorded[path] = current
+        return True
+
+    def is_fresh(self, key: str, input_paths: Sequence[str], params: Dict, code: str) -> bool:
+        """Return True if output `key` was recorded with the same inputs, params and code.
+
+        The recorded outputs must also still exist unchanged.
+        """
+        entry = self.entries.get(key)
+        if self.force or entry is None:
+            return False
+        # round trip through json so tuples compare equal to the stored lists
+        if entry["params"] != json.loads(json.dumps(params)) or entry["code"] != code:
+            return False
+        if not self._unchanged(input_paths, entry["inputs"]):
+            return False
+        return self._unchanged(list(entry["outputs"]), entry["outputs"])
+
+    def record(
+        self,
+        key: str,
+        input_paths: Sequence[str],
+        params: Dict,
+        code: str,
+        output_paths: Sequence[str],
+    ) -> None:
+        """Record that `output_paths` were computed from the inputs and save the manifest."""
+        previous = self.entries.get(key, {})
+        self.entries[key] = {
+            "inputs": self._fingerprints(input_paths, previous.get("inputs", {})),
+            "params": json.loads(json.dumps(params)),
+            "code": code,
+            # outputs were just written, so they are always read
+            "outputs": self._fingerprints(output_paths, {}),
+        }
+        self.save()
+
+    def save(self) -> None:
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(self.entries, fp, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
@@ -0,0 +1,81 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""Static pruning of low-impact postings.
+
+Most nonzeros of a BM25 topic-term matrix are small impacts of common terms
+that never move a topic into a query's top-n. Dropping them at training time
+gives smaller and faster models. The policies work on the posting list of
+each term (a column of xdocterm):
+
+    top_n       keep the `value` largest impacts of every term
+    percentile  drop impacts below the `value`-th percentile of their term
+    budget      keep the `value` largest impacts of the whole matrix
+
+Ties are broken by topic id so pruning is deterministic.
+"""
+import numpy as np
+import scipy.sparse
+
+
+PRUNING_POLICIES = ("top_n", "percentile", "budget")
+
+
+def prune_topic_term(
+    xdocterm: scipy.sparse.spmatrix, policy: str, value: float
+) -> scipy.sparse.csr_matrix:
+    """Return a copy of the (n_topics, n_terms) matrix `xdocterm` with postings pruned.
+
+    Parameters
+    ----------
+    xdocterm : sparse matrix of shape (n_topics, n_terms)
+        Non-negative impacts.
+    policy : str
+        One of `PRUNING_POLICIES`.
+    value : int or float
+        Postings kept per term (top_n), percentile in [0, 100] (percentile)
+        or total postings kept (budget).
+    """
+    if policy not in PRUNING_POLICIES:
+        raise ValueError(f"policy must be one of {PRUNING_POLICIES}")
+    postings = scipy.sparse.csr_matrix(xdocterm.T)
+    postings.sort_indices()
+    lengths = np.diff(postings.indptr).astype(np.int64)
+    term_ids = np.repeat(np.arange(postings.shape[0]), lengths)
+
+    if policy == "top_n":
+        order = _descending_order(postings, term_ids)
+        rank = np.empty(postings.nnz, dtype=np.int64)
+        rank[order] = np.arange(postings.nnz) - np.repeat(postings.indptr[:-1], lengths)
+        keep = rank < value
+    elif policy == "percentile":
+        if not 0 <= value <= 100:
+            raise ValueError("percentile must be in [0, 100]")
+        # cutoff is the lower percentile of each term, impacts tied with it are kept
+        order = _descending_order(postings, term_ids)
+        lower = np.floor(value / 100 * (lengths - 1)).astype(np.int64)
+        nonempty = lengths > 0
+        cutoff = np.full(postings.shape[0], np.inf)
+        cutoff[nonempty] = postings.data[
+            order[postings.indptr[:-1][nonempty] + (lengths - 1 - lower)[nonempty]]
+        ]
+        keep = postings.data >= cutoff[term_ids]
+    else:
+        keep = np.zeros(postings.nnz, dtype=bool)
+        if value > 0:
+            order = np.lexsort((postings.indices, -postings.data))
+            keep[order[: int(value)]] = True
+
+    pruned = scipy.sparse.csr_matrix(
+        (postings.data[keep], postings.indices[keep], _pruned_indptr(term_ids[keep], postings)),
+        shape=postings.shape,
+    )
+    return scipy.sparse.csr_matrix(pruned.T)
+
+
+def _descending_order(postings: scipy.sparse.csr_matrix, term_ids: np.ndarray) -> np.ndarray:
+    """Return the posting positions sorted by term, then descending impact, then topic id."""
+    return np.lexsort((postings.indices, -postings.data, term_ids))
+
+
+def _pruned_indptr(kept_term_ids: np.ndarray, postings: scipy.sparse.csr_matrix) -> np.ndarray:
+    counts = np.bincount(kept_term_ids, minlength=postings.shape[0])
+    return np.concatenate([[0], np.cumsum(counts)])
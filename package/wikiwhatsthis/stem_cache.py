@@ -0,0 +1,160 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""Bounded memoization of stemmer calls.
+
+Token frequencies in natural language are Zipfian, so almost every call to
+`SnowballStemmer.stem` repeats an earlier one. `CachedStemmer` keeps the most
+recently used results in an LRU cache and counts hits, misses and evictions.
+
+`StemTable` is the unbounded, persisted form: `task_01` stems every distinct
+token of a dump date once and saves the table next to its outputs, so later
+stem passes and query services can look stems up instead of recomputing them.
+"""
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Union
+
+from nltk.stem.snowball import SnowballStemmer
+
+
+DEFAULT_STEM_CACHE_SIZE = 1_000_000
+
+
+class StemTable:
+    def __init__(
+        self, stems: Optional[Dict[str, str]] = None, stemmer: Optional[SnowballStemmer] = None
+    ) -> None:
+        """Unbounded token to stem table, tokens missing from `stems` are stemmed once.
+
+        Stems added since the last `pop_new_stems` call are tracked so that
+        workers can hand only their new entries to a merge step.
+        """
+        self.stemmer = stemmer if stemmer is not None else SnowballStemmer("english")
+        self.stems: Dict[str, str] = dict(stems) if stems is not None else {}
+        self.new_stems: Dict[str, str] = {}
+
+    def stem(self, token: str) -> str:
+        stem = self.stems.get(token)
+        if stem is None:
+            stem = self._add(token)
+        return stem
+
+    def stem_tokens(self, tokens: List[str]) -> List[str]:
+        """Return the stems of `tokens`, stemming each distinct unknown token once."""
+        for token in set(tokens).difference(self.stems):
+            self._add(token)
+        return list(map(self.stems.__getitem__, tokens))
+
+    def _add(self, token: str) -> str:
+        stem = self.stemmer.stem(token)
+        self.stems[token] = stem
+        self.new_stems[token] = stem
+        return stem
+
+    def get(self, token: str) -> Optional[str]:
+        return self.stems.get(token)
+
+    def update(self, stems: Dict[str, str]) -> None:
+        self.stems.update(stems)
+
+    def discard(self, tokens: Iterable[str]) -> None:
+        for token in tokens:
+            self.stems.pop(token, None)
+
+    def pop_new_stems(self) -> Dict[str, str]:
+        new_stems, self.new_stems = self.new_stems, {}
+        return new_stems
+
+    def __len__(self) -> int:
+        return len(self.stems)
+
+    def save(self, file_path: str) -> None:
+        """Write the table as sorted `token<TAB>stem` lines."""
+        with open(file_path, "w", encoding="utf-8") as fp:
+            for token in sorted(self.stems):
+                fp.write(f"{token}\t{self.stems[token]}\n")
+
+    @classmethod
+    def load(cls, file_path: str, stemmer: Optional[SnowballStemmer] = None) -> "StemTable":
+        with open(file_path, "r", encoding="utf-8") as fp:
+            stems = dict(line.rstrip("\n").split("\t") for line in fp)
+        return cls(stems, stemmer)
+
+
+class CachedStemmer:
+    def __init__(
+        self,
+        stemmer: Optional[SnowballStemmer] = None,
+        maxsize: int = DEFAULT_STEM_CACHE_SIZE,
+        table: Optional[StemTable] = None,
+    ) -> None:
+        """Wrap `stemmer` (english snowball by default) with an LRU cache of `maxsize` entries.
+
+        Tokens in `table` are looked up there first and never use the cache.
+        """
+        self.stemmer = stemmer if stemmer is not None else SnowballStemmer("english")
+        self.maxsize = maxsize
+        self.table = table
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.table_hits = 0
+
+    def stem(self, token: str) -> str:
+        if self.table is not None:
+            stem = self.table.get(token)
+            if stem is not None:
+                self.table_hits += 1
+                return stem
+        stem = self._cache.get(token)
+        if stem is not None:
+            self.hits += 1
+            self._cache.move_to_end(token)
+            return stem
+        self.misses += 1
+        stem = self.stemmer.stem(token)
+        self._insert(token, stem)
+        return stem
+
+    def warm(self, tokens: Iterable[str]) -> None:
+        """Stem `tokens` into the cache without counting hits or misses."""
+        for token in tokens:
+            if token not in self._cache:
+                self._insert(token, self.stemmer.stem(token))
+
+    def _insert(self, token: str, stem: str) -> None:
+        self._cache[token] = stem
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.table_hits = 0
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        lookups = self.hits + self.misses
+        stats: Dict[str, Union[int, float]] = {
+            "size": len(self._cache),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+        if self.table is not None:
+            stats["table_size"] = len(self.table)
+            stats["table_hits"] = self.table_hits
+        return stats
+
+
+def cached_stemmer(stemmer: Union[SnowballStemmer, CachedStemmer]) -> CachedStemmer:
+    """Return `stemmer` if it is already cached, otherwise wrap it."""
+    if isinstance(stemmer, CachedStemmer):
+        return stemmer
+    return CachedStemmer(stemmer)
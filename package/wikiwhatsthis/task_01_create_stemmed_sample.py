@@ -2,24 +2,82 @@
 """Add stemmed words to plaintext chunks and filter sections.
 
 Can do all chunks at once with a machine with 64 cores and 256G RAM
+
+Chunk files are split into byte ranges that are scheduled largest first (see
+`work_units`), so a few large files do not leave most workers idle at the end.
+
+Decoding the link annotations is a large share of the json work, `orjson` is
+used for it when installed. Pages are still encoded with `json.dumps` so the
+output bytes do not depend on which decoder ran.
+
+Every distinct token is stemmed once per worker. The stems are merged into
+`stem-table.tsv` for the dump date, which seeds later runs and can be passed to
+`CachedStemmer` at query time.
+
+Input chunks may be gzip or zstd compressed, and `compression` selects the
+compression of the outputs (see `compressed_io`).
+
+With `write_token_store` the stems of every chunk file are also written as integer
+arrays to a `.tokens.npz` file next to it (see `token_store`).
 """
+from collections import Counter
+from functools import partial
 import json
 import logging
-from multiprocessing import Pool
 import os
 import re
-from typing import Callable, Dict, List, Union
+from typing import Callable, Dict, List, Optional, Union
 
 from nltk.stem.snowball import SnowballStemmer
 from sklearn.feature_extraction.text import CountVectorizer
 
 from wikiwhatsthis import argconfig
 from wikiwhatsthis import patterns
+from wikiwhatsthis.compressed_io import open_text, remove_other_compressions, with_compression
+from wikiwhatsthis.stage_manifest import (
+    MANIFEST_FILE_NAME,
+    StageManifest,
+    code_version,
+    stage_sources,
+)
+from wikiwhatsthis.stem_cache import CachedStemmer, StemTable
+from wikiwhatsthis.token_store import (
+    TokenStore,
+    TokenStoreWriter,
+    concatenate_stores,
+    token_store_path,
+)
+from wikiwhatsthis.work_units import (
+    DEFAULT_UNIT_BYTES,
+    WorkUnit,
+    iter_unit_lines,
+    part_path,
+    plan_work_units,
+    run_work_units,
+)
 
 
 logger = logging.getLogger(__name__)
 
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# token -> stem table of the dump date, written next to the snowball chunks
+STEM_TABLE_FILE_NAME = "stem-table.tsv"
+
+# stem table of the pool workers, loaded by `main` before the pool forks so
+# the workers share one copy instead of each reading the whole file
+_worker_stem_table: Optional[StemTable] = None
+# number of stems in the loaded table, the others were added by the worker
+_worker_base_size = 0
+# a worker past this many added stems drops those of each further unit
+MAX_WORKER_NEW_STEMS = 1_000_000
+
+
 FORBIDDEN_SECTIONS = frozenset(
     [
         "see also",  # citation-like
@@ -60,6 +118,21 @@ FORBIDDEN_SECTIONS = frozenset(
 )
 
 
+def decode_page(line: Union[str, bytes]) -> Dict:
+    """Decode one page line, with `orjson` if it is installed.
+
+    Both decoders give the same page for json lines with integers that fit in
+    64 bits, which holds for page ids and anchor offsets.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # e.g. lone surrogates or NaN, which the json module accepts
+            pass
+    return json.loads(line)
+
+
 def filter_sections(page: Dict) -> Dict:
     page["paragraphs"] = [
         para
@@ -69,35 +142,116 @@ def filter_sections(page: Dict) -> Dict:
     return page
 
 
-def add_stems(page: Dict, stemmer: SnowballStemmer, tokenizer: Callable[[str], List[str]]) -> Dict:
+def add_stems(
+    page: Dict,
+    stemmer: Union[SnowballStemmer, CachedStemmer, StemTable],
+    tokenizer: Callable[[str], List[str]],
+) -> Dict:
     for paragraph in page["paragraphs"]:
-        paragraph["plaintext_snowball"] = " ".join(
-            [stemmer.stem(tok) for tok in tokenizer(paragraph["plaintext"])]
-        )
+        tokens = tokenizer(paragraph["plaintext"])
+        if isinstance(stemmer, StemTable):
+            stems = stemmer.stem_tokens(tokens)
+        else:
+            stems = list(map(stemmer.stem, tokens))
+        paragraph["plaintext_snowball"] = " ".join(stems)
     return page
 
 
-def parse_file(args: Dict) -> None:
+def load_worker_stem_table(stem_table_path: Optional[str]) -> StemTable:
+    """Set the stem table of the workers, seeded from `stem_table_path` if that exists."""
+    global _worker_stem_table, _worker_base_size
+    if stem_table_path is not None and os.path.exists(stem_table_path):
+        _worker_stem_table = StemTable.load(stem_table_path)
+    else:
+        _worker_stem_table = StemTable()
+    _worker_base_size = len(_worker_stem_table)
+    return _worker_stem_table
+
 
-    stemmer = SnowballStemmer("english")
-    cv = CountVectorizer()
-    tokenizer = cv.build_tokenizer()
-    out_file_name = os.path.basename(args["lat_file_path"])
-    out_file_path = os.path.join(args["out_dump_paths"]["snbl"], out_file_name)
-    logger.info("parsing {}".format(args["lat_file_path"]))
-    with open(args["lat_file_path"], "r") as ifp, open(out_file_path, "w") as ofp:
-        for line in ifp:
-            page = json.loads(line)
+def parse_unit(
+    unit: WorkUnit,
+    out_path: str,
+    stem_table_path: Optional[str] = None,
+    stem_parts_path: Optional[str] = None,
+    write_token_store: bool = False,
+) -> int:
+    """Filter sections and add stems to the pages of `unit`, return the number of pages.
+
+    Workers use the `StemTable` that `main` loaded before forking them (a
+    worker that was not forked loads `stem_table_path` itself). The stems the
+    unit added are written to `stem_parts_path`, and once a worker added
+    more than `MAX_WORKER_NEW_STEMS` they are also dropped from its table.
+    With `write_token_store` the stems also go to the token store of `out_path`.
+    """
+    stem_table = _worker_stem_table
+    if stem_table is None:
+        stem_table = load_worker_stem_table(stem_table_path)
+    tokenizer = CountVectorizer().build_tokenizer()
+    writer = TokenStoreWriter() if write_token_store else None
+    num_pages = 0
+    with open_text(out_path, "w") as ofp:
+        for line in iter_unit_lines(unit):
+            page = decode_page(line)
             page = filter_sections(page)
-            page = add_stems(page, stemmer, tokenizer)
+            page = add_stems(page, stem_table, tokenizer)
             ofp.write("{}\n".format(json.dumps(page)))
+            if writer is not None:
+                writer.add_page(
+                    page["page_id"],
+                    [
+                        (para["section_idx"], para["plaintext_snowball"].split())
+                        for para in page["paragraphs"]
+                    ],
+                )
+            num_pages += 1
+    if writer is not None:
+        writer.to_store().save(token_store_path(out_path))
+    new_stems = StemTable(stem_table.pop_new_stems())
+    if stem_parts_path is not None:
+        new_stems.save(os.path.join(stem_parts_path, os.path.basename(out_path) + ".tsv"))
+    if len(stem_table) - _worker_base_size > MAX_WORKER_NEW_STEMS:
+        # they are merged into the stem table file by `main`
+        stem_table.discard(new_stems.stems)
+    logger.debug(f"{unit}: {len(new_stems)} new stems, {len(stem_table)} in worker table")
+    return num_pages
+
+
+def merge_stem_tables(stem_table_path: str, stem_parts_path: str) -> StemTable:
+    """Merge the unit stem files in `stem_parts_path` into the table at `stem_table_path`."""
+    if os.path.exists(stem_table_path):
+        stem_table = StemTable.load(stem_table_path)
+    else:
+        stem_table = StemTable()
+    for file_name in sorted(os.listdir(stem_parts_path)):
+        file_path = os.path.join(stem_parts_path, file_name)
+        stem_table.update(StemTable.load(file_path).stems)
+        os.remove(file_path)
+    stem_table.save(stem_table_path)
+    return stem_table
+
+
+def merge_unit_token_stores(out_path: str, num_units: int) -> None:
+    """Concatenate the token stores of the `num_units` units of `out_path` and remove them."""
+    unit_store_paths = [
+        token_store_path(part_path(out_path, unit_index)) for unit_index in range(num_units)
+    ]
+    store = concatenate_stores([TokenStore.load(path) for path in unit_store_paths])
+    store.save(token_store_path(out_path))
+    for unit_store_path in unit_store_paths:
+        os.remove(unit_store_path)
 
 
 def main(
     wp_yyyymmdd: str,
     data_path: str = argconfig.DEFAULT_KWNLP_DATA_PATH,
     workers: int = argconfig.DEFAULT_KWNLP_WORKERS,
+    unit_bytes: int = DEFAULT_UNIT_BYTES,
+    force: bool = False,
+    hash_contents: bool = True,
+    compression: str = "",
+    write_token_store: bool = False,
 ) -> None:
+    global _worker_stem_table
 
     in_dump_paths = {
         "lat": os.path.join(
@@ -112,7 +266,13 @@ def main(
             "wiki-whats-this",
             f"link-annotated-text-snowball-chunks",
         ),
+        "stem_parts": os.path.join(
+            data_path, f"wikipedia-derived-{wp_yyyymmdd}", "wiki-whats-this", "stem-table-parts"
+        ),
     }
+    stem_table_path = os.path.join(
+        data_path, f"wikipedia-derived-{wp_yyyymmdd}", "wiki-whats-this", STEM_TABLE_FILE_NAME
+    )
 
     for name, path in in_dump_paths.items():
         logger.info(f"{name} path: {path}")
@@ -129,24 +289,89 @@ def main(
     sorted_matches = sorted(non_null_matches, key=lambda x: int(x.groupdict()["pageno_start"]))
     sorted_file_names = [match.string for match in sorted_matches]
 
-    mp_args = []
-    for file_name in sorted_file_names:
-        file_path = os.path.join(in_dump_paths["lat"], file_name)
-        mp_args.append(
-            {
-                "wp_yyyymmdd": wp_yyyymmdd,
-                "lat_file_path": file_path,
-                "out_dump_paths": out_dump_paths,
-            }
+    # skip chunk files whose input, sections filter and code did not change
+    manifest = StageManifest(
+        os.path.join(out_dump_paths["snbl"], MANIFEST_FILE_NAME),
+        hash_contents=hash_contents,
+        force=force,
+    )
+    params = {
+        "forbidden_sections": sorted(FORBIDDEN_SECTIONS),
+        "compression": compression,
+        "token_store": write_token_store,
+    }
+    code = code_version(stage_sources(__file__))
+    stale_file_names = [
+        file_name
+        for file_name in sorted_file_names
+        if not manifest.is_fresh(
+            file_name, [os.path.join(in_dump_paths["lat"], file_name)], params, code
         )
-    with Pool(workers) as p:
-        p.map(parse_file, mp_args)
+    ]
+    logger.info(f"{len(stale_file_names)} of {len(sorted_file_names)} chunk files are stale")
+
+    in_file_paths = [
+        os.path.join(in_dump_paths["lat"], file_name) for file_name in stale_file_names
+    ]
+    out_file_paths = [
+        with_compression(os.path.join(out_dump_paths["snbl"], file_name), compression)
+        for file_name in stale_file_names
+    ]
+    for out_file_path in out_file_paths:
+        # downstream tasks would read both copies
+        remove_other_compressions(out_file_path)
+        if not write_token_store and os.path.exists(token_store_path(out_file_path)):
+            os.remove(token_store_path(out_file_path))
+    num_units = Counter(unit.file_index for unit in plan_work_units(in_file_paths, unit_bytes))
+
+    def record_file(file_index: int) -> None:
+        output_paths = [out_file_paths[file_index]]
+        if write_token_store:
+            merge_unit_token_stores(out_file_paths[file_index], num_units[file_index])
+            output_paths.append(token_store_path(out_file_paths[file_index]))
+        manifest.record(
+            stale_file_names[file_index],
+            [in_file_paths[file_index]],
+            params,
+            code,
+            output_paths,
+        )
+
+    load_worker_stem_table(stem_table_path)
+    unit_function = partial(
+        parse_unit,
+        stem_table_path=stem_table_path,
+        stem_parts_path=out_dump_paths["stem_parts"],
+        write_token_store=write_token_store,
+    )
+    run_work_units(
+        unit_function,
+        in_file_paths,
+        out_file_paths,
+        workers,
+        unit_bytes=unit_bytes,
+        on_file_done=record_file,
+    )
+    # merge_stem_tables reads the table again
+    _worker_stem_table = None
+
+    stem_table = merge_stem_tables(stem_table_path, out_dump_paths["stem_parts"])
+    logger.info(f"wrote {len(stem_table)} stems to {stem_table_path}")
 
 
 if __name__ == "__main__":
 
     description = "filter sections and stem tokens"
-    arg_names = ["wp_yyyymmdd", "data_path", "workers", "loglevel"]
+    arg_names = [
+        "wp_yyyymmdd",
+        "data_path",
+        "workers",
+        "loglevel",
+        "force",
+        "fingerprints",
+        "compression",
+        "token_store",
+    ]
     parser = argconfig.get_argparser(description, arg_names)
 
     args = parser.parse_args()
@@ -157,4 +382,8 @@ if __name__ == "__main__":
         args.wp_yyyymmdd,
         data_path=args.data_path,
         workers=args.workers,
+        force=args.force,
+        hash_contents=args.fingerprints == "content",
+        compression=args.compression,
+        write_token_store=args.token_store,
     )
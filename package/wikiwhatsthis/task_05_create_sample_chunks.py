@@ -1,48 +1,172 @@
 # Copyright 2020-present Kensho Technologies, LLC.
-"""Create different samples from stemmed/section filtered chunks."""
+"""Create different samples from stemmed/section filtered chunks.
+
+Every chunk file is read once. Each page has a bitmask of the samples it
+belongs to, and its line is written to the chunk file of each of those
+samples. Page ids and bitmasks are sorted arrays, so a batch of lines is
+looked up with one binary search and article rows are selected by position.
+Chunk files are routed in parallel.
+
+Samples are defined in `sample_masks.json`, which is part of the manifest
+params rather than the code. Chunk files whose input, article table, sample
+definitions and code are unchanged since the last run (see `stage_manifest`)
+are skipped. Inputs may be compressed and `compression` selects the
+compression of the outputs (see `compressed_io`).
+"""
+from contextlib import ExitStack
+from itertools import islice
 import json
 import logging
+from multiprocessing import Pool
+import operator
 import os
 import re
-from typing import Dict, List, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
+import numpy as np
 import pandas as pd
 
 from wikiwhatsthis import argconfig
 from wikiwhatsthis import patterns
+from wikiwhatsthis.compressed_io import (
+    iter_lines,
+    open_binary,
+    open_text,
+    remove_other_compressions,
+    with_compression,
+)
+from wikiwhatsthis.stage_manifest import (
+    MANIFEST_FILE_NAME,
+    StageManifest,
+    code_version,
+    stage_sources,
+)
 
 
 logger = logging.getLogger(__name__)
 
 
-def create_sample(args: Dict) -> None:
-
-    keep_page_ids = set(args["df_articles"]["page_id"].values)
-    for match in args["lat_matches"]:
-        mgd = match.groupdict()
-        parsed_page_ids = []
-        in_file_path = os.path.join(args["lat_file_path"], match.string)
-        out_file_name = "kwnlp-{}-{}-link-annotated-text{}-{}-{}.jsonl".format(
-            mgd["wiki"], mgd["wp_yyyymmdd"], mgd["fileno"], mgd["page_signature"], args["mask_name"]
-        )
-        out_file_path = os.path.join(args["out_file_path"], out_file_name)
-        logger.info(f"writing {out_file_path}")
-        with open(in_file_path, "r") as ifp, open(out_file_path, "w") as ofp:
-            for line in ifp:
-                page = json.loads(line)
-                if page["page_id"] in keep_page_ids:
-                    ofp.write(line)
-                    parsed_page_ids.append(page["page_id"])
-
-        # reorder df_articles to match order in link annotated text file
-        df = args["df_articles"].set_index("page_id").loc[parsed_page_ids]
-        assert df.shape[0] == len(parsed_page_ids)
-        out_file_name = "kwnlp-{}-{}-article{}-{}-{}.csv".format(
-            mgd["wiki"], mgd["wp_yyyymmdd"], mgd["fileno"], mgd["page_signature"], args["mask_name"]
-        )
-        out_file_path = os.path.join(args["out_file_path"], out_file_name)
-        logger.info(f"writing {out_file_path}")
-        df.to_csv(out_file_path)
+# manifest of all sample chunk directories, kept in the wiki-whats-this directory
+SAMPLE_MANIFEST_FILE_NAME = f"sample-chunks-{MANIFEST_FILE_NAME}"
+# task_01 writes the page id first, so most lines need not be decoded to route them
+PAGE_ID_PATTERN = re.compile(rb'\{"page_id": (-?\d+)[,}]')
+# lines whose page ids are looked up at once
+ROUTE_BATCH_LINES = 10_000
+# bits in a page mask
+MAX_SAMPLES = 32
+# sample name -> [column, operator, value] conditions that a base article meets
+SAMPLE_MASKS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample_masks.json")
+MASK_OPERATORS = {"==": operator.eq, ">=": operator.ge}
+
+SampleMasks = Dict[str, List[List[Any]]]
+
+
+# route state shared by the pool workers (set by `_init_router`)
+_router: Dict = {}
+
+
+def _init_router(router: Dict) -> None:
+    global _router
+    _router = router
+
+
+def page_id_of(line: bytes) -> int:
+    """Return the page id of a page line, without decoding it if it comes first."""
+    match = PAGE_ID_PATTERN.match(line)
+    if match is not None:
+        return int(match.group(1))
+    return json.loads(line)["page_id"]
+
+
+def sample_file_paths(
+    match: re.Match, out_dir_paths: Dict[str, str], compression: str
+) -> Dict[str, Tuple[str, str]]:
+    """Return the (jsonl, csv) output paths of chunk file `match` for each sample."""
+    mgd = match.groupdict()
+    file_paths = {}
+    for mask_name, out_dir_path in out_dir_paths.items():
+        file_names = [
+            "kwnlp-{}-{}-{}{}-{}-{}.{}".format(
+                mgd["wiki"],
+                mgd["wp_yyyymmdd"],
+                content,
+                mgd["fileno"],
+                mgd["page_signature"],
+                mask_name,
+                extension,
+            )
+            for content, extension in [("link-annotated-text", "jsonl"), ("article", "csv")]
+        ]
+        jsonl_path, csv_path = [
+            with_compression(os.path.join(out_dir_path, file_name), compression)
+            for file_name in file_names
+        ]
+        file_paths[mask_name] = (jsonl_path, csv_path)
+    return file_paths
+
+
+def lookup_pages(page_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the row of each page in the sorted page table and its sample bitmask.
+
+    Pages that are not base articles get bitmask 0.
+    """
+    table_ids = _router["page_ids"]
+    if not len(table_ids):
+        return np.zeros(len(page_ids), dtype=np.int64), np.zeros(len(page_ids), dtype=np.uint32)
+    rows = np.searchsorted(table_ids, page_ids)
+    rows = np.minimum(rows, len(table_ids) - 1)
+    found = table_ids[rows] == page_ids
+    bits = np.where(found, _router["page_bits"][rows], 0)
+    return rows, bits
+
+
+def route_chunk(args: Dict) -> Dict:
+    """Write the lines of one chunk file to the jsonl of every sample that holds the page.
+
+    Each sample also gets the rows of its pages, in the order of the chunk file.
+    Lines are looked up in batches of `ROUTE_BATCH_LINES`.
+    """
+    # bit i of a page mask is the i-th sample
+    mask_names = _router["mask_names"]
+    sample_rows: Dict[str, List[np.ndarray]] = {mask_name: [] for mask_name in mask_names}
+    with ExitStack() as stack:
+        ofps = [
+            stack.enter_context(open_binary(args["file_paths"][mask_name][0], "wb"))
+            for mask_name in mask_names
+        ]
+        lines = iter_lines(args["in_file_path"])
+        for batch in iter(lambda: list(islice(lines, ROUTE_BATCH_LINES)), []):
+            page_ids = np.fromiter(map(page_id_of, batch), dtype=np.int64, count=len(batch))
+            rows, bits = lookup_pages(page_ids)
+            for bit, (mask_name, ofp) in enumerate(zip(mask_names, ofps)):
+                (selected,) = np.nonzero(bits >> bit & 1)
+                ofp.writelines(batch[i] for i in selected)
+                sample_rows[mask_name].append(rows[selected])
+
+    df_articles = _router["df_articles"]
+    num_pages = {}
+    for mask_name in mask_names:
+        rows = np.concatenate(sample_rows[mask_name]) if sample_rows[mask_name] else []
+        # rows in the order of the link annotated text file
+        with open_text(args["file_paths"][mask_name][1], "w") as fp:
+            df_articles.iloc[rows].to_csv(fp)
+        num_pages[mask_name] = len(rows)
+    return {"key": args["key"], "num_pages": num_pages}
+
+
+def page_mask_bits(page_ids: np.ndarray, masks: Dict[str, pd.Series]) -> np.ndarray:
+    """Return a bitmask per page with bit i set if the page is in the i-th sample.
+
+    `page_ids` must be sorted and unique so pages can be found with a binary search.
+    """
+    if len(masks) > MAX_SAMPLES:
+        raise ValueError(f"at most {MAX_SAMPLES} samples fit in a page mask")
+    if np.any(np.diff(page_ids) <= 0):
+        raise ValueError("page_ids must be sorted and unique")
+    bits = np.zeros(len(page_ids), dtype=np.uint32)
+    for bit, mask in enumerate(masks.values()):
+        bits |= mask.to_numpy(dtype=bool).astype(np.uint32) << np.uint32(bit)
+    return bits
 
 
 def create_df_base_articles(df_articles: pd.DataFrame) -> pd.DataFrame:
@@ -61,13 +185,59 @@ def create_df_base_articles(df_articles: pd.DataFrame) -> pd.DataFrame:
     mask_base = (
         mask_17442446 & mask_14795564 & mask_18340514 & mask_wikidata & mask_list & mask_disa
     )
-    return df_articles[mask_base].copy()
+    # boolean indexing already copies
+    return df_articles[mask_base]
+
+
+def load_sample_masks(file_path: str = SAMPLE_MASKS_PATH) -> SampleMasks:
+    with open(file_path, "r") as fp:
+        return json.load(fp)
+
+
+def create_masks(
+    df_base_articles: pd.DataFrame, sample_masks: Optional[SampleMasks] = None
+) -> Dict[str, pd.Series]:
+    """Return the boolean row mask of each sample of the base articles.
+
+    A sample keeps the rows that meet all of its conditions, so a sample
+    without conditions keeps every row. `sample_masks` defaults to
+    `sample_masks.json`.
+    """
+    if sample_masks is None:
+        sample_masks = load_sample_masks()
+    masks = {}
+    for mask_name, conditions in sample_masks.items():
+        mask = pd.Series(True, index=df_base_articles.index)
+        for column, op, value in conditions:
+            if op not in MASK_OPERATORS:
+                raise ValueError(f"operator must be one of {list(MASK_OPERATORS)}, got {op}")
+            mask &= MASK_OPERATORS[op](df_base_articles[column], value)
+        masks[mask_name] = mask
+    return masks
+
+
+def create_router(
+    df_base_articles: pd.DataFrame, sample_masks: Optional[SampleMasks] = None
+) -> Dict:
+    """Return the state `route_chunk` needs, with the article rows sorted by page id."""
+    df_articles = df_base_articles.set_index("page_id").sort_index()
+    masks = create_masks(df_articles, sample_masks)
+    page_ids = df_articles.index.to_numpy(dtype=np.int64)
+    return {
+        "mask_names": list(masks),
+        "page_ids": page_ids,
+        "page_bits": page_mask_bits(page_ids, masks),
+        "df_articles": df_articles,
+    }
 
 
 def main(
     wp_yyyymmdd: str,
     data_path: str = argconfig.DEFAULT_KWNLP_DATA_PATH,
     workers: int = argconfig.DEFAULT_KWNLP_WORKERS,
+    force: bool = False,
+    hash_contents: bool = True,
+    compression: str = "",
 ) -> None:
 
     # set data paths
@@ -110,69 +280,68 @@ def main(
     logger.info("creating base article dataframe")
     df_base_articles = create_df_base_articles(df_articles)
 
-    # create mp arguments for each mask
+    # one bit per sample, rows sorted by page id
     # ============================================================
-    mp_args = {}
-
-    mask_base = df_base_articles["page_id"] == df_base_articles["page_id"]
-    mask_feat = df_base_articles["tmpl_featured_article"] == 1
-    mask_good = df_base_articles["tmpl_good_article"] == 1 | mask_feat
-
-    mask_views50 = df_base_articles["views"] >= 50
-    mask_views500 = df_base_articles["views"] >= 500
-    mask_views5000 = df_base_articles["views"] >= 5000
-
-    mask_inlinks10 = df_base_articles["in_link_count"] >= 10
-    mask_inlinks20 = df_base_articles["in_link_count"] >= 20
-    mask_inlinks40 = df_base_articles["in_link_count"] >= 40
-
-    mask_fidu = mask_views50 & mask_inlinks10
-    mask_small = mask_views500 & mask_inlinks20
-    mask_mini = mask_views5000 & mask_inlinks40
-
-    masks = {
-        "feat": mask_feat,
-        "base": mask_base,
-        "good": mask_good,
-        "views50": mask_views50,
-        "views500": mask_views500,
-        "views5000": mask_views5000,
-        "inlinks10": mask_inlinks10,
-        "inlinks20": mask_inlinks20,
-        "inlinks40": mask_inlinks40,
-        "fidu": mask_fidu,
-        "small": mask_small,
-        "mini": mask_mini,
-    }
-
-    # write all samples
+    sample_masks = load_sample_masks()
+    router = create_router(df_base_articles, sample_masks)
+    mask_names = router["mask_names"]
+    # the router holds the only copy the workers need
+    del df_articles, df_base_articles
+
+    out_dir_paths = {}
+    for mask_name in mask_names:
+        out_dir_path = os.path.join(wiki_whats_this_path, f"link-annotated-text-{mask_name}-chunks")
+        os.makedirs(out_dir_path, exist_ok=True)
+        logger.info(f"creating path: {out_dir_path}")
+        out_dir_paths[mask_name] = out_dir_path
+
+    # route every chunk file once, skipping those with fresh outputs
     # ============================================================
-    for mask_name, mask in masks.items():
-        out_file_path = os.path.join(
-            wiki_whats_this_path, f"link-annotated-text-{mask_name}-chunks"
+    manifest = StageManifest(
+        os.path.join(wiki_whats_this_path, SAMPLE_MANIFEST_FILE_NAME),
+        hash_contents=hash_contents,
+        force=force,
+    )
+    # editing a sample definition reroutes every chunk without being a code change
+    params = {"samples": sample_masks, "compression": compression}
+    code = code_version(stage_sources(__file__))
+    mp_args = []
+    for match in sorted_lat_matches:
+        in_file_path = os.path.join(lat_file_path, match.string)
+        if manifest.is_fresh(match.string, [in_file_path, art_file_path], params, code):
+            continue
+        file_paths = sample_file_paths(match, out_dir_paths, compression)
+        for jsonl_path, csv_path in file_paths.values():
+            remove_other_compressions(jsonl_path)
+            remove_other_compressions(csv_path)
+        mp_args.append(
+            {"key": match.string, "in_file_path": in_file_path, "file_paths": file_paths}
         )
-        os.makedirs(out_file_path, exist_ok=True)
-        logger.info(f"creating path: {out_file_path}")
-        mp_args[mask_name] = {
-            "mask_name": mask_name,
-            "df_articles": df_base_articles[mask].copy(),
-            "lat_matches": sorted_lat_matches,
-            "lat_file_path": lat_file_path,
-            "art_file_path": art_file_path,
-            "out_file_path": out_file_path,
-        }
-        create_sample(mp_args[mask_name])
+    logger.info(f"routing {len(mp_args)} of {len(sorted_lat_matches)} chunk files")
 
-
-#    sys.exit(1)
-#    with Pool(workers) as p:
-#        p.map(parse_file, mp_args)
+    args_by_key = {args["key"]: args for args in mp_args}
+    with Pool(workers, initializer=_init_router, initargs=(router,)) as p:
+        for result in p.imap_unordered(route_chunk, mp_args):
+            args = args_by_key[result["key"]]
+            logger.info(f"routed {args['in_file_path']}: {result['num_pages']}")
+            output_paths = [path for paths in args["file_paths"].values() for path in paths]
+            manifest.record(
+                args["key"], [args["in_file_path"], art_file_path], params, code, output_paths
+            )
 
 
 if __name__ == "__main__":
 
     description = "create model samples"
-    arg_names = ["wp_yyyymmdd", "data_path", "workers", "loglevel"]
+    arg_names = [
+        "wp_yyyymmdd",
+        "data_path",
+        "workers",
+        "loglevel",
+        "force",
+        "fingerprints",
+        "compression",
+    ]
     parser = argconfig.get_argparser(description, arg_names)
 
     args = parser.parse_args()
@@ -183,4 +352,7 @@ if __name__ == "__main__":
         args.wp_yyyymmdd,
         data_path=args.data_path,
         workers=args.workers,
+        force=args.force,
+        hash_contents=args.fingerprints == "content",
+        compression=args.compression,
     )
@@ -1,19 +1,62 @@
 # Copyright 2020-present Kensho Technologies, LLC.
-"""Collect chunks."""
+"""Collect chunks.
+
+The chunk files of each sample are concatenated byte for byte. When a chunk
+already has the output compression its bytes are copied by the kernel
+(`os.copy_file_range`, falling back to `os.sendfile`), otherwise it is
+recompressed block by block. Article CSVs are copied the same way, skipping
+the header of every chunk after the first. Samples are collected
+concurrently in threads, since the copies do not hold the GIL.
+
+Next to each collected jsonl file goes a `.offsets.npy` array with the byte
+offset of every line in the uncompressed jsonl, for random access (unless
+`write_offsets` is off). Offsets of recompressed chunks are taken from the
+blocks on their way to the output. Chunks copied by the kernel never pass
+through user space, so their offsets take one more (decompressing) read of
+the chunk, which is usually served from the page cache right after the copy.
+
+A sample is skipped if its chunk files are unchanged since the last run (see
+`stage_manifest`). By default files are compared by contents, so a sample
+whose chunks task_05 rewrote with the same bytes is not collected again. Chunks may be compressed, and `compression` selects the
+compression of the collected files (see `compressed_io`).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import errno
 import logging
 import os
 import re
-from typing import List, Union
+from typing import BinaryIO, List, Optional, Sequence, Union
 
-import pandas as pd
+import numpy as np
 
 from wikiwhatsthis import argconfig
 from wikiwhatsthis import patterns
+from wikiwhatsthis.compressed_io import (
+    compressed_writer,
+    compression_of,
+    open_binary,
+    remove_other_compressions,
+    strip_compression,
+    with_compression,
+)
+from wikiwhatsthis.stage_manifest import (
+    MANIFEST_FILE_NAME,
+    StageManifest,
+    code_version,
+    stage_sources,
+)
 
 
 logger = logging.getLogger(__name__)
 
 
+COPY_BLOCK_SIZE = 16 * 2 ** 20
+# errors of copy_file_range and sendfile on file systems or kernels without them
+UNSUPPORTED_COPY_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+OFFSETS_SUFFIX = ".offsets.npy"
+
+
 SAMPLE_NAMES = [
     "feat",
     "good",
@@ -30,9 +73,223 @@ SAMPLE_NAMES = [
 ]
 
 
+def _copy_range(in_fd: int, out_fd: int, offset: int, count: int) -> int:
+    """Copy up to `count` bytes from `offset` of `in_fd` to `out_fd` and return how many."""
+    for copy_function in (
+        lambda: os.copy_file_range(in_fd, out_fd, count, offset),
+        lambda: os.sendfile(out_fd, in_fd, offset, count),
+    ):
+        try:
+            return copy_function()
+        except AttributeError:
+            pass
+        except OSError as exc:
+            if exc.errno not in UNSUPPORTED_COPY_ERRNOS:
+                raise
+    data = os.pread(in_fd, min(count, COPY_BLOCK_SIZE), offset)
+    view = memoryview(data)
+    while view:
+        view = view[os.write(out_fd, view) :]
+    return len(data)
+
+
+def copy_file_bytes(in_file_path: str, out_fp: BinaryIO, offset: int = 0) -> int:
+    """Append the bytes of `in_file_path` from `offset` on to unbuffered `out_fp`.
+
+    Returns the number of bytes copied.
+    """
+    with open(in_file_path, "rb") as in_fp:
+        in_fd, out_fd = in_fp.fileno(), out_fp.fileno()
+        count = os.fstat(in_fd).st_size - offset
+        copied = 0
+        while copied < count:
+            num_bytes = _copy_range(in_fd, out_fd, offset + copied, count - copied)
+            if num_bytes == 0:
+                break
+            copied += num_bytes
+    return copied
+
+
+class LineIndex:
+    def __init__(self, start: int = 0) -> None:
+        """Offsets of the lines of a stream that is observed block by block, plus `start`."""
+        self.start = start
+        self.position = 0
+        self._offsets = [np.zeros(1, dtype=np.uint64)]
+
+    def observe(self, block: bytes) -> None:
+        newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n"))
+        self._offsets.append((newlines + self.position + 1).astype(np.uint64))
+        self.position += len(block)
+
+    def offsets(self) -> np.ndarray:
+        """Return the offsets of the observed lines, see `line_offsets`."""
+        all_offsets = np.concatenate(self._offsets)
+        if all_offsets[-1] != self.position:
+            # last line without a newline
+            all_offsets = np.append(all_offsets, np.uint64(self.position))
+        return all_offsets + np.uint64(self.start)
+
+
+def line_offsets(file_path: str, start: int = 0) -> np.ndarray:
+    """Return the offset of every line of (uncompressed) `file_path` plus `start`.
+
+    The uncompressed size is the last element, so the array has one entry more
+    than there are lines.
+    """
+    index = LineIndex(start)
+    with open_binary(file_path) as fp:
+        for block in iter(lambda: fp.read(COPY_BLOCK_SIZE), b""):
+            index.observe(block)
+    return index.offsets()
+
+
+def offsets_path(jsonl_path: str) -> str:
+    """Return the path of the line offsets of `jsonl_path`, whatever its compression."""
+    return strip_compression(jsonl_path) + OFFSETS_SUFFIX
+
+
+def _append_stream(
+    in_fp: BinaryIO,
+    out_fp: BinaryIO,
+    compression: str,
+    prefix: bytes = b"",
+    index: Optional[LineIndex] = None,
+) -> None:
+    """Append `prefix` and the rest of decompressed `in_fp` to `out_fp`.
+
+    With a `compression` they are compressed as a new member. The blocks of
+    `in_fp` are also passed to `index`.
+    """
+    with ExitStack() as stack:
+        if compression:
+            out_fp = stack.enter_context(compressed_writer(out_fp, compression))
+        out_fp.write(prefix)
+        for block in iter(lambda: in_fp.read(COPY_BLOCK_SIZE), b""):
+            if index is not None:
+                index.observe(block)
+            out_fp.write(block)
+
+
+def collect_jsonl(
+    in_file_paths: Sequence[str], out_file_path: str, with_offsets: bool = True
+) -> Optional[np.ndarray]:
+    """Concatenate `in_file_paths` into `out_file_path` and return its line offsets.
+
+    See `line_offsets` for the layout of the offsets. Without `with_offsets`
+    every chunk is read once and None is returned.
+    """
+    compression = compression_of(out_file_path)
+    offsets = [np.zeros(1, dtype=np.uint64)]
+    size = 0
+    with open(out_file_path, "wb", buffering=0) as out_fp:
+        for in_file_path in in_file_paths:
+            if compression_of(in_file_path) == compression:
+                copy_file_bytes(in_file_path, out_fp)
+                # the kernel copy never sees the bytes, so they are read again
+                chunk_offsets = line_offsets(in_file_path, start=size) if with_offsets else None
+            else:
+                index = LineIndex(start=size) if with_offsets else None
+                with open_binary(in_file_path) as in_fp:
+                    _append_stream(in_fp, out_fp, compression, index=index)
+                chunk_offsets = index.offsets() if index is not None else None
+            if chunk_offsets is not None:
+                offsets.append(chunk_offsets[1:])
+                size = int(chunk_offsets[-1])
+    return np.concatenate(offsets) if with_offsets else None
+
+
+def collect_csv(in_file_paths: Sequence[str], out_file_path: str) -> None:
+    """Concatenate the CSVs `in_file_paths` into `out_file_path` with a single header."""
+    compression = compression_of(out_file_path)
+    header = None
+    with open(out_file_path, "wb", buffering=0) as out_fp:
+        for in_file_path in in_file_paths:
+            with open_binary(in_file_path) as in_fp:
+                chunk_header = in_fp.readline()
+                if header is None:
+                    header = chunk_header
+                    prefix = chunk_header
+                elif chunk_header != header:
+                    raise ValueError(f"{in_file_path} has another header than the first chunk")
+                else:
+                    prefix = b""
+                if not compression and not compression_of(in_file_path):
+                    copy_file_bytes(in_file_path, out_fp, offset=len(chunk_header) - len(prefix))
+                else:
+                    _append_stream(in_fp, out_fp, compression, prefix=prefix)
+
+
+def collect_sample(
+    key: str,
+    in_dump_path: str,
+    out_dump_path: str,
+    wp_yyyymmdd: str,
+    force: bool = False,
+    hash_contents: bool = True,
+    compression: str = "",
+    write_offsets: bool = True,
+) -> None:
+    """Collect the chunk files of sample `key` unless they are unchanged since the last run."""
+    manifest = StageManifest(
+        os.path.join(out_dump_path, MANIFEST_FILE_NAME), hash_contents=hash_contents, force=force
+    )
+    all_matches: List[Union[re.Match, None]] = [
+        re.match(patterns.ARTICLES_DUMP_PATTERN, filename) for filename in os.listdir(in_dump_path)
+    ]
+    non_null_matches: List[re.Match] = [match for match in all_matches if match is not None]
+    sorted_matches = sorted(non_null_matches, key=lambda x: int(x.groupdict()["pageno_start"]))
+    input_paths = sorted(os.path.join(in_dump_path, match.string) for match in sorted_matches)
+    params = {"compression": compression, "write_offsets": write_offsets}
+    code = code_version(stage_sources(__file__))
+    if manifest.is_fresh(key, input_paths, params, code):
+        logger.info(f"skipping {key}, chunk files are unchanged")
+        return
+
+    logger.info(f"working on {key}")
+    lat_paths = [
+        os.path.join(in_dump_path, match.string)
+        for match in sorted_matches
+        if match.group("extension") == "jsonl"
+    ]
+    art_paths = [
+        os.path.join(in_dump_path, match.string)
+        for match in sorted_matches
+        if match.group("extension") == "csv"
+    ]
+
+    out_file_name = "kwnlp-{}-{}-{}-{}.jsonl".format(
+        "enwiki", wp_yyyymmdd, "link-annotated-text", key
+    )
+    lat_file_path = with_compression(os.path.join(out_dump_path, out_file_name), compression)
+    remove_other_compressions(lat_file_path)
+    offsets = collect_jsonl(lat_paths, lat_file_path, with_offsets=write_offsets)
+    output_paths = [lat_file_path]
+    if offsets is not None:
+        np.save(offsets_path(lat_file_path), offsets)
+        output_paths.append(offsets_path(lat_file_path))
+        logger.info(f"collected {key}: {len(offsets) - 1} pages")
+    elif os.path.exists(offsets_path(lat_file_path)):
+        # offsets of an earlier collection would not match the new jsonl
+        os.remove(offsets_path(lat_file_path))
+
+    out_file_name = "kwnlp-{}-{}-{}-{}.csv".format("enwiki", wp_yyyymmdd, "article", key)
+    art_file_path = with_compression(os.path.join(out_dump_path, out_file_name), compression)
+    remove_other_compressions(art_file_path)
+    collect_csv(art_paths, art_file_path)
+
+    output_paths.append(art_file_path)
+    manifest.record(key, input_paths, params, code, output_paths)
+
+
 def main(
     wp_yyyymmdd: str,
     data_path: str = argconfig.DEFAULT_KWNLP_DATA_PATH,
+    workers: int = argconfig.DEFAULT_KWNLP_WORKERS,
+    force: bool = False,
+    hash_contents: bool = True,
+    compression: str = "",
+    write_offsets: bool = True,
 ) -> None:
 
     in_dump_paths = {
@@ -62,65 +319,39 @@ def main(
         os.makedirs(path, exist_ok=True)
         logger.info(f"{key} path: {path}")
 
-    for key in SAMPLE_NAMES:
-
-        logger.info(f"working on {key}")
-
-        all_lat_matches: List[Union[re.Match, None]] = [
-            re.match(patterns.ARTICLES_DUMP_PATTERN, filename)
-            for filename in os.listdir(in_dump_paths[key])
-            if filename.endswith(".jsonl")
-        ]
-        non_null_lat_matches: List[re.Match] = [
-            match for match in all_lat_matches if match is not None
-        ]
-        sorted_lat_matches = sorted(
-            non_null_lat_matches, key=lambda x: int(x.groupdict()["pageno_start"])
-        )
-
-        out_file_name = "kwnlp-{}-{}-{}-{}.jsonl".format(
-            "enwiki", wp_yyyymmdd, "link-annotated-text", key
-        )
-        out_file_path = os.path.join(out_dump_paths[key], out_file_name)
-        with open(out_file_path, "w") as ofp:
-            for match in sorted_lat_matches:
-                in_file_name = match.string
-                in_file_path = os.path.join(in_dump_paths[key], in_file_name)
-                with open(in_file_path, "r") as ifp:
-                    for line in ifp:
-                        ofp.write(line)
-
-        all_art_matches: List[Union[re.Match, None]] = [
-            re.match(patterns.ARTICLES_DUMP_PATTERN, filename)
-            for filename in os.listdir(in_dump_paths[key])
-            if filename.endswith(".csv")
-        ]
-        non_null_art_matches: List[re.Match] = [
-            match for match in all_art_matches if match is not None
+    # the copies wait on the disk, so threads are enough
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = [
+            executor.submit(
+                collect_sample,
+                key,
+                in_dump_paths[key],
+                out_dump_paths[key],
+                wp_yyyymmdd,
+                force=force,
+                hash_contents=hash_contents,
+                compression=compression,
+                write_offsets=write_offsets,
+            )
+            for key in SAMPLE_NAMES
         ]
-        sorted_art_matches = sorted(
-            non_null_art_matches, key=lambda x: int(x.groupdict()["pageno_start"])
-        )
-
-        out_file_name = "kwnlp-{}-{}-{}-{}.csv".format("enwiki", wp_yyyymmdd, "article", key)
-        out_file_path = os.path.join(out_dump_paths[key], out_file_name)
-
-        if os.path.exists(out_file_path):
-            os.remove(out_file_path)
-        write_header = True
-        for match in sorted_art_matches:
-            in_file_name = match.string
-            in_file_path = os.path.join(in_dump_paths[key], in_file_name)
-            df = pd.read_csv(in_file_path, keep_default_na=False)
-            df.to_csv(out_file_path, mode="a", header=write_header, index=False)
-            if write_header:
-                write_header = False
+        for future in futures:
+            future.result()
 
 
 if __name__ == "__main__":
 
     description = "gather sample chunks"
-    arg_names = ["wp_yyyymmdd", "data_path", "loglevel"]
+    arg_names = [
+        "wp_yyyymmdd",
+        "data_path",
+        "workers",
+        "loglevel",
+        "force",
+        "fingerprints",
+        "compression",
+        "no_line_offsets",
+    ]
     parser = argconfig.get_argparser(description, arg_names)
 
     args = parser.parse_args()
@@ -130,4 +361,9 @@ if __name__ == "__main__":
     main(
         args.wp_yyyymmdd,
         data_path=args.data_path,
+        workers=args.workers,
+        force=args.force,
+        hash_contents=args.fingerprints == "content",
+        compression=args.compression,
+        write_offsets=not args.no_line_offsets,
     )
@@ -3,18 +3,47 @@ import json
 import logging
 import os
 import subprocess
-from typing import Dict, Iterator
+import tempfile
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
 
 import joblib
+import numpy as np
 import pandas as pd
 import scipy.sparse
 from sklearn.feature_extraction.text import CountVectorizer
 from tqdm import tqdm
 
-from bm25_transformer import BM25Transformer
+from bm25_transformer import BM25Transformer, iter_row_blocks
 from nltk.stem.snowball import SnowballStemmer
 
 from wikiwhatsthis import argconfig
+from wikiwhatsthis import static_pruning
+from wikiwhatsthis.base_counts import (
+    ParagraphCounts,
+    fit_subset,
+    scope_counts,
+    scope_text,
+    subset_rows,
+    sums_paragraph_counts,
+)
+from wikiwhatsthis.compressed_io import compression_of, iter_lines, with_compression
+from wikiwhatsthis.model_bundle import write_bundle
+from wikiwhatsthis.model_comparison import write_topn_report
+from wikiwhatsthis.sharded_counts import (
+    count_corpus_paragraphs,
+    count_corpus_scope,
+    fit_count_vectorizer,
+)
+from wikiwhatsthis.stage_manifest import (
+    MANIFEST_FILE_NAME,
+    StageManifest,
+    code_version,
+    directory_files,
+    stage_sources,
+)
+from wikiwhatsthis.static_pruning import prune_topic_term
+from wikiwhatsthis.token_store import TOKEN_STORE_SUFFIX, paragraph_counts_from_stores
+from wikiwhatsthis.vocabulary import Vocabulary
 
 import warnings
 
@@ -28,7 +57,15 @@ warnings.filterwarnings(
 logger = logging.getLogger(__name__)
 
 
+# extra bundles with smaller impacts (--quantizations) that can be written, each
+# with a top-n report against the float64 bundle
+QUANTIZED_BUNDLES = ("float32", "float16", "uint8_linear", "uint8_log")
+NUM_REPORT_TEXTS = 1000
+
+
 def count_file_lines(file_path: str) -> int:
+    if compression_of(file_path):
+        return sum(1 for _ in iter_lines(file_path))
     output = subprocess.check_output(["wc", "-l", file_path])
     num_lines = int(output.split()[0])
     return num_lines
@@ -41,6 +78,9 @@ def dump(
     xcv: scipy.sparse.csr_matrix,
     xbm25: scipy.sparse.csr_matrix,
     output_path: str = "",
+    quantizations: Sequence[str] = (),
+    prunings: Sequence[Tuple[str, float]] = (),
+    report_texts: Sequence[str] = (),
 ) -> None:
     os.makedirs(output_path, exist_ok=True)
 
@@ -52,6 +92,9 @@ def dump(
     file_name = os.path.join(output_path, "cv.joblib")
     joblib.dump(cv, file_name)
 
+    file_name = os.path.join(output_path, "vocabulary.npz")
+    Vocabulary.from_dict(cv.vocabulary_).save(file_name)
+
     file_name = os.path.join(output_path, "df_articles.csv")
     df_articles.to_csv(file_name, index=False)
 
@@ -61,6 +104,51 @@ def dump(
     file_name = os.path.join(output_path, "xbm25.npz")
     scipy.sparse.save_npz(file_name, xbm25)
 
+    # memory-mapped copy of the bm25 model (including term-major posting lists),
+    # with the raw counts so that bm25 parameters can be tuned at query time;
+    # the transposes are built in memory, unlike the bm25 values themselves
+    feature_names = cv.get_feature_names()
+    reference_path = os.path.join(output_path, "bundle")
+    write_bundle(reference_path, wwt_config, feature_names, df_articles, xbm25, xcounts=xcv)
+
+    for quantization in quantizations:
+        bundle_path = os.path.join(output_path, f"bundle-{quantization}")
+        write_bundle(
+            bundle_path, wwt_config, feature_names, df_articles, xbm25, quantization=quantization
+        )
+        if report_texts:
+            write_topn_report(reference_path, bundle_path, report_texts)
+
+    for policy, value in prunings:
+        bundle_path = os.path.join(output_path, f"bundle-{policy}-{value:g}")
+        xpruned = prune_topic_term(xbm25, policy, value)
+        logger.info(f"{policy}={value:g} kept {xpruned.nnz} of {xbm25.nnz} nonzeros")
+        pruned_config = dict(wwt_config, pruning={"policy": policy, "value": value})
+        write_bundle(bundle_path, pruned_config, feature_names, df_articles, xpruned)
+        if report_texts:
+            write_topn_report(reference_path, bundle_path, report_texts)
+
+
+def held_out_report_texts(
+    base_corpus_path: str, model_page_ids: np.ndarray, num_texts: int = NUM_REPORT_TEXTS
+) -> List[str]:
+    """Return raw first paragraphs of base pages that are not topics of a model.
+
+    The models stem their queries, so the texts are the unstemmed
+    `plaintext`. Pages of the model are skipped, as a topic's own text would
+    inflate the agreement of the top-n reports.
+    """
+    model_pages = frozenset(model_page_ids.tolist())
+    texts: List[str] = []
+    for line in iter_lines(base_corpus_path):
+        page = json.loads(line)
+        if page["page_id"] in model_pages or not page["paragraphs"]:
+            continue
+        texts.append(page["paragraphs"][0]["plaintext"])
+        if len(texts) == num_texts:
+            break
+    return texts
+
 
 class WwtCorpus:
     def __init__(self, corpus_path: str, article_path: str):
@@ -69,45 +157,82 @@ class WwtCorpus:
         self._num_lines = count_file_lines(article_path) - 1
 
     def __iter__(self) -> Iterator[Dict]:
-        with open(self.corpus_path, "r") as fp:
-            for line in tqdm(fp, total=self._num_lines, dynamic_ncols=True):
-                yield json.loads(line)
+        lines = iter_lines(self.corpus_path)
+        for line in tqdm(lines, total=self._num_lines, dynamic_ncols=True):
+            yield json.loads(line)
 
     def iter_chunks(self, scope: str) -> Iterator[str]:
-        if scope == "paragraph":
-            for page in self:
-                if page["paragraphs"]:
-                    yield page["paragraphs"][0]["plaintext_snowball"]
-                else:
-                    yield ""
-        elif scope == "intro":
-            for page in self:
-                if page["paragraphs"]:
-                    yield " ".join(
-                        [
-                            para["plaintext_snowball"]
-                            for para in page["paragraphs"]
-                            if para["section_idx"] == 0
-                        ]
-                    )
-                else:
-                    yield ""
-        elif scope == "page":
-            for page in self:
-                if page["paragraphs"]:
-                    yield " ".join([para["plaintext_snowball"] for para in page["paragraphs"]])
-                else:
-                    yield ""
-        else:
-            raise ValueError("scope must be one of ['paragraph', 'intro', 'page']")
+        for page in self:
+            yield scope_text(page, scope)
+
+
+def count_base_paragraphs(
+    cv_args: Dict,
+    corpus_path: str,
+    article_path: str,
+    token_store_paths: Sequence[str],
+    workers: int,
+) -> ParagraphCounts:
+    """Return the raw paragraph counts of the base corpus, from its token stores if given."""
+    if not token_store_paths:
+        print("counting base corpus paragraphs")
+        return count_corpus_paragraphs(cv_args, corpus_path, workers=workers)
+    print(f"counting base corpus paragraphs from {len(token_store_paths)} token stores")
+    page_ids = pd.read_csv(article_path, usecols=["page_id"])["page_id"].to_numpy()
+    return paragraph_counts_from_stores(cv_args, token_store_paths, page_ids)
 
 
 def main(
     wp_yyyymmdd: str,
     data_path: str = argconfig.DEFAULT_KWNLP_DATA_PATH,
+    workers: int = argconfig.DEFAULT_KWNLP_WORKERS,
+    force: bool = False,
+    hash_contents: bool = True,
+    compression: str = "",
+    per_corpus_counts: bool = False,
+    use_token_store: bool = False,
+    quantizations: Sequence[str] = (),
+    prunings: Sequence[Tuple[str, float]] = (),
 ) -> None:
+    """Train a model for every corpus, scope and ngram range.
+
+    Every corpus is a subset of the base pages, so by default the base corpus
+    is counted once and each corpus takes its rows from those counts (see
+    `base_counts`). Word unigrams are counted per paragraph once for all
+    scopes, other ngram ranges once per scope. With `per_corpus_counts` every
+    corpus is tokenized from its own text instead. All give the same models.
+    Corpora are tokenized by `workers` processes (see `sharded_counts`).
+    With `use_token_store` the base paragraph counts come from the token
+    stores of task_01 instead (see `token_store`). BM25 is fit and written
+    a block of rows at a time, so only that step runs in bounded memory:
+    `dump` still holds xcv in memory, and every bundle it writes builds the
+    term-major postings of the whole topic-term matrix in memory (the
+    reference bundle also a float32 transpose of xcv, see
+    `model_bundle.write_bundle`).
+
+    Extra bundles for `quantizations` and `prunings` are only written on
+    request, each with a top-n report on held-out text (see
+    `held_out_report_texts`). A pruning is a (policy, value) pair passed
+    as is to `static_pruning.prune_topic_term`, so the value of "budget"
+    is an absolute number of postings kept, not a fraction of the nonzeros.
+    """
+
+    for quantization in quantizations:
+        if quantization not in QUANTIZED_BUNDLES:
+            raise ValueError(f"quantizations must be in {QUANTIZED_BUNDLES}, got {quantization}")
+    for policy, _ in prunings:
+        if policy not in static_pruning.PRUNING_POLICIES:
+            raise ValueError(
+                f"pruning policies must be in {static_pruning.PRUNING_POLICIES}, got {policy}"
+            )
 
     output_path = os.path.join("/data/wiki-whats-this", wp_yyyymmdd)
+    os.makedirs(output_path, exist_ok=True)
+    # models whose corpus, config and training code are unchanged are skipped
+    manifest = StageManifest(
+        os.path.join(output_path, MANIFEST_FILE_NAME), hash_contents=hash_contents, force=force
+    )
+    code = code_version(stage_sources(__file__))
 
     stemmer = SnowballStemmer("english")
     stop_words = frozenset(
@@ -142,7 +267,10 @@ def main(
             f"wikipedia-derived-{wp_yyyymmdd}",
             "wiki-whats-this",
             f"link-annotated-text-{corpus_name}",
-            f"kwnlp-enwiki-{wp_yyyymmdd}-link-annotated-text-{corpus_name}.jsonl",
+            with_compression(
+                f"kwnlp-enwiki-{wp_yyyymmdd}-link-annotated-text-{corpus_name}.jsonl",
+                compression,
+            ),
         )
         for corpus_name in corpora_names
     }
@@ -153,29 +281,47 @@ def main(
             f"wikipedia-derived-{wp_yyyymmdd}",
             "wiki-whats-this",
             f"link-annotated-text-{corpus_name}",
-            f"kwnlp-enwiki-{wp_yyyymmdd}-article-{corpus_name}.csv",
+            with_compression(f"kwnlp-enwiki-{wp_yyyymmdd}-article-{corpus_name}.csv", compression),
         )
         for corpus_name in corpora_names
     }
 
+    snowball_chunks_path = os.path.join(
+        data_path,
+        f"wikipedia-derived-{wp_yyyymmdd}",
+        "wiki-whats-this",
+        "link-annotated-text-snowball-chunks",
+    )
+    token_store_paths = (
+        sorted(
+            os.path.join(snowball_chunks_path, file_name)
+            for file_name in os.listdir(snowball_chunks_path)
+            if file_name.endswith(TOKEN_STORE_SUFFIX)
+        )
+        if use_token_store
+        else []
+    )
+
+    # raw paragraph counts of the base corpus, shared by all scopes
+    base_paragraph_counts: Optional[ParagraphCounts] = None
     for scope in scopes:
         print(f"working on scope {scope}")
+        # raw counts of the base corpus per ngram range, computed when first needed
+        scope_base_counts: Dict[Tuple[int, int], Tuple] = {}
 
         for corpus_name in corpora_names:
             print(f"working on corpus {corpus_name}")
 
             for ngram_range in ngram_ranges:
 
-                corpus = WwtCorpus(corpus_paths[corpus_name], article_paths[corpus_name])
-                df_articles = pd.read_csv(article_paths[corpus_name], keep_default_na=False)
-
                 cv_args = {
                     "min_df": 3,
                     "max_df": 0.85,
                     "ngram_range": ngram_range,
                     "max_features": 500_000,
                     "token_pattern": r"(?u)\b[^\d\W]{2,25}\b",
-                    "stop_words": list(stop_words),
+                    # sorted so the config is the same on every run
+                    "stop_words": sorted(stop_words),
                 }
 
                 wwt_config = {
@@ -184,22 +330,97 @@ def main(
                     "stemmer": "snowball",
                     "cv_args": cv_args,
                 }
+                model_name = f"{corpus_name}-{scope}-ngram{ngram_range[0]}{ngram_range[1]}-snowball"
+                model_path = os.path.join(output_path, model_name)
+                input_paths = [corpus_paths[corpus_name], article_paths[corpus_name]]
+                if not per_corpus_counts:
+                    input_paths += [corpus_paths["base"], article_paths["base"]]
+                    input_paths += token_store_paths
+                params = {
+                    "wwt_config": wwt_config,
+                    "quantizations": list(quantizations),
+                    "prunings": [list(pruning) for pruning in prunings],
+                    "num_report_texts": NUM_REPORT_TEXTS,
+                    "per_corpus_counts": per_corpus_counts,
+                    "token_store": use_token_store,
+                }
+                if manifest.is_fresh(model_name, input_paths, params, code):
+                    print(f"skipping {model_name}, inputs are unchanged")
+                    continue
 
-                cv = CountVectorizer(**cv_args)
-                xcv = cv.fit_transform(corpus.iter_chunks(scope))
+                df_articles = pd.read_csv(article_paths[corpus_name], keep_default_na=False)
+
+                if per_corpus_counts:
+                    cv, xcv = fit_count_vectorizer(
+                        cv_args, corpus_paths[corpus_name], scope, workers=workers
+                    )
+                else:
+                    if ngram_range not in scope_base_counts:
+                        if not sums_paragraph_counts(cv_args):
+                            print(f"counting base corpus for scope {scope}")
+                            feature_names, xbase = count_corpus_scope(
+                                cv_args, corpus_paths["base"], scope, workers=workers
+                            )
+                        else:
+                            if base_paragraph_counts is None:
+                                base_paragraph_counts = count_base_paragraphs(
+                                    cv_args,
+                                    corpus_paths["base"],
+                                    article_paths["base"],
+                                    token_store_paths,
+                                    workers,
+                                )
+                            feature_names, xbase = scope_counts(base_paragraph_counts, scope)
+                        df_base = pd.read_csv(article_paths["base"], usecols=["page_id"])
+                        base_page_ids = df_base["page_id"].to_numpy()
+                        scope_base_counts[ngram_range] = (feature_names, xbase, base_page_ids)
+                    feature_names, xbase, base_page_ids = scope_base_counts[ngram_range]
+                    rows = subset_rows(base_page_ids, df_articles["page_id"].to_numpy())
+                    cv, xcv = fit_subset(cv_args, feature_names, xbase, rows)
                 bm25 = BM25Transformer()
-                xbm25 = bm25.fit_transform(xcv)
-                model_path = os.path.join(
-                    output_path,
-                    f"{corpus_name}-{scope}-ngram{ngram_range[0]}{ngram_range[1]}-snowball",
-                )
-                dump(wwt_config, cv, df_articles, xcv, xbm25, output_path=model_path)
+                for xblock in iter_row_blocks(xcv):
+                    bm25.partial_fit(xblock)
+                # first paragraphs make realistic queries for the top-n reports
+                report_texts: List[str] = []
+                if quantizations or prunings:
+                    report_texts = held_out_report_texts(
+                        corpus_paths["base"], df_articles["page_id"].to_numpy()
+                    )
+                    if not report_texts:
+                        print(f"no held-out pages for {model_name}, writing no top-n reports")
+                with tempfile.TemporaryDirectory(dir=output_path) as tmp_path:
+                    # bm25 values go to disk a block of rows at a time
+                    xbm25 = bm25.transform_to_file(xcv, os.path.join(tmp_path, "xbm25_data.npy"))
+                    dump(
+                        wwt_config,
+                        cv,
+                        df_articles,
+                        xcv,
+                        xbm25,
+                        output_path=model_path,
+                        quantizations=quantizations,
+                        prunings=prunings,
+                        report_texts=report_texts,
+                    )
+                manifest.record(model_name, input_paths, params, code, directory_files(model_path))
 
 
 if __name__ == "__main__":
 
     description = "train explicit topic models"
-    arg_names = ["wp_yyyymmdd", "data_path", "loglevel"]
+    arg_names = [
+        "wp_yyyymmdd",
+        "data_path",
+        "workers",
+        "loglevel",
+        "force",
+        "fingerprints",
+        "compression",
+        "per_corpus_counts",
+        "token_store",
+        "quantizations",
+        "prunings",
+    ]
     parser = argconfig.get_argparser(description, arg_names)
 
     args = parser.parse_args()
@@ -209,4 +430,12 @@ if __name__ == "__main__":
     main(
         args.wp_yyyymmdd,
         data_path=args.data_path,
+        workers=args.workers,
+        force=args.force,
+        hash_contents=args.fingerprints == "content",
+        compression=args.compression,
+        per_corpus_counts=args.per_corpus_counts,
+        use_token_store=args.token_store,
+        quantizations=args.quantizations,
+        prunings=args.prunings,
     )
@@ -0,0 +1,108 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import numpy as np
+import pytest
+from sklearn.feature_extraction.text import CountVectorizer
+
+from wikiwhatsthis.base_counts import (
+    fit_base_counts,
+    fit_paragraph_counts,
+    fit_subset,
+    scope_counts,
+    subset_rows,
+)
+
+
+TEXTS = [
+    "apple banana cherry apple",
+    "banana cherry date",
+    "cherry date elder fig",
+    "apple fig grape grape",
+    "banana elder grape",
+    "date fig apple cherry",
+    "the apple and the banana",
+    "",
+]
+
+
+@pytest.mark.parametrize(
+    "cv_args",
+    [
+        {"min_df": 1, "max_df": 1.0},
+        {"min_df": 2, "max_df": 0.85},
+        {"min_df": 0.2, "max_df": 3, "stop_words": ["the", "and"]},
+        {"min_df": 1, "max_df": 1.0, "max_features": 3},
+        {"min_df": 1, "max_df": 0.9, "ngram_range": (1, 2), "max_features": 5},
+    ],
+)
+def test_fit_subset_matches_count_vectorizer(cv_args: dict) -> None:
+    base_page_ids = np.array([10, 4, 7, 1, 3, 9, 2, 8])
+    feature_names, xbase = fit_base_counts(cv_args, TEXTS)
+    for page_ids in ([4, 1, 9, 8], [2, 10, 3], list(base_page_ids)):
+        rows = subset_rows(base_page_ids, np.array(page_ids))
+        cv, xcv = fit_subset(cv_args, feature_names, xbase, rows)
+
+        expected_cv = CountVectorizer(**cv_args)
+        expected_xcv = expected_cv.fit_transform([TEXTS[row] for row in rows])
+        assert cv.vocabulary_ == expected_cv.vocabulary_
+        assert cv.stop_words_ == expected_cv.stop_words_
+        assert (xcv != expected_xcv).nnz == 0
+        assert (cv.transform(TEXTS) != expected_cv.transform(TEXTS)).nnz == 0
+
+
+def test_subset_rows_needs_base_pages() -> None:
+    base_page_ids = np.array([5, 3, 8])
+    assert list(subset_rows(base_page_ids, np.array([8, 5]))) == [2, 0]
+    with pytest.raises(ValueError):
+        subset_rows(base_page_ids, np.array([3, 4]))
+
+
+def test_fit_subset_needs_terms() -> None:
+    feature_names, xbase = fit_base_counts({}, TEXTS)
+    with pytest.raises(ValueError):
+        fit_subset({"min_df": 3}, feature_names, xbase, np.array([0, 1]))
+
+
+def _scope_text(page: dict, scope: str) -> str:
+    paragraphs = page["paragraphs"]
+    if scope == "paragraph":
+        paragraphs = paragraphs[:1]
+    elif scope == "intro":
+        paragraphs = [para for para in paragraphs if para["section_idx"] == 0]
+    elif scope == "sections2":
+        paragraphs = [para for para in paragraphs if para["section_idx"] < 2]
+    return " ".join(para["plaintext_snowball"] for para in paragraphs)
+
+
+@pytest.mark.parametrize("scope", ["paragraph", "intro", "page", "sections2"])
+def test_scope_counts_match_counts_of_scope_text(scope: str) -> None:
+    pages = [
+        {"paragraphs": [{"section_idx": section_idx, "plaintext_snowball": text}]}
+        for section_idx, text in enumerate(TEXTS[:3])
+    ]
+    pages[0]["paragraphs"] += [
+        {"section_idx": section_idx % 3, "plaintext_snowball": text}
+        for section_idx, text in enumerate(TEXTS[3:])
+    ]
+    pages.insert(1, {"paragraphs": []})
+    cv_args = {"stop_words": ["the"]}
+    paragraph_counts = fit_paragraph_counts(cv_args, pages)
+    assert list(paragraph_counts.page_offsets) == [0, 6, 6, 7, 8]
+
+    feature_names, xscope = scope_counts(paragraph_counts, scope)
+    cv = CountVectorizer(**cv_args).fit([_scope_text(page, scope) for page in pages])
+    expected = cv.transform([_scope_text(page, scope) for page in pages])
+    columns = [list(feature_names).index(term) for term in cv.get_feature_names_out()]
+    assert (xscope[:, columns] != expected).nnz == 0
+    assert xscope.sum() == expected.sum()
+
+
+def test_fit_paragraph_counts_needs_unigrams() -> None:
+    with pytest.raises(ValueError):
+        fit_paragraph_counts({"ngram_range": (1, 2)}, [])
+    with pytest.raises(ValueError):
+        scope_counts(
+            fit_paragraph_counts(
+                {}, [{"paragraphs": [{"section_idx": 0, "plaintext_snowball": "ab"}]}]
+            ),
+            "chapter",
+        )
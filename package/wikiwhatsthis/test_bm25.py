@@ -1,6 +1,11 @@
 # Copyright 2020-present Kensho Technologies, LLC.
+import os
+
+import numpy as np
+import pytest
+import scipy.sparse
 from sklearn.feature_extraction.text import CountVectorizer
-from bm25_transformer import BM25Transformer
+from bm25_transformer import BM25Transformer, iter_row_blocks
 
 cv = CountVectorizer()
 corpus = [
@@ -12,3 +17,59 @@ xcv = cv.fit_transform(corpus)
 bm25 = BM25Transformer(use_idf=True)
 bm25.fit(xcv)
 xbm25 = bm25.fit_transform(xcv)
+
+
+def test_partial_fit_of_row_blocks_matches_fit(tmp_path: str) -> None:
+    rng = np.random.default_rng(0)
+    xcounts = scipy.sparse.random(200, 50, density=0.1, format="csr", random_state=0)
+    xcounts.data = rng.integers(1, 6, xcounts.nnz).astype(np.int64)
+    expected = BM25Transformer().fit(xcounts)
+    streamed = BM25Transformer()
+    for xblock in iter_row_blocks(xcounts, block_rows=33):
+        streamed.partial_fit(xblock)
+    assert streamed.n_samples_seen_ == 200
+    assert streamed.avgdl_ == expected.avgdl_
+    assert np.array_equal(streamed.idf_, expected.idf_)
+
+    file_path = os.path.join(tmp_path, "xbm25_data.npy")
+    xstreamed = streamed.transform_to_file(xcounts, file_path, block_rows=17)
+    assert np.array_equal(xstreamed.toarray(), expected.transform(xcounts).toarray())
+    assert np.array_equal(np.load(file_path), xstreamed.data)
+
+
+def test_partial_fit_needs_equal_features() -> None:
+    bm25 = BM25Transformer().partial_fit(xcv)
+    with pytest.raises(ValueError):
+        bm25.partial_fit(xcv[:, :2])
+    bm25.fit(xcv[:, :2])
+    assert bm25.n_samples_seen_ == 2
+
+
+def _dense_bm25(bm25: BM25Transformer, xcounts: np.ndarray) -> np.ndarray:
+    dl = xcounts.sum(axis=1, keepdims=True)
+    norm = bm25.k1 * (1 - bm25.b + bm25.b * dl / dl.mean())
+    return xcounts * (bm25.k1 + 1) / (xcounts + norm) * bm25.idf_
+
+
+def test_transform_in_place() -> None:
+    xcounts = scipy.sparse.csr_matrix(
+        np.array([[1, 0, 2, 0], [0, 0, 0, 0], [3, 1, 0, 0], [0, 0, 0, 0], [0, 4, 1, 1]])
+    ).astype(np.float64)
+    bm25 = BM25Transformer().fit(xcounts)
+    expected = _dense_bm25(bm25, xcounts.toarray())
+
+    xcopy = bm25.transform(xcounts, block_rows=2)
+    assert np.allclose(xcopy.toarray(), expected)
+    assert np.array_equal(xcounts.data, [1, 2, 3, 1, 4, 1, 1])
+
+    data = xcounts.data
+    xinplace = bm25.transform(xcounts, copy=False, block_rows=2)
+    assert xinplace.data is data
+    assert np.array_equal(xinplace.toarray(), xcopy.toarray())
+
+
+def test_transform_float32() -> None:
+    bm25 = BM25Transformer(dtype=np.float32).fit(xcv)
+    xbm25_32 = bm25.transform(xcv)
+    assert xbm25_32.dtype == np.float32
+    assert np.allclose(xbm25_32.toarray(), xbm25.toarray(), rtol=1e-6)
@@ -0,0 +1,83 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from wikiwhatsthis.compressed_io import open_binary
+from wikiwhatsthis.task_10_collect_sample_chunks import (
+    collect_csv,
+    collect_jsonl,
+    copy_file_bytes,
+    line_offsets,
+)
+
+
+def _write(file_path: str, data: bytes) -> str:
+    with open_binary(file_path, "wb") as fp:
+        fp.write(data)
+    return file_path
+
+
+def _read(file_path: str) -> bytes:
+    with open_binary(file_path) as fp:
+        return fp.read()
+
+
+def test_copy_file_bytes_from_offset(tmp_path: str) -> None:
+    in_file_path = _write(os.path.join(tmp_path, "in.txt"), b"header\nbody\n")
+    out_file_path = os.path.join(tmp_path, "out.txt")
+    with open(out_file_path, "wb", buffering=0) as out_fp:
+        out_fp.write(b"first\n")
+        assert copy_file_bytes(in_file_path, out_fp, offset=7) == 5
+    assert _read(out_file_path) == b"first\nbody\n"
+
+
+def test_line_offsets_end_with_the_size(tmp_path: str) -> None:
+    file_path = _write(os.path.join(tmp_path, "in.jsonl.gz"), b"a\nbcd\n\nef")
+    assert list(line_offsets(file_path, start=10)) == [10, 12, 16, 17, 19]
+
+
+@pytest.mark.parametrize("compression", ["", "gz"])
+def test_collect_jsonl_mixes_compressions(tmp_path: str, compression: str) -> None:
+    in_file_paths = [
+        _write(os.path.join(tmp_path, "in0.jsonl"), b'{"page_id": 1}\n{"page_id": 2}\n'),
+        _write(os.path.join(tmp_path, "in1.jsonl"), b""),
+        _write(os.path.join(tmp_path, "in2.jsonl.gz"), b'{"page_id": 30}\n'),
+    ]
+    out_file_path = os.path.join(tmp_path, "out.jsonl" + ("." + compression if compression else ""))
+    offsets = collect_jsonl(in_file_paths, out_file_path)
+    data = _read(out_file_path)
+    assert data == b'{"page_id": 1}\n{"page_id": 2}\n{"page_id": 30}\n'
+    lines = [data[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+    assert lines == data.splitlines(keepends=True)
+    assert offsets.dtype == np.uint64
+    # offsets of recompressed and of kernel-copied chunks agree with a scan of the output
+    assert np.array_equal(offsets, line_offsets(out_file_path))
+
+    assert collect_jsonl(in_file_paths, out_file_path, with_offsets=False) is None
+    assert _read(out_file_path) == data
+
+
+@pytest.mark.parametrize("compression", ["", "gz"])
+def test_collect_csv_keeps_one_header(tmp_path: str, compression: str) -> None:
+    in_file_paths = []
+    for chunk, page_ids in enumerate([[1, 2], [], [3]]):
+        file_path = os.path.join(tmp_path, f"in{chunk}.csv" + (".gz" if chunk == 2 else ""))
+        pd.DataFrame({"page_id": page_ids, "page_title": ["x"] * len(page_ids)}).to_csv(
+            file_path, index=False
+        )
+        in_file_paths.append(file_path)
+    out_file_path = os.path.join(tmp_path, "out.csv" + ("." + compression if compression else ""))
+    collect_csv(in_file_paths, out_file_path)
+    assert list(pd.read_csv(out_file_path)["page_id"]) == [1, 2, 3]
+
+
+def test_collect_csv_needs_equal_headers(tmp_path: str) -> None:
+    in_file_paths = [
+        _write(os.path.join(tmp_path, "in0.csv"), b"page_id\n1\n"),
+        _write(os.path.join(tmp_path, "in1.csv"), b"item_id\n2\n"),
+    ]
+    with pytest.raises(ValueError):
+        collect_csv(in_file_paths, os.path.join(tmp_path, "out.csv"))
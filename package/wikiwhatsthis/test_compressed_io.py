@@ -0,0 +1,51 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import os
+
+import pytest
+
+from wikiwhatsthis import compressed_io
+from wikiwhatsthis.compressed_io import iter_lines, open_binary, with_compression
+from wikiwhatsthis.work_units import WorkUnit, iter_unit_lines, run_work_units
+
+LINES = [b'{"page_id": %d, "text": "%s"}\n' % (ii, b"ab" * (ii % 50)) for ii in range(3000)]
+
+
+@pytest.mark.parametrize("compression", ["", "gz", "zst"])
+def test_concatenated_files_round_trip(
+    tmp_path: str, compression: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    if compression == "zst":
+        pytest.importorskip("zstandard")
+    # blocks end in the middle of lines
+    monkeypatch.setattr(compressed_io, "READ_BLOCK_SIZE", 1000)
+    part_paths = [
+        with_compression(os.path.join(tmp_path, f"part{ii}.jsonl"), compression) for ii in range(2)
+    ]
+    for part_path, lines in zip(part_paths, [LINES[:1000], LINES[1000:]]):
+        with open_binary(part_path, "wb") as fp:
+            fp.writelines(lines)
+    # compressed members (frames) can be concatenated byte for byte
+    file_path = with_compression(os.path.join(tmp_path, "chunk.jsonl"), compression)
+    with open(file_path, "wb") as ofp:
+        for part_path in part_paths:
+            with open(part_path, "rb") as ifp:
+                ofp.write(ifp.read())
+    assert list(iter_lines(file_path)) == LINES
+
+
+def _copy_unit(unit: WorkUnit, out_path: str) -> int:
+    lines = list(iter_unit_lines(unit))
+    with open_binary(out_path, "wb") as fp:
+        fp.writelines(lines)
+    return len(lines)
+
+
+def test_work_units_on_compressed_files(tmp_path: str) -> None:
+    in_paths = [os.path.join(tmp_path, "a.jsonl.gz"), os.path.join(tmp_path, "b.jsonl")]
+    for in_path in in_paths:
+        with open_binary(in_path, "wb") as fp:
+            fp.writelines(LINES)
+    out_paths = [os.path.join(tmp_path, "out-a.jsonl.gz"), os.path.join(tmp_path, "out-b.jsonl.gz")]
+    run_work_units(_copy_unit, in_paths, out_paths, workers=2, unit_bytes=20_000)
+    for out_path in out_paths:
+        assert list(iter_lines(out_path)) == LINES
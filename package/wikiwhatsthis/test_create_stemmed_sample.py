@@ -0,0 +1,153 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import json
+import os
+
+import pytest
+from nltk.stem.snowball import SnowballStemmer
+from sklearn.feature_extraction.text import CountVectorizer
+
+from wikiwhatsthis import task_01_create_stemmed_sample
+from wikiwhatsthis.stem_cache import CachedStemmer, StemTable
+from wikiwhatsthis.task_01_create_stemmed_sample import (
+    add_stems,
+    decode_page,
+    filter_sections,
+    load_worker_stem_table,
+    merge_stem_tables,
+    merge_unit_token_stores,
+    parse_unit,
+)
+from wikiwhatsthis.token_store import TokenStore, token_store_path
+from wikiwhatsthis.work_units import part_path, plan_work_units
+
+
+def test_decode_page_matches_json_module() -> None:
+    page = {
+        "page_id": 12,
+        "page_title": "Café – \U0001f600",
+        "paragraphs": [
+            {
+                "plaintext": 'Quoted "text" \\ with\nescapes \ud800',
+                "section_name": "Introduction",
+                "anchor_point_offsets": [0, 7],
+            }
+        ],
+    }
+    line = json.dumps(page)
+    assert decode_page(line) == json.loads(line)
+    assert json.dumps(decode_page(line)) == line
+
+
+def test_filter_sections_and_add_stems() -> None:
+    page = {
+        "paragraphs": [
+            {"plaintext": "Running dogs", "section_name": "History"},
+            {"plaintext": "Cited works", "section_name": " See Also "},
+        ]
+    }
+    tokenizer = CountVectorizer().build_tokenizer()
+    page = add_stems(filter_sections(page), CachedStemmer(SnowballStemmer("english")), tokenizer)
+    assert [para["plaintext_snowball"] for para in page["paragraphs"]] == ["run dog"]
+
+
+def test_parse_unit_matches_whole_file(tmp_path: str) -> None:
+    pages = [
+        {
+            "page_id": page_id,
+            "paragraphs": [
+                {"plaintext": f"running dogs {page_id}", "section_name": "Introduction"},
+                {"plaintext": "sources", "section_name": "References"},
+            ],
+        }
+        for page_id in range(50)
+    ]
+    in_path = os.path.join(tmp_path, "chunk.jsonl")
+    with open(in_path, "w") as fp:
+        fp.writelines(json.dumps(page) + "\n" for page in pages)
+    units = plan_work_units([in_path], unit_bytes=500)
+    assert len(units) > 1
+    out_paths = [os.path.join(tmp_path, f"out{unit.unit_index}") for unit in units]
+    assert sum(parse_unit(unit, out_path) for unit, out_path in zip(units, out_paths)) == 50
+    lines = []
+    for unit, out_path in sorted(zip(units, out_paths)):
+        with open(out_path) as fp:
+            lines.extend(fp)
+    assert [json.loads(line)["page_id"] for line in lines] == list(range(50))
+    assert json.loads(lines[3])["paragraphs"] == [
+        {
+            "plaintext": "running dogs 3",
+            "section_name": "Introduction",
+            "plaintext_snowball": "run dog",
+        }
+    ]
+
+
+def test_parse_unit_writes_token_store(tmp_path: str) -> None:
+    pages = [
+        {
+            "page_id": page_id,
+            "paragraphs": [
+                {"plaintext": "running dogs", "section_name": "Introduction", "section_idx": 0},
+                {"plaintext": "sources", "section_name": "References", "section_idx": 1},
+                {"plaintext": "cats", "section_name": "Life", "section_idx": 2},
+            ],
+        }
+        for page_id in range(30)
+    ]
+    in_path = os.path.join(tmp_path, "chunk.jsonl")
+    with open(in_path, "w") as fp:
+        fp.writelines(json.dumps(page) + "\n" for page in pages)
+    units = plan_work_units([in_path], unit_bytes=1000)
+    assert len(units) > 1
+    out_path = os.path.join(tmp_path, "out.jsonl.gz")
+    for unit in units:
+        parse_unit(unit, part_path(out_path, unit.unit_index), write_token_store=True)
+    merge_unit_token_stores(out_path, len(units))
+
+    store = TokenStore.load(token_store_path(out_path))
+    assert list(store.page_ids) == list(range(30))
+    assert list(store.section_idx[:2]) == [0, 2]
+    assert list(store.stems) == ["cat", "dog", "run"]
+    assert list(store.stems[store.stem_ids[:3]]) == ["run", "dog", "cat"]
+    assert not os.path.exists(token_store_path(part_path(out_path, 0)))
+
+
+def test_merge_stem_tables(tmp_path: str) -> None:
+    stem_parts_path = os.path.join(tmp_path, "stem-table-parts")
+    os.makedirs(stem_parts_path)
+    StemTable({"cats": "cat"}).save(os.path.join(stem_parts_path, "a.tsv"))
+    StemTable({"dogs": "dog"}).save(os.path.join(stem_parts_path, "b.tsv"))
+    stem_table_path = os.path.join(tmp_path, "stem-table.tsv")
+    StemTable({"running": "run"}).save(stem_table_path)
+    merge_stem_tables(stem_table_path, stem_parts_path)
+    assert StemTable.load(stem_table_path).stems == {"cats": "cat", "dogs": "dog", "running": "run"}
+    assert os.listdir(stem_parts_path) == []
+
+
+def test_worker_stem_table_is_loaded_once_and_bounded(
+    tmp_path: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    in_path = os.path.join(tmp_path, "chunk.jsonl")
+    with open(in_path, "w") as fp:
+        for page_id, text in enumerate(["running dogs", "jumping cats", "flying birds"]):
+            page = {"page_id": page_id, "paragraphs": [{"plaintext": text, "section_name": ""}]}
+            fp.write(json.dumps(page) + "\n")
+    stem_table_path = os.path.join(tmp_path, "stem-table.tsv")
+    StemTable({"running": "run", "dogs": "dog"}).save(stem_table_path)
+    stem_parts_path = os.path.join(tmp_path, "stem-table-parts")
+    os.makedirs(stem_parts_path)
+
+    monkeypatch.setattr(task_01_create_stemmed_sample, "MAX_WORKER_NEW_STEMS", 2)
+    stem_table = load_worker_stem_table(stem_table_path)
+    # the loaded table is used as is, the path is not read again
+    os.remove(stem_table_path)
+    for unit in plan_work_units([in_path], unit_bytes=1):
+        out_path = os.path.join(tmp_path, f"out{unit.unit_index}")
+        parse_unit(unit, out_path, stem_table_path, stem_parts_path)
+    assert task_01_create_stemmed_sample._worker_stem_table is stem_table
+    # the stems of the third page pushed the worker past its limit
+    assert stem_table.stems == {"running": "run", "dogs": "dog", "jumping": "jump", "cats": "cat"}
+    # every unit still wrote its new stems
+    merged = merge_stem_tables(stem_table_path, stem_parts_path)
+    assert merged.stems == {"jumping": "jump", "cats": "cat", "flying": "fli", "birds": "bird"}
+    monkeypatch.setattr(task_01_create_stemmed_sample, "_worker_stem_table", None)
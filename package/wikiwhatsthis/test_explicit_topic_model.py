@@ -0,0 +1,84 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import numpy as np
+import pandas as pd
+import pytest
+from nltk.stem.snowball import SnowballStemmer
+from sklearn.feature_extraction.text import CountVectorizer
+
+from wikiwhatsthis.bm25_transformer import BM25Transformer
+from wikiwhatsthis.explicit_topic_model import ExplicitTopicModel
+
+
+TOPIC_TEXTS = [
+    "red apple fruit apple",
+    "green apple tree tree",
+    "red car engine",
+    "blue sky",
+    "red sky over the apple tree",
+    "fast red car",
+]
+
+TEXTS = [
+    "red apples",
+    "",
+    "unknown words only",
+    "the green trees and the blue skies",
+    "red",
+    "Red cars with fast engines",
+    "zzz red zzz",
+]
+
+
+def _model(retrieval: str = "exhaustive") -> ExplicitTopicModel:
+    cv = CountVectorizer()
+    xcounts = cv.fit_transform(TOPIC_TEXTS)
+    xbm25 = BM25Transformer().fit_transform(xcounts).tocsr()
+    topic_df = pd.DataFrame({"page_title": [f"Topic {i}" for i in range(len(TOPIC_TEXTS))]})
+    return ExplicitTopicModel(cv, xbm25, topic_df, SnowballStemmer("english"), retrieval=retrieval)
+
+
+@pytest.mark.parametrize("retrieval", ["exhaustive", "maxscore"])
+@pytest.mark.parametrize("topn", [1, 3, 10])
+@pytest.mark.parametrize("thresh", [0.0, 0.2])
+def test_batch_matches_single_texts(retrieval: str, topn: int, thresh: float) -> None:
+    model = _model(retrieval)
+    batch = model.topn_topics_from_texts(TEXTS, topn=topn, thresh=thresh)
+    assert batch.topic_ids.shape == batch.scores.shape == (len(TEXTS), topn)
+    for row, text in enumerate(TEXTS):
+        expected = model.topn_topics_from_text(text, topn=topn, thresh=thresh)
+        count = batch.counts[row]
+        assert count == len(expected)
+        assert np.array_equal(batch.topic_ids[row, :count], expected.index.to_numpy())
+        assert np.allclose(batch.scores[row, :count], expected["score"].to_numpy())
+        # padding after the valid entries
+        assert (batch.topic_ids[row, count:] == -1).all()
+        assert (batch.scores[row, count:] == 0.0).all()
+
+
+def test_batch_of_empty_and_unknown_texts() -> None:
+    model = _model()
+    batch = model.topn_topics_from_texts(["", "unknown words only", "  "], topn=4)
+    assert batch.counts.tolist() == [0, 0, 0]
+    assert (batch.topic_ids == -1).all()
+    assert (batch.scores == 0.0).all()
+
+    batch = model.topn_topics_from_texts([], topn=4)
+    assert batch.topic_ids.shape == batch.scores.shape == (0, 4)
+    assert len(batch.counts) == 0
+
+    with pytest.raises(ValueError):
+        model.topn_topics_from_texts(TEXTS, thresh=-1.0)
+
+
+def test_topn_tokens_from_topic_pads_with_zero_scores() -> None:
+    model = _model()
+    # "blue sky" has two tokens, the rest of the vocabulary scores zero
+    tokens = model.topn_tokens_from_topic("Topic 3", topn=5)
+    assert len(tokens) == 5
+    assert set(tokens["token"][:2]) == {"blue", "sky"}
+    assert (tokens["score"][:2] > 0).all()
+    assert tokens["token"][2:].tolist() == ["apple", "car", "engine"]
+    assert (tokens["score"][2:] == 0.0).all()
+    # never more rows than tokens
+    num_tokens = model.xdocterm.shape[1]
+    assert len(model.topn_tokens_from_topic("Topic 3", topn=num_tokens + 5)) == num_tokens
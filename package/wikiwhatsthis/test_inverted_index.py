@@ -0,0 +1,45 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import numpy as np
+import scipy.sparse
+
+from wikiwhatsthis.inverted_index import InvertedIndex
+
+
+def _random_topic_term(n_topics: int = 200, n_terms: int = 50) -> scipy.sparse.csr_matrix:
+    return scipy.sparse.random(n_topics, n_terms, density=0.1, format="csr", random_state=0)
+
+
+def test_score_matches_column_sum() -> None:
+    xdocterm = _random_topic_term()
+    index = InvertedIndex.from_topic_term(xdocterm)
+    term_ids = np.array([0, 3, 7, 49])
+    weights = np.array([1.0, 2.0, 0.5, 1.0])
+
+    topic_ids, scores = index.score(term_ids, weights)
+
+    expected = np.asarray(xdocterm[:, term_ids] @ weights).ravel()
+    assert np.all(np.diff(topic_ids) > 0)
+    assert np.allclose(scores, expected[topic_ids])
+    assert np.all(np.delete(expected, topic_ids) == 0)
+
+
+def test_score_empty_query() -> None:
+    index = InvertedIndex.from_topic_term(_random_topic_term())
+    topic_ids, scores = index.score(np.zeros(0, dtype=np.int64), np.zeros(0))
+    assert len(topic_ids) == 0
+    assert len(scores) == 0
+
+
+def test_pruned_topn_matches_exhaustive() -> None:
+    rng = np.random.default_rng(0)
+    xdocterm = _random_topic_term(n_topics=500, n_terms=40)
+    # rounded impacts create ties at the top-n boundary
+    xdocterm.data = np.round(xdocterm.data * 4)
+    index = InvertedIndex(scipy.sparse.csr_matrix(xdocterm.T), block_size=4)
+    for _ in range(50):
+        term_ids = np.unique(rng.integers(0, 40, size=8))
+        weights = rng.integers(1, 4, size=len(term_ids)) / len(term_ids)
+        expected = index.topn(term_ids, weights, topn=10)
+        topic_ids, scores = index.topn(term_ids, weights, topn=10, pruning=True)
+        assert np.array_equal(topic_ids, expected[0])
+        assert np.array_equal(scores, expected[1])
@@ -0,0 +1,77 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import os
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import pytest
+from nltk.stem.snowball import SnowballStemmer
+from sklearn.feature_extraction.text import CountVectorizer
+
+from wikiwhatsthis.bm25_transformer import BM25Transformer
+from wikiwhatsthis.explicit_topic_model import ExplicitTopicModel
+from wikiwhatsthis.model_bundle import load_bundle, read_manifest, write_bundle
+
+
+TOPIC_TEXTS = [
+    "red apple fruit apple",
+    "green apple tree tree",
+    "red car engine",
+    "blue sky",
+    "not a number",
+    "red sky over the apple tree",
+]
+
+TOPIC_DF = pd.DataFrame(
+    {
+        "page_id": np.array([12, 7, 40, 3, 99, 5], dtype=np.int64),
+        "page_title": ["Apple", "Tree", "Car", "Sky", "NaN", "nan"],
+        "views": [1.5, np.nan, 3.0, 0.0, 2.25, 8.0],
+        "redirect": ["None", "", None, "Skies", np.nan, "Red sky"],
+    }
+)
+
+QUERIES = ["red apples", "a tree in the sky", "not a number", "unknown words", ""]
+
+
+@pytest.mark.parametrize("mmap_mode", ["r", None])
+def test_bundle_round_trip(tmp_path: str, mmap_mode: Optional[str]) -> None:
+    cv = CountVectorizer()
+    xcounts = cv.fit_transform(TOPIC_TEXTS)
+    xbm25 = BM25Transformer().fit_transform(xcounts).tocsr()
+    stemmer = SnowballStemmer("english")
+    expected_model = ExplicitTopicModel(cv, xbm25, TOPIC_DF, stemmer)
+
+    bundle_path = os.path.join(tmp_path, "bundle")
+    write_bundle(
+        bundle_path, {"cv_args": {}}, cv.get_feature_names_out(), TOPIC_DF, xbm25, xcounts=xcounts
+    )
+    kinds = {
+        column["name"]: column["kind"] for column in read_manifest(bundle_path)["topic_columns"]
+    }
+    assert kinds == {
+        "page_id": "numeric",
+        "page_title": "string",
+        "views": "numeric",
+        "redirect": "string",
+    }
+    model = load_bundle(bundle_path, stemmer=stemmer, mmap_mode=mmap_mode)
+
+    for query in QUERIES:
+        expected = expected_model.topn_topics_from_text(query, topn=4)
+        result = model.topn_topics_from_text(query, topn=4)
+        assert np.array_equal(result.index, expected.index)
+        assert np.array_equal(result["score"], expected["score"])
+    expected_batch = expected_model.topn_topics_from_texts(QUERIES, topn=4)
+    batch = model.topn_topics_from_texts(QUERIES, topn=4)
+    for expected_array, array in zip(expected_batch, batch):
+        assert np.array_equal(array, expected_array)
+
+    topics = model.topic_df.to_frame()
+    assert topics["page_id"].tolist() == TOPIC_DF["page_id"].tolist()
+    assert topics["page_id"].dtype == np.int64
+    assert np.array_equal(topics["views"], TOPIC_DF["views"], equal_nan=True)
+    # a page titled "NaN" keeps its title, missing strings become empty
+    assert topics["page_title"].tolist() == ["Apple", "Tree", "Car", "Sky", "NaN", "nan"]
+    assert topics["redirect"].tolist() == ["None", "", "", "Skies", "", "Red sky"]
+    assert model.topic_df.positions("page_title", "NaN").tolist() == [4]
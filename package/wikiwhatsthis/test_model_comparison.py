@@ -0,0 +1,44 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import json
+import os
+
+import pandas as pd
+import pytest
+from sklearn.feature_extraction.text import CountVectorizer
+
+from wikiwhatsthis.model_bundle import write_bundle
+from wikiwhatsthis.model_comparison import TOPN_REPORT, write_topn_report
+
+
+def test_compare_topn_of_bundles_with_one_changed_topic(tmp_path: str) -> None:
+    topic_texts = ["red apple fruit", "green apple tree", "red car engine", "blue sky"]
+    cv = CountVectorizer()
+    xdocterm = cv.fit_transform(topic_texts).tocsr().astype(float)
+    topic_df = pd.DataFrame({"page_title": ["Apple", "Tree", "Car", "Sky"]})
+    # the candidate loses the "red" impact of topic Apple and halves that of Car
+    xcandidate = xdocterm.copy()
+    red = cv.vocabulary_["red"]
+    xcandidate[0, red] = 0.0
+    xcandidate[2, red] = 0.5
+    xcandidate.eliminate_zeros()
+
+    wwt_config = {"cv_args": {}}
+    feature_names = cv.get_feature_names_out()
+    reference_path = os.path.join(tmp_path, "reference")
+    candidate_path = os.path.join(tmp_path, "candidate")
+    write_bundle(reference_path, wwt_config, feature_names, topic_df, xdocterm)
+    write_bundle(candidate_path, wwt_config, feature_names, topic_df, xcandidate)
+
+    # "red": Apple and Car tie in the reference, only Car is left in the candidate
+    # "blue sky": unchanged, "unknown": no topics in either
+    report = write_topn_report(reference_path, candidate_path, ["red", "blue sky", "unknown"], 2)
+    assert report["num_texts"] == 3
+    assert report["topn"] == 2
+    assert report["recall_at_k"] == pytest.approx((1 / 2 + 1) / 2)
+    assert report["exact_match_rate"] == pytest.approx(2 / 3)
+    assert report["max_abs_score_error"] == pytest.approx(0.5)
+    # shared topics: Car for "red" and Sky for "blue sky"
+    assert report["mean_abs_score_error"] == pytest.approx(0.25)
+    with open(os.path.join(candidate_path, TOPN_REPORT)) as fp:
+        assert json.load(fp) == report
+    assert report["nbytes"] < report["reference_nbytes"]
@@ -0,0 +1,39 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import numpy as np
+import scipy.sparse
+
+from wikiwhatsthis.inverted_index import InvertedIndex
+from wikiwhatsthis.quantize import QUANTIZATION_MODES, quantize_postings
+
+
+def _random_postings(n_terms: int = 40, n_topics: int = 500) -> scipy.sparse.csr_matrix:
+    postings = scipy.sparse.random(n_terms, n_topics, density=0.1, format="csr", random_state=0)
+    postings.data *= 10
+    return postings
+
+
+def test_decode_error_is_bounded() -> None:
+    postings = _random_postings()
+    row_terms = np.repeat(np.arange(postings.shape[0]), np.diff(postings.indptr))
+    for mode in QUANTIZATION_MODES:
+        coded, codec = quantize_postings(postings, mode)
+        impacts = codec.decode(coded.data, row_terms)
+        assert impacts.dtype == np.float64
+        assert np.all(impacts > 0)
+        # 8-bit codes round each impact to the nearest of 255 levels of its term
+        assert np.allclose(impacts, postings.data, rtol=0.05, atol=0.05), mode
+
+
+def test_pruned_topn_matches_exhaustive_on_quantized_index() -> None:
+    rng = np.random.default_rng(0)
+    xdocterm = _random_postings().T
+    for mode in ("float16", "uint8_linear", "uint8_log"):
+        index = InvertedIndex.from_topic_term(xdocterm, quantization=mode)
+        index.block_size = 4
+        for _ in range(20):
+            term_ids = np.unique(rng.integers(0, 40, size=8))
+            weights = rng.integers(1, 4, size=len(term_ids)) / len(term_ids)
+            expected = index.topn(term_ids, weights, topn=10)
+            topic_ids, scores = index.topn(term_ids, weights, topn=10, pruning=True)
+            assert np.array_equal(topic_ids, expected[0])
+            assert np.array_equal(scores, expected[1])
@@ -0,0 +1,85 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+
+import pandas as pd
+from nltk.stem.snowball import SnowballStemmer
+from sklearn.feature_extraction.text import CountVectorizer
+
+from wikiwhatsthis.explicit_topic_model import ExplicitTopicModel
+from wikiwhatsthis.query_server import MAX_TOPN, LatencyHistogram, MicroBatcher, QueryServer
+from wikiwhatsthis.stem_cache import CachedStemmer
+
+
+def test_latency_histogram_quantiles() -> None:
+    histogram = LatencyHistogram(bounds=(1, 10, 100, float("inf")))
+    for latency_ms in [0.5] * 50 + [5] * 40 + [50] * 9 + [500]:
+        histogram.observe(latency_ms)
+    stats = histogram.stats()
+    assert stats["count"] == 100
+    assert (stats["p50_ms"], stats["p90_ms"], stats["p99_ms"]) == (1.0, 10.0, 100.0)
+
+
+def _model() -> ExplicitTopicModel:
+    topic_texts = ["red apple fruit", "green apple tree", "red car engine", "blue sky"]
+    cv = CountVectorizer()
+    xdocterm = cv.fit_transform(topic_texts).tocsr().astype(float)
+    topic_df = pd.DataFrame({"page_title": ["Apple", "Tree", "Car", "Sky"]})
+    return ExplicitTopicModel(cv, xdocterm, topic_df, SnowballStemmer("english"))
+
+
+def test_micro_batcher_matches_model() -> None:
+    model = _model()
+    batcher = MicroBatcher(model, ThreadPoolExecutor(max_workers=1), max_wait_ms=50)
+    queries = ["red apple", "apple tree", "engine", "unknown words"]
+
+    async def run_queries() -> list:
+        results = await asyncio.gather(*[batcher.topn(query, topn=2) for query in queries])
+        await batcher.close()
+        return results
+
+    results = asyncio.run(run_queries())
+    for query, records in zip(queries, results):
+        expected = model.topn_topics_from_text(query, topn=2)
+        assert [record["page_title"] for record in records] == list(expected["page_title"])
+    # all four requests arrived within the wait window
+    assert batcher.batch_sizes == {4: 1}
+
+
+def test_handle_request_rejects_topn_and_reports_scoring_errors() -> None:
+    model = _model()
+    server = QueryServer({"apples": model}, CachedStemmer())
+
+    async def post(query: dict) -> tuple:
+        return await server.handle_request("POST", "/models/apples/topn", json.dumps(query))
+
+    async def run_requests() -> list:
+        results = [
+            await post({"text": "red apple", "topn": topn}) for topn in (0, -1, MAX_TOPN + 1)
+        ]
+        results.append(await post({"text": "red apple", "topn": 2}))
+
+        results += [await post(query) for query in ({"topn": 2}, {"text": "red", "thresh": "x"})]
+
+        def fail(*args: object, **kwargs: object) -> None:
+            raise MemoryError()
+
+        model.topn_topics_from_texts = fail
+        results += await asyncio.gather(post({"text": "red"}), post({"text": "apple"}))
+
+        def fail_with_value_error(*args: object, **kwargs: object) -> None:
+            raise ValueError("internal detail")
+
+        model.topn_topics_from_texts = fail_with_value_error
+        results.append(await post({"text": "red"}))
+        for batcher in server.batchers.values():
+            await batcher.close()
+        return results
+
+    results = asyncio.run(run_requests())
+    assert [status for status, _ in results] == [400, 400, 400, 200, 400, 400, 500, 500, 500]
+    assert [record["page_title"] for record in results[3][1]] == ["Apple", "Car"]
+    assert "MemoryError" in results[6][1]["error"]
+    # errors raised by the model are not blamed on the client, nor shown to it
+    assert results[8][1] == {"error": "scoring failed: ValueError"}
@@ -0,0 +1,128 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from wikiwhatsthis import patterns
+from wikiwhatsthis.compressed_io import iter_lines
+from wikiwhatsthis.task_05_create_sample_chunks import (
+    _init_router,
+    create_masks,
+    create_router,
+    lookup_pages,
+    main,
+    page_id_of,
+    page_mask_bits,
+    route_chunk,
+    sample_file_paths,
+)
+from wikiwhatsthis.token_store import TokenStoreWriter, token_store_path
+
+
+def _base_articles() -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "page_id": [3, 1, 2, 5],
+            "page_title": ["C", "A", "B", "E"],
+            "tmpl_featured_article": [0, 1, 0, 0],
+            "tmpl_good_article": [0, 0, 1, 0],
+            "views": [10, 6000, 600, 60],
+            "in_link_count": [50, 50, 5, 15],
+        }
+    )
+
+
+def test_page_id_of_falls_back_to_json() -> None:
+    assert page_id_of(b'{"page_id": 12, "paragraphs": []}\n') == 12
+    assert page_id_of(b'{"paragraphs": [], "page_id": 7}\n') == 7
+
+
+def test_page_mask_bits_needs_sorted_page_ids() -> None:
+    df_base_articles = _base_articles()
+    with pytest.raises(ValueError):
+        page_mask_bits(df_base_articles["page_id"].to_numpy(), create_masks(df_base_articles))
+
+
+def test_lookup_pages_finds_rows_of_sorted_table() -> None:
+    _init_router(create_router(_base_articles()))
+    rows, bits = lookup_pages(np.array([5, 4, 1, 0, 9]))
+    found = bits != 0
+    assert list(found) == [True, False, True, False, False]
+    assert list(rows[found]) == [3, 0]
+    # page 1 is the only featured article ("feat" is bit 0)
+    assert list(bits[found] & 1) == [0, 1]
+
+
+def test_route_chunk_writes_every_sample(tmp_path: str) -> None:
+    df_base_articles = _base_articles()
+    masks = create_masks(df_base_articles)
+    _init_router(create_router(df_base_articles))
+    file_name = "kwnlp-enwiki-20200920-link-annotated-text1-p1p9.jsonl"
+    in_file_path = os.path.join(tmp_path, file_name)
+    # page 4 is not a base article
+    lines = [
+        json.dumps({"page_id": page_id, "paragraphs": []}) + "\n" for page_id in [5, 4, 1, 2, 3]
+    ]
+    with open(in_file_path, "w") as fp:
+        fp.writelines(lines)
+    out_dir_paths = {mask_name: os.path.join(tmp_path, mask_name) for mask_name in masks}
+    for out_dir_path in out_dir_paths.values():
+        os.makedirs(out_dir_path)
+    match = re.match(patterns.ARTICLES_DUMP_PATTERN, file_name)
+    assert match is not None
+    file_paths = sample_file_paths(match, out_dir_paths, "gz")
+
+    result = route_chunk({"key": file_name, "in_file_path": in_file_path, "file_paths": file_paths})
+
+    for mask_name, mask in masks.items():
+        expected = [
+            page_id
+            for page_id in [5, 4, 1, 2, 3]
+            if page_id in set(df_base_articles["page_id"][mask])
+        ]
+        jsonl_path, csv_path = file_paths[mask_name]
+        assert [json.loads(line)["page_id"] for line in iter_lines(jsonl_path)] == expected
+        assert list(pd.read_csv(csv_path)["page_id"]) == expected
+        assert result["num_pages"][mask_name] == len(expected)
+    assert result["num_pages"]["base"] == 4
+    assert result["num_pages"]["mini"] == 1
+
+
+def test_main_skips_token_stores(tmp_path: str) -> None:
+    derived_path = os.path.join(tmp_path, "wikipedia-derived-20200920")
+    lat_path = os.path.join(derived_path, "wiki-whats-this", "link-annotated-text-snowball-chunks")
+    os.makedirs(lat_path)
+    os.makedirs(os.path.join(derived_path, "kwnlp-sql"))
+    df_articles = _base_articles()
+    for column in ["isa_Q17442446", "isa_Q14795564", "isa_Q18340514"]:
+        df_articles[column] = 0
+    df_articles["item_id"] = df_articles["page_id"] + 100
+    df_articles.to_csv(
+        os.path.join(derived_path, "kwnlp-sql", "kwnlp-enwiki-20200920-article.csv"), index=False
+    )
+    chunk_path = os.path.join(lat_path, "kwnlp-enwiki-20200920-link-annotated-text1-p1p9.jsonl")
+    with open(chunk_path, "w") as fp:
+        fp.writelines(
+            json.dumps({"page_id": page_id, "paragraphs": []}) + "\n" for page_id in [1, 5]
+        )
+    # task_01 --token_store writes the store next to its chunk
+    writer = TokenStoreWriter()
+    writer.add_page(1, [(0, ["run", "dog"])])
+    writer.to_store().save(token_store_path(chunk_path))
+    assert (
+        patterns.ARTICLES_DUMP_PATTERN.match(os.path.basename(token_store_path(chunk_path))) is None
+    )
+
+    main("20200920", data_path=str(tmp_path), workers=1)
+
+    base_path = os.path.join(
+        derived_path,
+        "wiki-whats-this",
+        "link-annotated-text-base-chunks",
+        "kwnlp-enwiki-20200920-link-annotated-text1-p1p9-base.jsonl",
+    )
+    assert [json.loads(line)["page_id"] for line in iter_lines(base_path)] == [1, 5]
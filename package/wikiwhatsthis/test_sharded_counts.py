@@ -0,0 +1,70 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import json
+import os
+import random
+
+import numpy as np
+import pytest
+from sklearn.feature_extraction.text import CountVectorizer
+
+from wikiwhatsthis.base_counts import fit_paragraph_counts, scope_text
+from wikiwhatsthis.sharded_counts import count_corpus_paragraphs, fit_count_vectorizer
+
+
+def _pages(num_pages: int) -> list:
+    rng = random.Random(0)
+    words = ["".join(rng.choice("abcdef") for _ in range(rng.randint(1, 4))) for _ in range(300)]
+    return [
+        {
+            "page_id": page_id,
+            "paragraphs": [
+                {
+                    "section_idx": section_idx,
+                    "plaintext_snowball": " ".join(rng.choices(words, k=rng.randint(0, 20))),
+                }
+                for section_idx in sorted(rng.choices(range(4), k=rng.randint(0, 5)))
+            ],
+        }
+        for page_id in range(num_pages)
+    ]
+
+
+def _write_corpus(tmp_path: str, pages: list) -> str:
+    corpus_path = os.path.join(tmp_path, "corpus.jsonl")
+    with open(corpus_path, "w") as fp:
+        for page in pages:
+            fp.write(json.dumps(page) + "\n")
+    return corpus_path
+
+
+@pytest.mark.parametrize(
+    "cv_args",
+    [
+        {"min_df": 3, "max_df": 0.85, "max_features": 50, "stop_words": ["ab", "cd"]},
+        {"min_df": 1, "max_df": 1.0, "ngram_range": (1, 2)},
+    ],
+)
+@pytest.mark.parametrize("workers", [1, 2])
+def test_fit_count_vectorizer_matches_count_vectorizer(
+    tmp_path: str, cv_args: dict, workers: int
+) -> None:
+    pages = _pages(200)
+    corpus_path = _write_corpus(tmp_path, pages)
+    for scope in ["intro", "page"]:
+        cv, xcv = fit_count_vectorizer(cv_args, corpus_path, scope, workers, unit_bytes=2000)
+        expected_cv = CountVectorizer(**cv_args)
+        expected_xcv = expected_cv.fit_transform([scope_text(page, scope) for page in pages])
+        assert cv.vocabulary_ == expected_cv.vocabulary_
+        assert cv.stop_words_ == expected_cv.stop_words_
+        assert (xcv != expected_xcv).nnz == 0
+
+
+def test_count_corpus_paragraphs_matches_one_shard(tmp_path: str) -> None:
+    pages = _pages(100)
+    corpus_path = _write_corpus(tmp_path, pages)
+    sharded = count_corpus_paragraphs({}, corpus_path, unit_bytes=1000)
+    expected = fit_paragraph_counts({}, pages)
+    assert list(sharded.feature_names) == list(expected.feature_names)
+    assert (sharded.xparagraph != expected.xparagraph).nnz == 0
+    assert np.array_equal(sharded.page_offsets, expected.page_offsets)
+    assert np.array_equal(sharded.section_idx, expected.section_idx)
@@ -0,0 +1,107 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import os
+from typing import List
+
+from wikiwhatsthis import stage_manifest
+from wikiwhatsthis.stage_manifest import StageManifest, file_fingerprint, stage_sources
+
+
+def _write(file_path: str, text: str) -> None:
+    with open(file_path, "w") as fp:
+        fp.write(text)
+
+
+def test_outputs_are_stale_after_any_change(tmp_path: str) -> None:
+    in_path = os.path.join(tmp_path, "chunk.jsonl")
+    out_path = os.path.join(tmp_path, "out.jsonl")
+    manifest_path = os.path.join(tmp_path, "stage-manifest.json")
+    _write(in_path, "a\n")
+    _write(out_path, "A\n")
+    params = {"sections": ("see also", "references")}
+
+    manifest = StageManifest(manifest_path)
+    assert not manifest.is_fresh("chunk", [in_path], params, "v1")
+    manifest.record("chunk", [in_path], params, "v1", [out_path])
+
+    # entries are reloaded from disk on the next run
+    manifest = StageManifest(manifest_path)
+    assert manifest.is_fresh("chunk", [in_path], params, "v1")
+    assert not manifest.is_fresh("chunk", [in_path], {"sections": ("see also",)}, "v1")
+    assert not manifest.is_fresh("chunk", [in_path], params, "v2")
+    assert not StageManifest(manifest_path, force=True).is_fresh("chunk", [in_path], params, "v1")
+
+    _write(out_path, "AA\n")
+    assert not manifest.is_fresh("chunk", [in_path], params, "v1")
+    manifest.record("chunk", [in_path], params, "v1", [out_path])
+    _write(in_path, "b\n")
+    assert not manifest.is_fresh("chunk", [in_path], params, "v1")
+
+
+def test_content_hashes(tmp_path: str) -> None:
+    in_path = os.path.join(tmp_path, "chunk.jsonl")
+    _write(in_path, "a\n")
+    manifest = StageManifest(os.path.join(tmp_path, "stage-manifest.json"), hash_contents=True)
+    manifest.record("chunk", [in_path], {}, "v1", [])
+    assert "sha256" in manifest.entries["chunk"]["inputs"][in_path]
+    assert manifest.is_fresh("chunk", [in_path], {}, "v1")
+
+
+def test_content_hashes_ignore_rewrites_with_same_bytes(tmp_path: str) -> None:
+    in_path = os.path.join(tmp_path, "chunk.jsonl")
+    out_path = os.path.join(tmp_path, "out.jsonl")
+    manifest_path = os.path.join(tmp_path, "stage-manifest.json")
+    _write(in_path, "a\n")
+    _write(out_path, "A\n")
+    StageManifest(manifest_path, hash_contents=True).record(
+        "chunk", [in_path], {}, "v1", [out_path]
+    )
+
+    # a rerun of the previous stage rewrites the input with a new mtime
+    _write(in_path, "a\n")
+    os.utime(in_path, ns=(0, 0))
+    assert StageManifest(manifest_path, hash_contents=True).is_fresh("chunk", [in_path], {}, "v1")
+    # without content hashes the new mtime makes the output stale
+    manifest = StageManifest(manifest_path)
+    manifest.record("chunk", [in_path], {}, "v1", [out_path])
+    os.utime(in_path, ns=(1, 1))
+    assert not manifest.is_fresh("chunk", [in_path], {}, "v1")
+
+    manifest = StageManifest(manifest_path, hash_contents=True)
+    manifest.record("chunk", [in_path], {}, "v1", [out_path])
+    _write(in_path, "b\n")
+    assert not manifest.is_fresh("chunk", [in_path], {}, "v1")
+    _write(in_path, "a\n")
+    _write(out_path, "B\n")
+    assert not manifest.is_fresh("chunk", [in_path], {}, "v1")
+
+
+def test_content_hashes_are_reused_for_unchanged_files(tmp_path: str) -> None:
+    in_path = os.path.join(tmp_path, "chunk.jsonl")
+    _write(in_path, "a\n")
+    fingerprint = file_fingerprint(in_path, hash_contents=True)
+    # a recorded sha256 is trusted while size and mtime match
+    stale = dict(fingerprint, sha256="0" * 64)
+    assert file_fingerprint(in_path, True, stale)["sha256"] == "0" * 64
+    os.utime(in_path, ns=(0, 0))
+    assert file_fingerprint(in_path, True, stale)["sha256"] == fingerprint["sha256"]
+
+
+def test_stage_sources_follow_package_imports() -> None:
+    package_path = os.path.dirname(os.path.abspath(stage_manifest.__file__))
+
+    def file_names(script_name: str) -> List[str]:
+        sources = stage_sources(os.path.join(package_path, script_name))
+        return [os.path.basename(source_path) for source_path in sources]
+
+    task_01 = file_names("task_01_create_stemmed_sample.py")
+    # direct and indirect imports, not modules of other stages
+    for file_name in ["compressed_io.py", "stem_cache.py", "work_units.py", "__init__.py"]:
+        assert file_name in task_01
+    for file_name in ["task_05_create_sample_chunks.py", "query_server.py", "model_comparison.py"]:
+        assert file_name not in task_01
+    task_15 = file_names("task_15_train_models.py")
+    # imported as a top-level module by the script
+    assert "bm25_transformer.py" in task_15
+    assert "topic_table.py" in task_15
+    assert "query_server.py" not in task_15
+    assert task_15 == sorted(task_15)
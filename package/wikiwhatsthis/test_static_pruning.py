@@ -0,0 +1,43 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import numpy as np
+import scipy.sparse
+
+from wikiwhatsthis.static_pruning import prune_topic_term
+
+
+def _random_topic_term() -> scipy.sparse.csr_matrix:
+    xdocterm = scipy.sparse.random(300, 40, density=0.2, format="csr", random_state=1)
+    # rounded impacts create ties at the cutoffs
+    xdocterm.data = np.round(xdocterm.data * 5) + 1
+    return xdocterm
+
+
+def test_top_n_keeps_largest_impacts_per_term() -> None:
+    xdocterm = _random_topic_term()
+    dense = xdocterm.toarray()
+    pruned = prune_topic_term(xdocterm, "top_n", 5).toarray()
+    for term in range(dense.shape[1]):
+        col = dense[:, term]
+        expected = sorted(np.flatnonzero(col), key=lambda topic: (-col[topic], topic))[:5]
+        assert set(np.flatnonzero(pruned[:, term])) == set(expected)
+        assert np.array_equal(pruned[expected, term], col[expected])
+
+
+def test_percentile_drops_impacts_below_term_percentile() -> None:
+    xdocterm = _random_topic_term()
+    dense = xdocterm.toarray()
+    pruned = prune_topic_term(xdocterm, "percentile", 60).toarray()
+    for term in range(dense.shape[1]):
+        col = dense[:, term]
+        if not col.any():
+            continue
+        impacts = np.sort(col[col > 0])
+        cutoff = impacts[int(np.floor(0.6 * (len(impacts) - 1)))]
+        assert set(np.flatnonzero(pruned[:, term])) == set(np.flatnonzero(col >= cutoff))
+
+
+def test_budget_keeps_largest_impacts_overall() -> None:
+    xdocterm = _random_topic_term()
+    pruned = prune_topic_term(xdocterm, "budget", 100)
+    assert pruned.nnz == 100
+    assert pruned.data.min() >= np.sort(xdocterm.data)[-100]
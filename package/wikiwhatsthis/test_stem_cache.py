@@ -0,0 +1,60 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import os
+
+from nltk.stem.snowball import SnowballStemmer
+
+from wikiwhatsthis.stem_cache import CachedStemmer, StemTable
+
+
+def test_cached_stems_match_stemmer() -> None:
+    stemmer = SnowballStemmer("english")
+    cached = CachedStemmer(stemmer)
+    tokens = ["running", "cats", "running", "generously", "cats", "running"]
+    assert [cached.stem(token) for token in tokens] == [stemmer.stem(token) for token in tokens]
+    stats = cached.stats()
+    assert stats["hits"] == 3
+    assert stats["misses"] == 3
+    assert stats["size"] == 3
+
+
+def test_lru_eviction() -> None:
+    cached = CachedStemmer(maxsize=2)
+    for token in ["cats", "dogs", "cats", "birds"]:
+        cached.stem(token)
+    # "dogs" is the least recently used entry when "birds" is inserted
+    assert cached.stats()["evictions"] == 1
+    cached.stem("cats")
+    assert cached.hits == 2
+    cached.stem("dogs")
+    assert cached.misses == 4
+
+
+def test_warm_does_not_count_lookups() -> None:
+    cached = CachedStemmer()
+    cached.warm(["cats", "dogs"])
+    assert len(cached) == 2
+    assert cached.stats()["hit_rate"] == 0.0
+    cached.stem("cats")
+    assert cached.stats()["hit_rate"] == 1.0
+
+
+def test_stem_table_stems_each_token_once(tmp_path: str) -> None:
+    table = StemTable()
+    tokens = ["running", "cats", "running", "the", "cats"]
+    stemmer = SnowballStemmer("english")
+    assert table.stem_tokens(tokens) == [stemmer.stem(token) for token in tokens]
+    assert table.pop_new_stems() == {"running": "run", "cats": "cat", "the": "the"}
+    assert table.stem_tokens(["cats", "dogs"]) == ["cat", "dog"]
+    assert table.pop_new_stems() == {"dogs": "dog"}
+
+    file_path = os.path.join(tmp_path, "stem-table.tsv")
+    table.save(file_path)
+    assert StemTable.load(file_path).stems == table.stems
+
+
+def test_cached_stemmer_uses_table() -> None:
+    cached = CachedStemmer(table=StemTable({"running": "run"}))
+    assert cached.stem("running") == "run"
+    assert cached.stem("cats") == "cat"
+    stats = cached.stats()
+    assert (stats["table_hits"], stats["misses"], stats["size"]) == (1, 1, 1)
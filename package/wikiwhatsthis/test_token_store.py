@@ -0,0 +1,88 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import os
+
+import numpy as np
+import scipy.sparse
+
+from wikiwhatsthis.base_counts import ParagraphCounts, fit_paragraph_counts
+from wikiwhatsthis.token_store import (
+    TokenStore,
+    TokenStoreWriter,
+    concatenate_stores,
+    paragraph_counts_from_store,
+    paragraph_counts_from_stores,
+)
+
+
+CV_ARGS = {"token_pattern": r"(?u)\b[^\d\W]{2,25}\b", "stop_words": ["the"]}
+
+PAGES = [
+    {
+        "page_id": 7,
+        "paragraphs": [
+            {"section_idx": 0, "plaintext_snowball": "the cat sat on the mat"},
+            {"section_idx": 1, "plaintext_snowball": "cat x2 b ab-cd"},
+        ],
+    },
+    {"page_id": 3, "paragraphs": []},
+    {
+        "page_id": 5,
+        "paragraphs": [{"section_idx": 0, "plaintext_snowball": "Dog dog café"}],
+    },
+]
+
+
+def _store(pages: list) -> TokenStore:
+    writer = TokenStoreWriter()
+    for page in pages:
+        writer.add_page(
+            page["page_id"],
+            [
+                (para["section_idx"], para["plaintext_snowball"].split())
+                for para in page["paragraphs"]
+            ],
+        )
+    return writer.to_store()
+
+
+def _assert_same_counts(got: ParagraphCounts, expected: ParagraphCounts) -> None:
+    columns = np.searchsorted(got.feature_names, expected.feature_names)
+    assert list(got.feature_names[columns]) == list(expected.feature_names)
+    assert (got.xparagraph[:, columns] != expected.xparagraph).nnz == 0
+    assert got.xparagraph.sum() == expected.xparagraph.sum()
+    assert np.array_equal(got.page_offsets, expected.page_offsets)
+    assert np.array_equal(got.section_idx, expected.section_idx)
+
+
+def test_token_store_round_trip(tmp_path: str) -> None:
+    store = _store(PAGES)
+    assert list(store.stems) == sorted(store.stems)
+    file_path = os.path.join(tmp_path, "chunk.tokens.npz")
+    store.save(file_path)
+    loaded = TokenStore.load(file_path)
+    assert list(loaded.stems) == list(store.stems)
+    for name in TokenStore._fields[1:]:
+        assert np.array_equal(getattr(loaded, name), getattr(store, name))
+
+
+def test_paragraph_counts_from_store_match_text_counts() -> None:
+    got = paragraph_counts_from_store(CV_ARGS, _store(PAGES))
+    _assert_same_counts(got, fit_paragraph_counts(CV_ARGS, PAGES))
+    assert isinstance(got.xparagraph, scipy.sparse.csr_matrix)
+
+
+def test_paragraph_counts_from_stores_select_pages(tmp_path: str) -> None:
+    store_paths = []
+    for index, pages in enumerate([PAGES[:1], PAGES[1:]]):
+        store_paths.append(os.path.join(tmp_path, f"chunk{index}.tokens.npz"))
+        _store(pages).save(store_paths[-1])
+    got = paragraph_counts_from_stores(CV_ARGS, store_paths, np.array([5, 7]))
+    _assert_same_counts(got, fit_paragraph_counts(CV_ARGS, [PAGES[2], PAGES[0]]))
+
+
+def test_concatenate_stores_merges_dictionaries() -> None:
+    store = concatenate_stores([_store(PAGES[:1]), _store(PAGES[1:])])
+    expected = _store(PAGES)
+    assert list(store.stems) == list(expected.stems)
+    for name in TokenStore._fields[1:]:
+        assert np.array_equal(getattr(store, name), getattr(expected, name))
@@ -0,0 +1,78 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import numpy as np
+import pytest
+
+from wikiwhatsthis.topk import topn_dense, topn_positions, topn_sparse
+
+
+def _reference_dense(scores: np.ndarray, topn: int, thresh: float = 0.0) -> np.ndarray:
+    order = np.argsort(-scores, kind="stable")
+    return order[scores[order] > thresh][: max(topn, 0)]
+
+
+@pytest.mark.parametrize("topn", [1, 3, 10, 57, 200])
+@pytest.mark.parametrize("thresh", [0.0, 2.0, -np.inf])
+def test_topn_dense_matches_stable_argsort(topn: int, thresh: float) -> None:
+    rng = np.random.default_rng(0)
+    # few distinct values, so the kth score is tied with many others
+    scores = rng.integers(0, 6, 100).astype(np.float64)
+    assert np.array_equal(topn_dense(scores, topn, thresh), _reference_dense(scores, topn, thresh))
+
+
+def test_ties_across_partition_boundary_keep_smallest_ids() -> None:
+    scores = np.array([1.0, 3.0, 2.0, 3.0, 2.0, 2.0, 1.0])
+    # 3.0 twice above the boundary, then two of the three 2.0 ties
+    assert topn_dense(scores, 4).tolist() == [1, 3, 2, 4]
+    assert topn_dense(scores, 2).tolist() == [1, 3]
+    assert topn_dense(scores, 3).tolist() == [1, 3, 2]
+
+
+def test_thresh_is_exclusive() -> None:
+    scores = np.array([0.0, 0.5, 1.0, 1.5, -1.0])
+    assert topn_dense(scores, 10).tolist() == [3, 2, 1]
+    assert topn_dense(scores, 10, thresh=1.0).tolist() == [3]
+    assert topn_dense(scores, 10, thresh=1.5).tolist() == []
+    ids, values = topn_sparse(np.array([7, 3, 5]), np.array([1.0, 2.0, 0.5]), 10, thresh=0.5)
+    assert ids.tolist() == [3, 7]
+    assert values.tolist() == [2.0, 1.0]
+
+
+@pytest.mark.parametrize("topn", [0, -1])
+def test_non_positive_topn_returns_nothing(topn: int) -> None:
+    scores = np.array([1.0, 2.0, 3.0])
+    assert len(topn_positions(scores, topn)) == 0
+    assert len(topn_dense(scores, topn)) == 0
+    ids, values = topn_sparse(np.array([4, 5, 6]), scores, topn)
+    assert len(ids) == 0 and len(values) == 0
+
+
+def test_topn_larger_than_candidates_returns_all_sorted() -> None:
+    scores = np.array([1.0, 3.0, 0.0, 3.0])
+    assert topn_dense(scores, 10).tolist() == [1, 3, 0]
+    assert topn_positions(scores, 4).tolist() == [1, 3, 0, 2]
+    assert topn_dense(np.zeros(0), 5).tolist() == []
+
+
+def test_topn_sparse_breaks_ties_by_id() -> None:
+    # equal scores are ordered by id, not by position
+    ids = np.array([9, 4, 7, 1, 8])
+    scores = np.array([2.0, 2.0, 3.0, 2.0, 1.0])
+    result_ids, result_scores = topn_sparse(ids, scores, 3)
+    assert result_ids.tolist() == [7, 1, 4]
+    assert result_scores.tolist() == [3.0, 2.0, 2.0]
+    result_ids, _ = topn_sparse(ids, scores, 10)
+    assert result_ids.tolist() == [7, 1, 4, 9, 8]
+
+
+def test_topn_sparse_matches_stable_argsort() -> None:
+    rng = np.random.default_rng(1)
+    ids = rng.permutation(1000)[:200]
+    scores = rng.integers(0, 8, 200).astype(np.float64)
+    by_id = np.argsort(ids, kind="stable")
+    # a stable sort of the id-sorted entries breaks ties by ascending id
+    order = by_id[np.argsort(-scores[by_id], kind="stable")]
+    order = order[scores[order] > 1.0]
+    for topn in (1, 10, 50, 300):
+        result_ids, result_scores = topn_sparse(ids, scores, topn, thresh=1.0)
+        assert np.array_equal(result_ids, ids[order][:topn])
+        assert np.array_equal(result_scores, scores[order][:topn])
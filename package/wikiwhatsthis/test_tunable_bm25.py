@@ -0,0 +1,115 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse
+from nltk.stem.snowball import SnowballStemmer
+from sklearn.feature_extraction.text import CountVectorizer
+
+from wikiwhatsthis.explicit_topic_model import ExplicitTopicModel
+from wikiwhatsthis.inverted_index import InvertedIndex
+from wikiwhatsthis.model_bundle import load_bundle, write_bundle
+from wikiwhatsthis.tunable_bm25 import BM25Params, TermFrequencyIndex, TunedIndex
+
+
+TOPIC_TEXTS = [
+    "red apple fruit apple",
+    "green apple tree tree tree",
+    "red car engine",
+    "blue sky",
+    "red red red sky over the apple tree",
+]
+
+
+def _dense_impacts(xcounts: np.ndarray, params: BM25Params) -> np.ndarray:
+    n_topics = xcounts.shape[0]
+    df = (xcounts > 0).sum(axis=0)
+    idf = np.log(1 + (n_topics - df + 0.5) / (df + 0.5))
+    dl = xcounts.sum(axis=1, keepdims=True)
+    norm = 1 - params.b + params.b * dl / dl.mean()
+    if params.variant == "bm25l":
+        ctf = xcounts / norm + params.delta
+        impacts = ctf * (params.k1 + 1) / (ctf + params.k1)
+    else:
+        impacts = xcounts * (params.k1 + 1) / (xcounts + params.k1 * norm)
+        if params.variant == "bm25+":
+            impacts += params.delta
+    return np.where(xcounts > 0, impacts * idf, 0.0)
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        BM25Params(),
+        BM25Params(k1=2.0, b=0.3),
+        BM25Params(k1=0.9, b=1.0, variant="bm25+", delta=1.0),
+        BM25Params(k1=1.5, b=0.5, variant="bm25l", delta=0.5),
+    ],
+)
+def test_impacts_match_formula(params: BM25Params) -> None:
+    xcounts = CountVectorizer().fit_transform(TOPIC_TEXTS)
+    term_frequencies = TermFrequencyIndex.from_counts(xcounts)
+    term_ids = np.array([4, 0, 7])
+    xterms = term_frequencies.term_matrix(term_ids, params)
+    expected = _dense_impacts(xcounts.toarray().astype(np.float64), params)
+    assert np.allclose(xterms.toarray(), expected[:, term_ids].T)
+
+    weights = np.array([0.5, 0.25, 0.25])
+    topic_ids, scores = term_frequencies.index(params).score(term_ids, weights)
+    expected_ids, expected_scores = InvertedIndex(xterms).score(np.arange(3), weights)
+    assert np.array_equal(topic_ids, expected_ids)
+    assert np.array_equal(scores, expected_scores)
+
+
+def test_cache_materializes_one_parameter_set() -> None:
+    xcounts = CountVectorizer().fit_transform(TOPIC_TEXTS)
+    term_frequencies = TermFrequencyIndex.from_counts(xcounts)
+    params = BM25Params(k1=1.0, b=0.5)
+    assert isinstance(term_frequencies.index(params), TunedIndex)
+    cached = term_frequencies.cache(params)
+    assert term_frequencies.index(params) is cached
+    assert isinstance(term_frequencies.index(BM25Params()), TunedIndex)
+    expected = _dense_impacts(xcounts.toarray().astype(np.float64), params)
+    assert np.allclose(cached.postings.toarray(), expected.T)
+    with pytest.raises(ValueError):
+        term_frequencies.cache(BM25Params(variant="bm26"))
+
+
+def test_model_scores_with_query_time_parameters(tmp_path: str) -> None:
+    cv = CountVectorizer()
+    xcounts = cv.fit_transform(TOPIC_TEXTS)
+    params = BM25Params(k1=1.6, b=0.4, variant="bm25+")
+    xtuned = scipy.sparse.csr_matrix(_dense_impacts(xcounts.toarray().astype(np.float64), params))
+    xdefault = scipy.sparse.csr_matrix(
+        _dense_impacts(xcounts.toarray().astype(np.float64), BM25Params())
+    )
+    topic_df = pd.DataFrame({"page_title": ["Apple", "Tree", "Car", "Sky", "Red"]})
+    stemmer = SnowballStemmer("english")
+    expected_model = ExplicitTopicModel(cv, xtuned, topic_df, stemmer)
+
+    bundle_path = os.path.join(tmp_path, "bundle")
+    write_bundle(
+        bundle_path,
+        {"cv_args": {}},
+        cv.get_feature_names_out(),
+        topic_df,
+        xdefault,
+        xcounts=xcounts,
+    )
+    model = load_bundle(bundle_path, stemmer=stemmer)
+    text = "a red apple tree in the sky"
+    expected = expected_model.topn_topics_from_text(text, topn=3)
+    for cached in (False, True):
+        if cached:
+            model.term_frequencies.cache(params)
+        result = model.topn_topics_from_text(text, topn=3, bm25_params=params)
+        assert list(result["page_title"]) == list(expected["page_title"])
+        assert np.allclose(result["score"], expected["score"])
+        batch = model.topn_topics_from_texts([text], topn=3, bm25_params=params)
+        assert np.allclose(batch.scores[0], expected["score"])
+
+    without_counts = ExplicitTopicModel(cv, xdefault, topic_df, stemmer)
+    with pytest.raises(ValueError):
+        without_counts.topn_topics_from_text(text, bm25_params=params)
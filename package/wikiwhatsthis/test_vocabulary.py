@@ -0,0 +1,40 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import os
+import random
+import tempfile
+
+from wikiwhatsthis.vocabulary import Vocabulary
+
+
+def _random_tokens(num_tokens: int, max_length: int) -> list:
+    alphabet = "abcé日z"
+    return [
+        "".join(random.choice(alphabet) for _ in range(random.randint(0, max_length)))
+        for _ in range(num_tokens)
+    ]
+
+
+def test_lookup_matches_dict() -> None:
+    random.seed(0)
+    tokens = [token for token in set(_random_tokens(3000, 6)) if token]
+    random.shuffle(tokens)
+    token_to_id = {token: indx for indx, token in enumerate(tokens)}
+    vocabulary = Vocabulary.from_tokens(tokens)
+    queries = tokens[:500] + _random_tokens(2000, 8)
+
+    assert list(vocabulary.lookup(queries)) == [token_to_id.get(token, -1) for token in queries]
+    assert vocabulary.tokens([3, 5]) == [tokens[3], tokens[5]]
+
+
+def test_from_dict_and_save_load() -> None:
+    random.seed(1)
+    tokens = sorted(token for token in set(_random_tokens(500, 5)) if token)
+    vocabulary = Vocabulary.from_dict({token: indx for indx, token in enumerate(tokens)})
+    # sorted column ids need no explicit indices array
+    assert vocabulary.indices is None
+
+    file_path = os.path.join(tempfile.mkdtemp(), "vocabulary.npz")
+    vocabulary.save(file_path)
+    loaded = Vocabulary.load(file_path)
+    assert loaded.tokens() == tokens
+    assert list(loaded.lookup(tokens)) == list(range(len(tokens)))
@@ -0,0 +1,43 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+import os
+
+from wikiwhatsthis.work_units import WorkUnit, iter_unit_lines, plan_work_units, run_work_units
+
+
+def _write_lines(file_path: str, num_lines: int) -> bytes:
+    content = b"".join(b"%d %s\n" % (ii, b"x" * (ii % 17)) for ii in range(num_lines))
+    with open(file_path, "wb") as fp:
+        fp.write(content)
+    return content
+
+
+def _upper_unit(unit: WorkUnit, out_path: str) -> int:
+    lines = list(iter_unit_lines(unit))
+    with open(out_path, "wb") as fp:
+        fp.writelines(line.upper() for line in lines)
+    return len(lines)
+
+
+def test_units_cover_every_line_once(tmp_path: str) -> None:
+    paths = [os.path.join(tmp_path, f"chunk-{ii}.jsonl") for ii in range(3)]
+    contents = [_write_lines(path, num_lines) for path, num_lines in zip(paths, [5, 200, 40])]
+    units = plan_work_units(paths, unit_bytes=97)
+    assert [unit.nbytes for unit in units] == sorted((unit.nbytes for unit in units), reverse=True)
+    for file_index, content in enumerate(contents):
+        file_units = sorted(unit for unit in units if unit.file_index == file_index)
+        lines = [line for unit in file_units for line in iter_unit_lines(unit)]
+        assert b"".join(lines) == content
+
+
+def test_run_work_units_reassembles_in_order(tmp_path: str) -> None:
+    in_paths = [os.path.join(tmp_path, f"chunk-{ii}.jsonl") for ii in range(2)]
+    out_paths = [os.path.join(tmp_path, f"out-{ii}.jsonl") for ii in range(2)]
+    contents = [_write_lines(path, num_lines) for path, num_lines in zip(in_paths, [300, 7])]
+    worker_stats = run_work_units(_upper_unit, in_paths, out_paths, workers=2, unit_bytes=128)
+    for out_path, content in zip(out_paths, contents):
+        with open(out_path, "rb") as fp:
+            assert fp.read() == content.upper()
+    assert sum(stats["lines"] for stats in worker_stats.values()) == 307
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        os.path.basename(path) for path in in_paths + out_paths
+    )
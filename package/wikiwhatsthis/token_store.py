@@ -0,0 +1,222 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""Pre-tokenized stems of the snowball chunk files.
+
+`task_01` can write a token store next to each chunk file, so count matrices
+can be built without decoding json or running the vectorizer's regex again.
+A store is an npz file with the arrays
+
+    stem_bytes, stem_offsets   utf-8 stems of the store, sorted, stem i is
+                               stem_bytes[stem_offsets[i]:stem_offsets[i + 1]]
+    stem_ids                   id of every stem token, paragraph after paragraph
+    paragraph_offsets          the tokens of paragraph i are stem_ids[offsets[i]:offsets[i + 1]]
+    section_idx                section of every paragraph
+    page_offsets               the paragraphs of page i, like `paragraph_offsets`
+    page_ids                   page id of every page
+
+Stores are written by independent workers, so each has its own stem
+dictionary. `concatenate_stores` maps them onto the sorted union of their
+dictionaries.
+
+`paragraph_counts_from_store` runs the vectorizer's analyzer once per distinct
+stem instead of once per token. The counts of a paragraph are then its stem
+counts times a (stems x terms) matrix. For word unigrams this equals
+vectorizing the space-joined `plaintext_snowball` (see `base_counts`).
+"""
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import scipy.sparse
+from sklearn.feature_extraction.text import CountVectorizer
+
+from wikiwhatsthis.base_counts import (
+    LIMIT_ARGS,
+    ParagraphCounts,
+    gather_ranges,
+    merge_paragraph_counts,
+    select_pages,
+    subset_rows,
+    sums_paragraph_counts,
+)
+from wikiwhatsthis.compressed_io import strip_compression
+
+
+TOKEN_STORE_SUFFIX = ".tokens.npz"
+
+
+def token_store_path(jsonl_path: str) -> str:
+    """Return the path of the token store of chunk file `jsonl_path`, whatever its compression."""
+    return strip_compression(jsonl_path) + TOKEN_STORE_SUFFIX
+
+
+class TokenStore(NamedTuple):
+    stems: np.ndarray
+    stem_ids: np.ndarray
+    paragraph_offsets: np.ndarray
+    section_idx: np.ndarray
+    page_offsets: np.ndarray
+    page_ids: np.ndarray
+
+    def save(self, file_path: str) -> None:
+        encoded = [stem.encode("utf-8") for stem in self.stems]
+        stem_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(stem) for stem in encoded], out=stem_offsets[1:])
+        # np.savez adds .npz to names without it
+        with open(file_path, "wb") as fp:
+            np.savez(
+                fp,
+                stem_bytes=np.frombuffer(b"".join(encoded), dtype=np.uint8),
+                stem_offsets=stem_offsets,
+                stem_ids=self.stem_ids,
+                paragraph_offsets=self.paragraph_offsets,
+                section_idx=self.section_idx,
+                page_offsets=self.page_offsets,
+                page_ids=self.page_ids,
+            )
+
+    @classmethod
+    def load(cls, file_path: str) -> "TokenStore":
+        with np.load(file_path) as arrays:
+            stem_bytes = arrays["stem_bytes"].tobytes()
+            stem_offsets = arrays["stem_offsets"]
+            stems = np.array(
+                [
+                    stem_bytes[start:stop].decode("utf-8")
+                    for start, stop in zip(stem_offsets[:-1], stem_offsets[1:])
+                ],
+                dtype=object,
+            )
+            return cls(
+                stems,
+                arrays["stem_ids"],
+                arrays["paragraph_offsets"],
+                arrays["section_idx"],
+                arrays["page_offsets"],
+                arrays["page_ids"],
+            )
+
+
+class TokenStoreWriter:
+    def __init__(self) -> None:
+        """Collect the stems of pages for a `TokenStore`."""
+        self._stem_ids: Dict[str, int] = {}
+        self._tokens: List[int] = []
+        self._paragraph_offsets = [0]
+        self._section_idx: List[int] = []
+        self._page_offsets = [0]
+        self._page_ids: List[int] = []
+
+    def add_page(self, page_id: int, paragraphs: Iterable[Tuple[int, Sequence[str]]]) -> None:
+        """Add a page given as (section_idx, stems) per paragraph."""
+        for section_idx, stems in paragraphs:
+            self._tokens.extend(
+                [self._stem_ids.setdefault(stem, len(self._stem_ids)) for stem in stems]
+            )
+            self._paragraph_offsets.append(len(self._tokens))
+            self._section_idx.append(section_idx)
+        self._page_offsets.append(len(self._section_idx))
+        self._page_ids.append(page_id)
+
+    def to_store(self) -> TokenStore:
+        stems = np.array(list(self._stem_ids), dtype=object)
+        order = np.argsort(stems)
+        sorted_ids = np.empty(len(order), dtype=np.int32)
+        sorted_ids[order] = np.arange(len(order), dtype=np.int32)
+        return TokenStore(
+            stems[order],
+            sorted_ids[np.array(self._tokens, dtype=np.int64)],
+            np.array(self._paragraph_offsets, dtype=np.int64),
+            np.array(self._section_idx, dtype=np.int32),
+            np.array(self._page_offsets, dtype=np.int64),
+            np.array(self._page_ids, dtype=np.int64),
+        )
+
+
+def concatenate_stores(stores: Sequence[TokenStore]) -> TokenStore:
+    """Concatenate the pages of `stores` on the union of their stem dictionaries."""
+    if not stores:
+        raise ValueError("stores must not be empty")
+    stems = np.unique(np.concatenate([store.stems for store in stores]))
+    stem_ids = []
+    paragraph_offsets = [np.zeros(1, dtype=np.int64)]
+    page_offsets = [np.zeros(1, dtype=np.int64)]
+    for store in stores:
+        stem_ids.append(np.searchsorted(stems, store.stems).astype(np.int32)[store.stem_ids])
+        paragraph_offsets.append(store.paragraph_offsets[1:] + paragraph_offsets[-1][-1])
+        page_offsets.append(store.page_offsets[1:] + page_offsets[-1][-1])
+    return TokenStore(
+        stems,
+        np.concatenate(stem_ids),
+        np.concatenate(paragraph_offsets),
+        np.concatenate([store.section_idx for store in stores]),
+        np.concatenate(page_offsets),
+        np.concatenate([store.page_ids for store in stores]),
+    )
+
+
+def paragraph_counts_from_store(
+    cv_args: Dict, store: TokenStore, rows: Optional[np.ndarray] = None
+) -> ParagraphCounts:
+    """Return the raw paragraph counts of the pages `rows` of `store` (all pages if None).
+
+    The counts are those of `base_counts.fit_paragraph_counts` on the same
+    pages, except that terms of the store that the pages do not use keep an
+    (empty) column.
+    """
+    if not sums_paragraph_counts(cv_args):
+        raise ValueError("paragraph counts add up to page counts only for word unigrams")
+    paragraphs, page_offsets = (
+        gather_ranges(store.page_offsets, rows)
+        if rows is not None
+        else (np.arange(len(store.section_idx)), store.page_offsets)
+    )
+    tokens, paragraph_offsets = gather_ranges(store.paragraph_offsets, paragraphs)
+
+    # analyze every stem once, a stem can give no term (e.g. a stop word) or several
+    analyze = CountVectorizer(
+        **{name: value for name, value in cv_args.items() if name not in LIMIT_ARGS}
+    ).build_analyzer()
+    stem_terms = [analyze(stem) for stem in store.stems]
+    all_terms = np.array([term for terms in stem_terms for term in terms], dtype=object)
+    feature_names = np.unique(all_terms)
+    term_columns = np.searchsorted(feature_names, all_terms)
+    num_terms = np.array([len(terms) for terms in stem_terms], dtype=np.int64)
+    stem_term = scipy.sparse.csr_matrix(
+        (
+            np.ones(len(term_columns), dtype=np.int64),
+            term_columns,
+            np.concatenate([[0], np.cumsum(num_terms)]),
+        ),
+        shape=(len(store.stems), len(feature_names)),
+    )
+    stem_term.sum_duplicates()
+
+    paragraph_stem = scipy.sparse.csr_matrix(
+        (np.ones(len(tokens), dtype=np.int64), store.stem_ids[tokens], paragraph_offsets),
+        shape=(len(paragraphs), len(store.stems)),
+    )
+    paragraph_stem.sum_duplicates()
+    xparagraph = scipy.sparse.csr_matrix(paragraph_stem @ stem_term)
+    xparagraph.sort_indices()
+    return ParagraphCounts(
+        feature_names,
+        xparagraph,
+        page_offsets.astype(np.int64),
+        store.section_idx[paragraphs].astype(np.int64),
+    )
+
+
+def paragraph_counts_from_stores(
+    cv_args: Dict, store_paths: Sequence[str], page_ids: np.ndarray
+) -> ParagraphCounts:
+    """Return the raw paragraph counts of pages `page_ids` (in that order) from token stores.
+
+    Stores are loaded one at a time and only their pages in `page_ids` are counted.
+    """
+    shards, shard_page_ids = [], []
+    for store_path in store_paths:
+        store = TokenStore.load(store_path)
+        (rows,) = np.nonzero(np.isin(store.page_ids, page_ids))
+        shards.append(paragraph_counts_from_store(cv_args, store, rows))
+        shard_page_ids.append(store.page_ids[rows])
+    paragraph_counts = merge_paragraph_counts(shards)
+    return select_pages(paragraph_counts, subset_rows(np.concatenate(shard_page_ids), page_ids))
@@ -0,0 +1,96 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""Column-oriented topic metadata backed by (memory-mapped) arrays.
+
+Numeric columns are plain arrays. String columns are a contiguous utf-8 byte
+buffer plus an offsets array, so a table with millions of page titles can be
+opened without creating millions of Python strings. Rows are only turned into
+a `pd.DataFrame` when they are selected.
+"""
+from typing import Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+
+StringColumn = Tuple[np.ndarray, np.ndarray]
+Column = Union[np.ndarray, StringColumn]
+
+
+def encode_strings(values: Sequence[str]) -> StringColumn:
+    """Return (utf-8 byte buffer, offsets) for `values`.
+
+    Missing values (None or NaN) are stored as empty strings, not as "nan".
+    """
+    encoded = [("" if pd.isna(value) else str(value)).encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return buffer, offsets
+
+
+def decode_strings(column: StringColumn, positions: Sequence[int]) -> List[str]:
+    buffer, offsets = column
+    return [
+        buffer[offsets[pos] : offsets[pos + 1]].tobytes().decode("utf-8") for pos in positions
+    ]
+
+
+class TopicTable:
+    def __init__(self, columns: Dict[str, Column], num_rows: int) -> None:
+        """Wrap named columns, each either an array or a (buffer, offsets) string column."""
+        self.columns = list(columns.keys())
+        self._columns = columns
+        self._num_rows = num_rows
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "TopicTable":
+        columns: Dict[str, Column] = {}
+        for name in df.columns:
+            if df[name].dtype.kind in "biuf":
+                columns[name] = df[name].values
+            else:
+                columns[name] = encode_strings(df[name].values)
+        return cls(columns, len(df))
+
+    def __len__(self) -> int:
+        return self._num_rows
+
+    @property
+    def iloc(self) -> "_TopicTableIloc":
+        """Positional row selection, `table.iloc[positions]` returns a `pd.DataFrame`."""
+        return _TopicTableIloc(self)
+
+    def rows(self, positions: Sequence[int]) -> pd.DataFrame:
+        positions = np.asarray(positions, dtype=np.int64)
+        data = {}
+        for name, column in self._columns.items():
+            if isinstance(column, tuple):
+                data[name] = decode_strings(column, positions)
+            else:
+                data[name] = np.asarray(column[positions])
+        return pd.DataFrame(data, index=positions, columns=self.columns)
+
+    def positions(self, name: str, value: Union[str, int, float]) -> np.ndarray:
+        """Return the positions of the rows where column `name` equals `value`."""
+        column = self._columns[name]
+        if not isinstance(column, tuple):
+            return np.flatnonzero(np.asarray(column) == value)
+
+        buffer, offsets = column
+        target = np.frombuffer(str(value).encode("utf-8"), dtype=np.uint8)
+        candidates = np.flatnonzero(np.diff(offsets) == len(target))
+        if len(target) == 0 or len(candidates) == 0:
+            return candidates
+        candidate_bytes = buffer[offsets[candidates][:, None] + np.arange(len(target))]
+        return candidates[(candidate_bytes == target).all(axis=1)]
+
+    def to_frame(self) -> pd.DataFrame:
+        return self.rows(np.arange(self._num_rows))
+
+
+class _TopicTableIloc:
+    def __init__(self, table: TopicTable) -> None:
+        self.table = table
+
+    def __getitem__(self, positions: Sequence[int]) -> pd.DataFrame:
+        return self.table.rows(positions)
@@ -0,0 +1,58 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""Top-k selection over topic and token scores.
+
+Scores are filtered with `thresh` first and only the survivors go through a
+partial selection (`np.partition`), so the cost of a query does not depend on
+the size of the topic or vocabulary axis. Results are in descending score
+order and ties are broken by ascending id, which is the order a stable
+`np.argsort(-scores)` gives.
+"""
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+def topn_positions(values: np.ndarray, topn: int, keys: Optional[np.ndarray] = None) -> np.ndarray:
+    """Return positions of the `topn` largest `values`, best first.
+
+    Parameters
+    ----------
+    values : array of shape (n,)
+        Scores to select from.
+    topn : int
+        Maximum number of positions to return.
+    keys : array of shape (n,), optional
+        Tie-break keys (smaller key wins). Defaults to the positions themselves.
+    """
+    num_values = len(values)
+    if keys is None:
+        keys = np.arange(num_values)
+    if topn <= 0 or num_values == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    if num_values > topn:
+        kth = np.partition(values, num_values - topn)[num_values - topn]
+        above = np.flatnonzero(values > kth)
+        ties = np.flatnonzero(values == kth)
+        ties = ties[np.argsort(keys[ties], kind="stable")][: topn - len(above)]
+        survivors = np.concatenate([above, ties])
+    else:
+        survivors = np.arange(num_values)
+
+    return survivors[np.lexsort((keys[survivors], -values[survivors]))]
+
+
+def topn_dense(scores: np.ndarray, topn: int, thresh: float = 0.0) -> np.ndarray:
+    """Return indices of the `topn` largest entries of `scores` that are above `thresh`."""
+    candidates = np.flatnonzero(scores > thresh)
+    return candidates[topn_positions(scores[candidates], topn)]
+
+
+def topn_sparse(
+    ids: np.ndarray, scores: np.ndarray, topn: int, thresh: float = 0.0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (ids, scores) of the `topn` largest explicit entries that are above `thresh`."""
+    keep = scores > thresh
+    ids, scores = ids[keep], scores[keep]
+    positions = topn_positions(scores, topn, keys=ids)
+    return ids[positions], scores[positions]
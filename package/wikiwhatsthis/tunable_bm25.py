@@ -0,0 +1,181 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""BM25 impacts computed at query time.
+
+`task_15_train_models` bakes `k1` and `b` into `xbm25`. A
+`TermFrequencyIndex` keeps what the impacts are made of instead: the raw
+term frequencies (term-major, like `inverted_index.InvertedIndex`), the
+length of every topic document and the idf of every term. Impacts are
+computed for the postings of the query terms only, for any `BM25Params`:
+
+    bm25    idf * tf * (k1 + 1) / (tf + k1 * norm)
+    bm25+   idf * (tf * (k1 + 1) / (tf + k1 * norm) + delta)
+    bm25l   idf * (ctf + delta) * (k1 + 1) / (ctf + delta + k1),  ctf = tf / norm
+
+with `norm = 1 - b + b * dl / avgdl`. Every variant uses the idf of
+`BM25Transformer`, so "bm25" with the default parameters gives the
+impacts of `xbm25`.
+
+The impacts of one parameter set can be materialized into an
+`InvertedIndex` with `cache`, which then also supports MaxScore retrieval.
+"""
+
+from typing import NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+import scipy.sparse
+
+from wikiwhatsthis.inverted_index import InvertedIndex
+from wikiwhatsthis.topk import topn_sparse
+
+BM25_VARIANTS = ("bm25", "bm25+", "bm25l")
+
+
+class BM25Params(NamedTuple):
+    """Parameters of query-time BM25 impacts, `delta` is ignored by "bm25"."""
+
+    k1: float = 1.2
+    b: float = 0.75
+    variant: str = "bm25"
+    delta: float = 1.0
+
+    def validate(self) -> "BM25Params":
+        if self.variant not in BM25_VARIANTS:
+            raise ValueError(f"variant must be one of {BM25_VARIANTS}")
+        if self.k1 < 0 or not 0 <= self.b <= 1 or self.delta < 0:
+            raise ValueError(f"k1 and delta must be non-negative and b in [0, 1], got {self}")
+        return self
+
+
+def bm25_impacts(
+    tf: np.ndarray, dl: np.ndarray, avgdl: float, idf: np.ndarray, params: BM25Params
+) -> np.ndarray:
+    """Return the float64 impacts of postings with term frequencies `tf`.
+
+    `dl` and `idf` are the document length and idf of every posting.
+    """
+    k1, b, variant, delta = params.validate()
+    tf = np.asarray(tf, dtype=np.float64)
+    norm = 1 - b + b * dl / avgdl
+    if variant == "bm25l":
+        ctf = tf / norm + delta
+        return idf * ctf * (k1 + 1) / (ctf + k1)
+    impacts = tf * (k1 + 1) / (tf + k1 * norm)
+    if variant == "bm25+":
+        impacts += delta
+    return idf * impacts
+
+
+class TunedIndex:
+    def __init__(self, term_frequencies: "TermFrequencyIndex", params: BM25Params) -> None:
+        """Score queries with the impacts of `params`, computed per query.
+
+        Mirrors the scoring methods of `InvertedIndex`. There are no stored
+        bounds, so `topn` always scores exhaustively.
+        """
+        self.term_frequencies = term_frequencies
+        self.params = params.validate()
+        self.n_terms, self.n_topics = term_frequencies.shape
+
+    def term_matrix(self, term_ids: np.ndarray) -> scipy.sparse.csr_matrix:
+        """Return the posting lists of `term_ids` as a (len(term_ids), n_topics) matrix."""
+        return self.term_frequencies.term_matrix(term_ids, self.params)
+
+    def score(self, term_ids: np.ndarray, weights: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Accumulate weighted impacts over the posting lists of the query terms.
+
+        Returns the same (topic ids, scores) as `InvertedIndex.score` on the
+        materialized impacts.
+        """
+        xterms = self.term_matrix(term_ids)
+        if xterms.nnz == 0:
+            return np.zeros(0, dtype=xterms.indices.dtype), np.zeros(0, dtype=np.float64)
+        contributions = np.repeat(np.asarray(weights, dtype=np.float64), np.diff(xterms.indptr))
+        contributions *= xterms.data
+        unique_topic_ids, slots = np.unique(xterms.indices, return_inverse=True)
+        scores = np.bincount(slots, weights=contributions, minlength=len(unique_topic_ids))
+        return unique_topic_ids, scores
+
+    def topn(
+        self,
+        term_ids: np.ndarray,
+        weights: np.ndarray,
+        topn: int = 10,
+        thresh: float = 0.0,
+        pruning: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (topic ids, scores) of the `topn` best topics with a score above `thresh`."""
+        topic_ids, scores = self.score(term_ids, weights)
+        return topn_sparse(topic_ids, scores, topn, thresh=thresh)
+
+
+class TermFrequencyIndex:
+    def __init__(
+        self, tf_postings: scipy.sparse.csr_matrix, doc_lengths: np.ndarray, idf: np.ndarray
+    ) -> None:
+        """Term-major raw term frequencies with the document lengths and idf of BM25.
+
+        Parameters
+        ----------
+        tf_postings : sparse matrix of shape (n_terms, n_topics)
+            Row `t` holds the term frequencies of term `t` in every topic.
+        doc_lengths : array of shape (n_topics,)
+            Number of terms of every topic document.
+        idf : array of shape (n_terms,)
+            idf of every term.
+        """
+        self.postings = InvertedIndex(tf_postings)
+        self.shape = tf_postings.shape
+        if doc_lengths.shape != (self.shape[1],) or idf.shape != (self.shape[0],):
+            raise ValueError(
+                f"doc_lengths {doc_lengths.shape} and idf {idf.shape}"
+                f" do not fit postings of shape {self.shape}"
+            )
+        self.doc_lengths = doc_lengths
+        self.idf = idf
+        self.avgdl = float(np.mean(doc_lengths)) if len(doc_lengths) else 1.0
+        self._cached: Optional[Tuple[BM25Params, InvertedIndex]] = None
+
+    @classmethod
+    def from_counts(cls, xcounts: scipy.sparse.spmatrix) -> "TermFrequencyIndex":
+        """Build the index of a (n_topics, n_terms) count matrix like `xcv`.
+
+        Term frequencies are stored as float32, exact for counts below 2 ** 24.
+        """
+        tf_postings = scipy.sparse.csr_matrix(xcounts.T, dtype=np.float32)
+        tf_postings.sort_indices()
+        n_topics = xcounts.shape[0]
+        doc_lengths = np.asarray(xcounts.sum(axis=1), dtype=np.float64).ravel()
+        # as `BM25Transformer.fit`, postings are nonzero counts
+        df = np.diff(tf_postings.indptr).astype(np.float64)
+        idf = np.log(1 + (n_topics - df + 0.5) / (df + 0.5))
+        return cls(tf_postings, doc_lengths, idf)
+
+    def term_matrix(self, term_ids: np.ndarray, params: BM25Params) -> scipy.sparse.csr_matrix:
+        """Return the impacts of the posting lists of `term_ids`, one row per term."""
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        xterms = self.postings.term_matrix(term_ids)
+        xterms.data = bm25_impacts(
+            xterms.data,
+            self.doc_lengths[xterms.indices],
+            self.avgdl,
+            np.repeat(self.idf[term_ids], np.diff(xterms.indptr)),
+            params,
+        )
+        return xterms
+
+    def cache(self, params: BM25Params) -> InvertedIndex:
+        """Materialize the impacts of `params` for all postings, replacing any cached set."""
+        params = params.validate()
+        if self._cached is None or self._cached[0] != params:
+            self._cached = (
+                params,
+                InvertedIndex(self.term_matrix(np.arange(self.shape[0]), params)),
+            )
+        return self._cached[1]
+
+    def index(self, params: BM25Params) -> Union[InvertedIndex, TunedIndex]:
+        """Return the cached index if it has `params`, otherwise a `TunedIndex`."""
+        params = params.validate()
+        if self._cached is not None and self._cached[0] == params:
+            return self._cached[1]
+        return TunedIndex(self, params)
@@ -0,0 +1,146 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""Compact array-backed vocabulary.
+
+`CountVectorizer.vocabulary_` is a dict with up to 500k string keys and
+`get_feature_names` makes a second copy as a list of strings. `Vocabulary`
+keeps the tokens in one sorted utf-8 byte buffer with an offsets array and
+looks up many tokens at once with a vectorized binary search, so it can be
+memory-mapped and holds no Python objects per token.
+"""
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+
+class Vocabulary:
+    def __init__(
+        self, buffer: np.ndarray, offsets: np.ndarray, indices: Optional[np.ndarray] = None
+    ) -> None:
+        """Wrap sorted tokens stored as a byte buffer.
+
+        Parameters
+        ----------
+        buffer : array of uint8
+            Concatenated utf-8 encoded tokens in byte order.
+        offsets : array of shape (n_tokens + 1,)
+            Token `i` is `buffer[offsets[i]:offsets[i + 1]]`.
+        indices : array of shape (n_tokens,), optional
+            Column id of each sorted token. Defaults to the sorted position,
+            which is how `CountVectorizer` numbers its features.
+        """
+        self.buffer = buffer
+        self.offsets = offsets
+        self.indices = indices
+        self._positions: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_tokens(cls, tokens: Sequence[str]) -> "Vocabulary":
+        """Build a vocabulary where `tokens[i]` has column id `i`."""
+        order = sorted(range(len(tokens)), key=tokens.__getitem__)
+        encoded = [tokens[indx].encode("utf-8") for indx in order]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(token) for token in encoded], out=offsets[1:])
+        buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        indices = np.array(order, dtype=np.int64)
+        if np.array_equal(indices, np.arange(len(indices))):
+            return cls(buffer, offsets)
+        return cls(buffer, offsets, indices)
+
+    @classmethod
+    def from_dict(cls, vocabulary: Dict[str, int]) -> "Vocabulary":
+        """Build a vocabulary from a token to column id mapping (e.g. `cv.vocabulary_`)."""
+        tokens = [""] * len(vocabulary)
+        for token, indx in vocabulary.items():
+            tokens[indx] = token
+        return cls.from_tokens(tokens)
+
+    @classmethod
+    def load(cls, file_path: str) -> "Vocabulary":
+        with np.load(file_path, allow_pickle=False) as loaded:
+            indices = loaded["indices"] if "indices" in loaded.files else None
+            return cls(loaded["buffer"], loaded["offsets"], indices)
+
+    def save(self, file_path: str) -> None:
+        arrays = {"buffer": self.buffer, "offsets": self.offsets}
+        if self.indices is not None:
+            arrays["indices"] = self.indices
+        np.savez(file_path, **arrays)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def lookup(self, tokens: Sequence[str]) -> np.ndarray:
+        """Return the column id of each token (-1 for tokens not in the vocabulary)."""
+        num_queries, num_tokens = len(tokens), len(self)
+        column_ids = np.full(num_queries, -1, dtype=np.int64)
+        if num_queries == 0 or num_tokens == 0:
+            return column_ids
+
+        # zero padded (num_queries, width) matrix of query bytes
+        encoded = [token.encode("utf-8") for token in tokens]
+        query_lengths = np.array([len(token) for token in encoded], dtype=np.int64)
+        width = max(1, int(query_lengths.max()))
+        query_bytes = np.zeros((num_queries, width), dtype=np.uint8)
+        rows = np.repeat(np.arange(num_queries), query_lengths)
+        cols = np.arange(len(rows)) - np.repeat(
+            np.cumsum(query_lengths) - query_lengths, query_lengths
+        )
+        query_bytes[rows, cols] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+        # lower bound binary search, all queries advance together
+        lo = np.zeros(num_queries, dtype=np.int64)
+        hi = np.full(num_queries, num_tokens, dtype=np.int64)
+        while True:
+            active = lo < hi
+            if not active.any():
+                break
+            mid = (lo + hi) // 2
+            greater = self._compare(query_bytes, np.minimum(mid, num_tokens - 1)) > 0
+            lo = np.where(active & greater, mid + 1, lo)
+            hi = np.where(active & ~greater, mid, hi)
+
+        found = lo < num_tokens
+        found[found] = self._compare(query_bytes[found], lo[found]) == 0
+        positions = lo[found]
+        column_ids[found] = positions if self.indices is None else self.indices[positions]
+        return column_ids
+
+    def _compare(self, query_bytes: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        """Return -1, 0 or 1 as each query row is less than, equal to or greater than its token."""
+        width = query_bytes.shape[1]
+        starts = self.offsets[positions]
+        lengths = self.offsets[positions + 1] - starts
+        cols = np.arange(width)
+        in_token = cols < lengths[:, None]
+        gather = np.minimum(starts[:, None] + cols, max(len(self.buffer) - 1, 0))
+        token_bytes = np.where(in_token, self.buffer[gather], 0).astype(np.uint8)
+
+        differs = query_bytes != token_bytes
+        first = differs.argmax(axis=1)
+        rows = np.arange(len(positions))
+        result = np.sign(
+            query_bytes[rows, first].astype(np.int16) - token_bytes[rows, first].astype(np.int16)
+        )
+        # equal over the query width: the query is a prefix of a longer token, or equal
+        result[~differs.any(axis=1) & (lengths > width)] = -1
+        return result
+
+    def tokens(self, column_ids: Optional[Iterable[int]] = None) -> List[str]:
+        """Return the tokens for `column_ids` (all tokens in column order by default)."""
+        if column_ids is None:
+            column_ids = range(len(self))
+        positions = self._column_positions()
+        return [
+            self.buffer[self.offsets[pos] : self.offsets[pos + 1]].tobytes().decode("utf-8")
+            for pos in (positions[indx] for indx in column_ids)
+        ]
+
+    def _column_positions(self) -> np.ndarray:
+        """Map column id to sorted position."""
+        if self._positions is None:
+            if self.indices is None:
+                self._positions = np.arange(len(self))
+            else:
+                self._positions = np.empty(len(self), dtype=np.int64)
+                self._positions[self.indices] = np.arange(len(self))
+        return self._positions
@@ -0,0 +1,220 @@
+# Copyright 2020-present Kensho Technologies, LLC.
+"""Balanced scheduling of line-oriented chunk files over a process pool.
+
+Chunk files differ a lot in size, so handing each file to the pool as one task
+ends a run with a few workers busy on the largest files. `run_work_units`
+splits every file into byte ranges of about `unit_bytes`, schedules the
+largest units first and pulls results as they finish. A unit owns the lines
+that start inside its byte range. Each unit writes its own part file, and the
+parts of a file are concatenated in order as soon as all of them are done.
+Compressed files are a single unit each, and their parts are compressed like
+the output so they can be concatenated without recompressing.
+"""
+from collections import defaultdict
+import logging
+from multiprocessing import Pool
+import os
+import shutil
+import time
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from wikiwhatsthis.compressed_io import (
+    compression_of,
+    iter_lines,
+    strip_compression,
+    with_compression,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+MB = 2 ** 20
+DEFAULT_UNIT_BYTES = 64 * MB
+DEFAULT_LOG_INTERVAL = 10.0
+
+
+class WorkUnit(NamedTuple):
+    file_index: int
+    unit_index: int
+    path: str
+    start: int
+    stop: int
+
+    @property
+    def nbytes(self) -> int:
+        return self.stop - self.start
+
+
+class UnitResult(NamedTuple):
+    unit: WorkUnit
+    pid: int
+    seconds: float
+    num_lines: int
+
+
+# worker function called with a unit and the path of its part file, returns lines written
+UnitFunction = Callable[[WorkUnit, str], int]
+
+
+def plan_work_units(
+    file_paths: Sequence[str], unit_bytes: int = DEFAULT_UNIT_BYTES
+) -> List[WorkUnit]:
+    """Split `file_paths` into byte ranges of at most about `unit_bytes`, largest first."""
+    if unit_bytes <= 0:
+        raise ValueError("unit_bytes must be positive")
+    units = []
+    for file_index, path in enumerate(file_paths):
+        size = os.path.getsize(path)
+        # compressed files can not be split without decompressing them
+        num_units = 1 if compression_of(path) else max(1, -(-size // unit_bytes))
+        bounds = [size * ii // num_units for ii in range(num_units + 1)]
+        for unit_index in range(num_units):
+            units.append(
+                WorkUnit(file_index, unit_index, path, bounds[unit_index], bounds[unit_index + 1])
+            )
+    return sorted(units, key=lambda unit: (-unit.nbytes, unit.file_index, unit.unit_index))
+
+
+def iter_unit_lines(unit: WorkUnit) -> Iterator[bytes]:
+    """Yield the lines of `unit.path` that start in [unit.start, unit.stop)."""
+    if compression_of(unit.path):
+        # the unit is the whole file
+        yield from iter_lines(unit.path)
+        return
+    with open(unit.path, "rb") as fp:
+        pos = unit.start
+        if pos > 0:
+            # the line that contains byte start - 1 belongs to the previous unit
+            fp.seek(pos - 1)
+            pos += len(fp.readline()) - 1
+        while pos < unit.stop:
+            line = fp.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+
+def part_path(out_path: str, unit_index: int) -> str:
+    """Return the hidden part file of unit `unit_index`, with the compression of `out_path`."""
+    dir_path, file_name = os.path.split(strip_compression(out_path))
+    part_file_name = f".{file_name}.part{unit_index:05d}"
+    return with_compression(os.path.join(dir_path, part_file_name), compression_of(out_path))
+
+
+def concatenate_parts(out_path: str, num_units: int) -> None:
+    """Concatenate the part files of `out_path` in unit order and remove them."""
+    if num_units == 1:
+        os.replace(part_path(out_path, 0), out_path)
+        return
+    with open(out_path, "wb") as ofp:
+        for unit_index in range(num_units):
+            with open(part_path(out_path, unit_index), "rb") as ifp:
+                shutil.copyfileobj(ifp, ofp, MB)
+    for unit_index in range(num_units):
+        os.remove(part_path(out_path, unit_index))
+
+
+class WorkProgress:
+    def __init__(
+        self, units: Sequence[WorkUnit], log_interval: float = DEFAULT_LOG_INTERVAL
+    ) -> None:
+        """Track finished units, overall throughput and throughput per worker process."""
+        self.total_units = len(units)
+        self.total_bytes = sum(unit.nbytes for unit in units)
+        self.log_interval = log_interval
+        self.done_units = 0
+        self.done_bytes = 0
+        self.start = time.perf_counter()
+        self._last_log = self.start
+        # pid -> [units, bytes, lines, busy seconds]
+        self.workers: Dict[int, List[float]] = defaultdict(lambda: [0, 0, 0, 0.0])
+
+    def observe(self, result: UnitResult) -> None:
+        self.done_units += 1
+        self.done_bytes += result.unit.nbytes
+        worker = self.workers[result.pid]
+        worker[0] += 1
+        worker[1] += result.unit.nbytes
+        worker[2] += result.num_lines
+        worker[3] += result.seconds
+        now = time.perf_counter()
+        if now - self._last_log >= self.log_interval or self.done_units == self.total_units:
+            self._last_log = now
+            self.log_progress()
+
+    def log_progress(self) -> None:
+        elapsed = time.perf_counter() - self.start
+        rate = self.done_bytes / elapsed if elapsed > 0 else 0.0
+        eta = (self.total_bytes - self.done_bytes) / rate if rate > 0 else float("inf")
+        logger.info(
+            f"{self.done_units}/{self.total_units} units, "
+            f"{self.done_bytes / MB:.0f}/{self.total_bytes / MB:.0f} MB "
+            f"({100 * self.done_bytes / max(self.total_bytes, 1):.1f}%), "
+            f"{rate / MB:.1f} MB/s, eta {eta:.0f}s"
+        )
+
+    def worker_stats(self) -> Dict[int, Dict[str, Any]]:
+        return {
+            pid: {
+                "units": int(units),
+                "mb": nbytes / MB,
+                "lines": int(lines),
+                "busy_seconds": seconds,
+                "mb_per_second": nbytes / MB / seconds if seconds > 0 else 0.0,
+            }
+            for pid, (units, nbytes, lines, seconds) in sorted(self.workers.items())
+        }
+
+
+def _run_unit(args: Tuple[UnitFunction, WorkUnit, str]) -> UnitResult:
+    unit_function, unit, unit_out_path = args
+    start = time.perf_counter()
+    num_lines = unit_function(unit, unit_out_path)
+    return UnitResult(unit, os.getpid(), time.perf_counter() - start, num_lines)
+
+
+def run_work_units(
+    unit_function: UnitFunction,
+    in_paths: Sequence[str],
+    out_paths: Sequence[str],
+    workers: int,
+    unit_bytes: int = DEFAULT_UNIT_BYTES,
+    log_interval: float = DEFAULT_LOG_INTERVAL,
+    on_file_done: Optional[Callable[[int], None]] = None,
+) -> Dict[int, Dict[str, Any]]:
+    """Map `unit_function` over the work units of `in_paths` and assemble `out_paths`.
+
+    `unit_function` must be a module level function (or a partial of one) so
+    it can be sent to the workers. `on_file_done` is called with the index of
+    each file once its output is assembled. Returns the throughput stats of
+    each worker process.
+    """
+    if len(in_paths) != len(out_paths):
+        raise ValueError("in_paths and out_paths must have the same length")
+    units = plan_work_units(in_paths, unit_bytes)
+    remaining: Dict[int, int] = defaultdict(int)
+    for unit in units:
+        remaining[unit.file_index] += 1
+    num_units = dict(remaining)
+    progress = WorkProgress(units, log_interval)
+    tasks = [
+        (unit_function, unit, part_path(out_paths[unit.file_index], unit.unit_index))
+        for unit in units
+    ]
+
+    with Pool(workers) as p:
+        for result in p.imap_unordered(_run_unit, tasks):
+            progress.observe(result)
+            file_index = result.unit.file_index
+            remaining[file_index] -= 1
+            if remaining[file_index] == 0:
+                concatenate_parts(out_paths[file_index], num_units[file_index])
+                if on_file_done is not None:
+                    on_file_done(file_index)
+
+    worker_stats = progress.worker_stats()
+    for pid, stats in worker_stats.items():
+        logger.info(f"worker {pid}: {stats}")
+    return worker_stats